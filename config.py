@@ -1,12 +1,15 @@
 import sys
 import random
 import string
-import hashlib
 from getpass import getpass
 
 import psycopg2
+from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from utils.dbconfig import dbconfig
+from utils.dbconfig import dbconfig, connectParams
+from utils.vault import computeMasterKey
+import utils.schema
+import utils.unlock
 
 from rich import print as printc
 from rich.console import Console
@@ -16,33 +19,32 @@ def generateDeviceSecret(length=10):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 def config():
+    # The database name and server come from $PM_DSN or the config file (see utils/dbconfig.py)
+    name = connectParams()["dbname"]
+
     # Connect to the default 'postgres' database to create our database
     try:
-        db = psycopg2.connect(
-            host='localhost',
-            user='pm',
-            password='password',
-            dbname='postgres'
-        )
+        db = psycopg2.connect(**connectParams("postgres"))
         db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         cursor = db.cursor()
-        cursor.execute("CREATE DATABASE pm")
+        cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
         db.close()
     except Exception as e:
         printc("[red][!] An error occurred while trying to create the db.[/red]")
         console.print_exception(show_locals=True)
         sys.exit(0)
-    printc("[green][+][/green] Database 'pm' created")
+    printc(f"[green][+][/green] Database '{name}' created")
 
-    # Connect to the new 'pm' database to create tables
-    db = dbconfig(database="pm")
+    # Connect to the new database to create tables
+    db = dbconfig(database=name)
     cursor = db.cursor()
 
     # In PostgreSQL we use the public schema (no "pm." prefix needed)
     query = """
         CREATE TABLE secrets (
-            masterkey_hash TEXT NOT NULL,
-            device_secret TEXT NOT NULL
+            masterkey_hash TEXT,
+            device_secret TEXT NOT NULL,
+            verifier TEXT
         )
     """
     cursor.execute(query)
@@ -66,23 +68,33 @@ def config():
             break
         printc("[yellow][-] Please try again.[/yellow]")
 
-    # Hash the MASTER PASSWORD
-    hashed_mp = hashlib.sha256(mp.encode()).hexdigest()
-    printc("[green][+][/green] Generated hash of MASTER PASSWORD")
-
     # Generate a DEVICE SECRET
     ds = generateDeviceSecret()
     printc("[green][+][/green] Device Secret Generated")
 
+    # Store a verifier derived from the master key, never a plain hash of the MASTER PASSWORD
+    verifier = utils.unlock.verifierOf(computeMasterKey(mp, ds))
+    printc("[green][+][/green] Derived the MASTER PASSWORD verifier")
+
     # Add to the DB
-    query = "INSERT INTO secrets (masterkey_hash, device_secret) VALUES (%s, %s)"
-    val = (hashed_mp, ds)
+    query = "INSERT INTO secrets (verifier, device_secret) VALUES (%s, %s)"
+    val = (verifier, ds)
     cursor.execute(query, val)
     db.commit()
 
     printc("[green][+][/green] Added to the database")
+
+    # Bring the new tables up to the current schema
+    utils.schema.migrate(db)
+
+    # Optionally encrypt site name, URL, email and username as well
+    if input("Encrypt entry metadata too? (yes/no): ").lower() in ["yes", "y"]:
+        cursor.execute("UPDATE secrets SET encrypt_metadata = TRUE")
+        db.commit()
+        printc("[green][+][/green] Metadata encryption enabled")
     printc("[green][+] Configuration done![/green]")
 
     db.close()
 
-config()
+if __name__ == "__main__":
+    config()
@@ -1,49 +1,229 @@
+import sys
 import argparse
 from getpass import getpass
-import hashlib
-import pyperclip
 
-from rich import print as printc
+# Everything else is imported by the subcommand that needs it, so e.g.
+# `pm.py g` never loads the database driver, the crypto library or rich's
+# console machinery. utils/importtime.py keeps this honest.
 
-import utils.add
-import utils.retrieve
-import utils.generate
-import utils.delete
-import utils.update
-from utils.dbconfig import dbconfig
+
+def printc(*objects, **kwargs):
+    """rich.print, imported on first use"""
+    from rich import print as rich_print
+    rich_print(*objects, **kwargs)
+
+
+# Every command; the shell completion scripts are built from the parser too
+COMMANDS = [
+    "add", "extract", "update", "generate", "delete", "encrypt-metadata", "backfill-urls", "batch", "serve",
+    "run", "sync", "snapshot", "restore", "stats", "loadtest", "attach", "get-attachment", "verify", "tags",
+    "rotate", "completion",
+]
+
+# Short command names, recorded under their long name
+ALIASES = {"a": "add", "e": "extract", "u": "update", "g": "generate", "d": "delete"}
 
 parser = argparse.ArgumentParser(description='Password Manager')
 
-parser.add_argument('option', help='(a)dd / (e)xtract / (g)enerate / (d)elete')
+parser.add_argument('option', choices=COMMANDS + list(ALIASES), metavar="option", help='(a)dd / (e)xtract / (u)pdate / (g)enerate / (d)elete / encrypt-metadata / backfill-urls / batch / serve / run / sync / snapshot / restore / stats / loadtest / attach / get-attachment / verify / tags / rotate / completion')
 parser.add_argument("-s", "--name", help="Site name")
 parser.add_argument("-u", "--url", help="Site URL")
 parser.add_argument("-e", "--email", help="Email")
 parser.add_argument("-l", "--login", help="Username")
-parser.add_argument("--length", help="Length of the password to generate", type=int)
+parser.add_argument("--domain", help="Registrable domain; matches every URL on it and its subdomains")
+parser.add_argument("-t", "--tag", action="append", help="add/update: tag the entry (repeat or comma-separate; update replaces the tags); extract: only entries with all of these tags")
+parser.add_argument("--any-tag", action='store_true', help="extract: match entries with any of the -t tags instead of all")
+parser.add_argument("--folder", help="add/update: put the entry in this folder ('' on update clears it); extract: only entries in this folder")
+parser.add_argument("--length", help="Length of the password to generate (rotate: default 24)", type=int)
+parser.add_argument("--older-than", metavar="AGE", help="rotate: entries whose password is older than AGE, e.g. 90d, 12h or 2w")
 parser.add_argument("-c", "--copy", action='store_true', help='Copy password to clipboard')
+parser.add_argument("--format", choices=["table", "json", "ndjson", "csv"], default="table", help="Output format for extract/list/verify")
+parser.add_argument("--new-name", help="update: new site name")
+parser.add_argument("--new-url", help="update: new site URL")
+parser.add_argument("--new-email", help="update: new email")
+parser.add_argument("--new-login", help="update: new username")
+parser.add_argument("--new-password", action='store_true', help="update: prompt for a new password")
+parser.add_argument("--expect-version", type=int, help="update: only write if the entry is still at this version")
+parser.add_argument("--with-passwords", action='store_true', help='Include decrypted passwords in json/ndjson/csv output (rotate: the new passwords)')
+parser.add_argument("--file", help="batch: read NDJSON commands from this file instead of stdin; attach: file to attach (default: a note from stdin); get-attachment: write to this file instead of stdout")
+parser.add_argument("--passphrase-fd", type=int, help="batch: read the master password from this file descriptor (default: $PM_PASSPHRASE_FD)")
+parser.add_argument("--group", type=int, default=100, help="batch: commands committed per transaction")
+parser.add_argument("--socket", help="serve: listen on this Unix socket path")
+parser.add_argument("--port", type=int, help="serve: listen on this localhost TCP port")
+parser.add_argument("--tokens", help="serve: file of client tokens (name, token hash, allowed methods)")
+parser.add_argument("--add-token", metavar="NAME", help="serve: create a token for client NAME and exit")
+parser.add_argument("--methods", help="serve: comma-separated methods the new token may call (get,list,add,update)")
+parser.add_argument("--threads", type=int, default=8, help="serve: worker threads and pooled connections")
+parser.add_argument("--map", action="append", default=[], help="run: VAR=field:value[+field:value], comma-separated; fields are sitename, siteurl, email, username, domain")
+parser.add_argument("--secrets-dir", help="run: write secrets to files here (e.g. on /dev/shm) and pass VAR_FILE paths instead")
+parser.add_argument("--remote", help="sync: libpq connection string of the other vault (default: $PM_SYNC_REMOTE)")
+parser.add_argument("--prefer", choices=["local", "remote"], help="sync: which side wins for entries changed on both")
+parser.add_argument("--snapshot-dir", help="snapshot/restore: snapshot store (default: $PM_SNAPSHOT_DIR or ~/.local/share/pm/snapshots)")
+parser.add_argument("--snapshot", help="restore: snapshot to restore (default: the latest)")
+parser.add_argument("--list", action='store_true', help="snapshot: list snapshots instead of taking one; get-attachment: list the entry's attachments")
+parser.add_argument("--profile", action='store_true', help="Print a per-phase timing breakdown to stderr (or set $PM_PROFILE)")
+parser.add_argument("--trace", metavar="FILE", help="Write timed phases to FILE as Chrome trace JSON (or set $PM_TRACE)")
+parser.add_argument("--cprofile", metavar="FILE", help="Run under cProfile and dump the stats to FILE")
+parser.add_argument("--prometheus", metavar="FILE", help="stats: also write the histograms as a Prometheus textfile (node_exporter)")
+parser.add_argument("--reset", action='store_true', help="stats: clear the recorded histograms")
+parser.add_argument("--workers", type=int, help="loadtest: concurrent clients (default 8); verify: worker processes (default: one per CPU)")
+parser.add_argument("--mode", choices=["thread", "process"], default="thread", help="loadtest: run the clients as threads or processes")
+parser.add_argument("--duration", type=float, default=10.0, help="loadtest: seconds to run for")
+parser.add_argument("--mix", help="loadtest: operation weights, e.g. add=20,extract=60,list=5,delete=15")
+parser.add_argument("--entries", type=int, default=10000, help="loadtest: entries seeded before the run")
+parser.add_argument("--keyspace", type=int, help="loadtest: distinct entries the clients pick from (default: --entries); smaller means more contention")
+parser.add_argument("--attachment", metavar="NAME", help="attach/get-attachment: attachment name (default: the file's name, or 'note')")
+parser.add_argument("--compress", action='store_true', help="attach: compress before encrypting")
+parser.add_argument("--shell", choices=["bash", "zsh", "fish"], default="bash", help="completion: shell to print the script for")
+
+
+def validateMasterPassword(mp, db):
+    """Check `mp` against the vault and upgrade it; returns (secrets row, master key) or None
+
+    The one key derivation both checks the password and yields the key.
+    """
+    import utils.unlock
+    import utils.completion
+    from utils.trace import span
+
+    notes = []
+    with span("unlock"):
+        unlocked = utils.unlock.unlock(mp, db, notes=notes)
+    # On stderr: stdout may be carrying an export
+    for note in notes:
+        printc(f"[green][+][/green] {note}", file=sys.stderr)
+    if unlocked is None:
+        return None
+    with span("completion.refresh"):
+        utils.completion.refresh(db, unlocked[0])
+    return unlocked
+
+
+def readPassphrase(fd):
+    """Read the master password from an inherited file descriptor, without prompting"""
+    import os
 
-args = parser.parse_args()
+    with os.fdopen(fd, "r", closefd=True) as f:
+        return f.readline().rstrip("\r\n")
+
+
+def refreshCompletion(db, added=None, removed=None):
+    """Update the shell-completion index after a write, on the command's
+    connection; never fails the command"""
+    import utils.completion
+    from utils.trace import span
+
+    try:
+        with span("completion.refresh"):
+            utils.completion.afterWrite(db, added, removed)
+        db.commit()
+    except Exception as e:
+        printc(f"[yellow][-][/yellow] Completion index not updated: {str(e).strip()}", file=sys.stderr)
+
+
+def readMasterPassword(args):
+    """Master password from --passphrase-fd / $PM_PASSPHRASE_FD, else prompt"""
+    import os
+    from utils.trace import span
+
+    fd = args.passphrase_fd
+    if fd is None and os.environ.get("PM_PASSPHRASE_FD"):
+        fd = int(os.environ["PM_PASSPHRASE_FD"])
+    with span("getpass"):
+        return readPassphrase(fd) if fd is not None else getpass("MASTER PASSWORD: ")
 
 
 def inputAndValidateMasterPassword():
-    mp = getpass("MASTER PASSWORD: ")
-    hashed_mp = hashlib.sha256(mp.encode()).hexdigest()
+    """Prompt for and check the master password; returns [mp, device secret,
+    master key, connection, utils.vault.Vault on that connection]
+
+    The connection stays open for the rest of the command.
+    """
+    import atexit
+    from utils.dbconfig import dbconfig
+    from utils.trace import span
+    from utils.vault import Vault
+
+    with span("getpass"):
+        mp = getpass("MASTER PASSWORD: ")
 
     db = dbconfig()
-    cursor = db.cursor()
-    query = "SELECT * FROM secrets"
-    cursor.execute(query)
-    result = cursor.fetchall()[0]
-    db.close()
+    unlocked = validateMasterPassword(mp, db)
 
-    if hashed_mp != result[0]:
+    if unlocked is None:
+        db.close()
         printc("[red][!] WRONG! [/red]")
         return None
 
-    return [mp, result[1]]
+    # Don't sit in an open transaction through later prompts
+    db.commit()
+    atexit.register(db.close)
+    secrets, mk = unlocked
+    return [mp, secrets["device_secret"], mk, db, Vault(db, mk, encrypted=bool(secrets.get("encrypt_metadata", False)))]
+
+# Commands whose duration says nothing about the vault's performance
+NOT_RECORDED = ["serve", "stats", "loadtest", "completion"]
+
+# Commands that work on the primary's entries alone, refused on a sharded vault
+SHARD_UNAWARE = [
+    "encrypt-metadata", "backfill-urls", "batch", "serve", "run", "sync", "snapshot", "restore", "loadtest",
+    "attach", "get-attachment", "verify", "rotate",
+]
 
 
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # `pm.py run ... -- command args` : everything after -- is the child command
+    command = []
+    if "--" in argv:
+        split = argv.index("--")
+        command = argv[split + 1:]
+        argv = argv[:split]
+
+    args = parser.parse_args(argv)
+
+    import os
+    import utils.trace
+
+    # Spans are always collected for the latency histograms (see `pm.py
+    # stats`); --profile and --trace only decide what is printed or written
+    record = args.option not in NOT_RECORDED and os.environ.get("PM_STATS") != "0"
+    if record or args.profile or args.trace:
+        utils.trace.enable(retain=args.profile or args.trace)
+    else:
+        utils.trace.enableFromEnv()
+
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        # Prompts inside are timed as interactive spans, which utils.stats
+        # takes back out of the command's recorded duration
+        with utils.trace.span(f"pm.py {ALIASES.get(args.option, args.option)}"):
+            runCommand(args, command)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        utils.trace.finish(args.profile, args.trace)
+        if record:
+            import utils.stats
+            utils.stats.recordTrace()
+
+
+def runCommand(args, command):
+    from utils.trace import span
+
+    if args.option in SHARD_UNAWARE:
+        import utils.shards
+        if utils.shards.active() is not None:
+            printc(f"[red][!][/red] '{args.option}' is not supported on a sharded vault yet")
+            return
+
     if args.option in ["add", "a"]:
         if args.name is None or args.url is None or args.login is None:
             if args.name is None:
@@ -57,11 +237,33 @@ def main():
         if args.email is None:
             args.email = ""
 
+        from utils.vault import DuplicateEntry
+
         res = inputAndValidateMasterPassword()
-        if res is not None:
-            utils.add.addEntry(res[0], res[1], args.name, args.url, args.email, args.login)
+        if res is None:
+            return
+        vault = res[4]
+        if vault.exists(args.name, args.url, args.email, args.login):
+            printc("[yellow][-][/yellow] Entry with these details already exists")
+            return
+        # Don't sit in an open transaction while the user types
+        res[3].commit()
+
+        with span("getpass"):
+            password = getpass("Password: ")
+        try:
+            vault.add(args.name, args.url, args.email, args.login, password, tags=args.tag, folder=args.folder)
+        except DuplicateEntry as e:
+            # Someone added it while the password was typed
+            printc(f"[yellow][-][/yellow] {e}")
+            return
+        printc("[green][+][/green] Added entry")
+        refreshCompletion(res[3], added={"sitename": args.name, "siteurl": args.url, "email": args.email, "username": args.login})
 
     if args.option in ["extract", "e"]:
+        import utils.retrieve
+        import utils.urls
+
         res = inputAndValidateMasterPassword()
 
         search = {}
@@ -73,41 +275,127 @@ def main():
             search["email"] = args.email
         if args.login is not None:
             search["username"] = args.login
+        if args.domain is not None:
+            search["url_domain"] = utils.urls.normalizeUrl(args.domain)["domain"]
+        if args.tag:
+            search["any_tags" if args.any_tag else "tags"] = args.tag
+        if args.folder is not None:
+            search["folder"] = args.folder
 
         if res is not None:
-            utils.retrieve.retrieveEntries(res[0], res[1], search, decryptPassword=args.copy)
+            # A caught-up replica takes the reads
+            vault, own = utils.retrieve.openVault(res[0], res[1], res[3], res[2])
+            try:
+                if args.format != "table":
+                    utils.retrieve.writeEntries(vault, search, args.format, includePasswords=args.with_passwords)
+                else:
+                    utils.retrieve.showEntries(vault, search, decryptPassword=args.copy)
+            finally:
+                if own:
+                    vault.db.close()
+
+    if args.option == "tags":
+        import utils.retrieve
+
+        res = inputAndValidateMasterPassword()
+        if res is not None:
+            utils.retrieve.showTags(res[4])
+
+    if args.option in ["update", "u"]:
+        if args.name is None or args.url is None:
+            printc("[red][!][/red] Both Site Name (-s) and Site URL (-u) are required to pick the entry to update")
+            return
+
+        changes = {}
+        for field, value in [("sitename", args.new_name), ("siteurl", args.new_url), ("email", args.new_email), ("username", args.new_login)]:
+            if value is not None:
+                changes[field] = value
+        if args.tag is not None:
+            changes["tags"] = args.tag
+        if args.folder is not None:
+            changes["folder"] = args.folder
+
+        from utils.update import UpdateError
+
+        res = inputAndValidateMasterPassword()
+        if res is None:
+            return
+
+        newPassword = None
+        if args.new_password or not changes:
+            with span("getpass"):
+                newPassword = getpass("New Password: ")
+                retyped = getpass("Re-Type: ")
+            if newPassword == "" or newPassword != retyped:
+                printc("[yellow][-][/yellow] Passwords empty or do not match; nothing updated")
+                return
+
+        try:
+            row = res[4].update(args.name, args.url, args.email or "", args.login or "",
+                                changes=changes, password=newPassword, expectedVersion=args.expect_version)
+        except UpdateError as e:
+            printc(f"[red][!][/red] {e}")
+            return
+        printc(f"[green][+][/green] Entry updated (version {row[1]})")
+        identity = {"sitename": args.name, "siteurl": args.url, "email": args.email or "", "username": args.login or ""}
+        renamed = {field: value for field, value in changes.items() if field in identity}
+        refreshCompletion(res[3], added={**identity, **renamed}, removed=identity)
 
     if args.option in ["generate", "g"]:
         if args.length is None:
             printc("[red][+][/red] Specify length of the password to generate (--length)")
             return
-        password = utils.generate.generatePassword(args.length)
-        pyperclip.copy(password)
+        import pyperclip
+        import utils.generate
+
+        with span("generate"):
+            password = utils.generate.generatePassword(args.length)
+        with span("clipboard"):
+            pyperclip.copy(password)
         printc("[green][+][/green] Password generated and copied to clipboard")
 
     if args.option in ["delete", "d"]:
+        import utils.delete
+        from utils.vault import EntryNotFound
+
         # Require master password first
         res = inputAndValidateMasterPassword()
         if res is None:
             return
+        vault = res[4]
         
         if args.name is None and args.url is None and args.email is None and args.login is None:
             # Show all entries and delete by ID
             printc("[cyan][*][/cyan] Listing all entries...\n")
-            all_entries = utils.delete.listEntries()
+            all_entries = vault.search()
+            utils.delete.printEntries(all_entries)
+            res[3].commit()
             
             if len(all_entries) == 0:
                 return
             
             try:
-                entry_id = int(input("\nEnter the ID of the entry to delete (0 to cancel): "))
+                with span("prompt"):
+                    entry_id = int(input("\nEnter the ID of the entry to delete (0 to cancel): "))
                 if entry_id == 0:
                     printc("[yellow][-][/yellow] Cancelled")
                     return
+                if entry_id < 1 or entry_id > len(all_entries):
+                    printc("[red][!][/red] Invalid ID")
+                    return
                 
-                confirm = input(f"Are you sure you want to delete entry {entry_id}? (yes/no): ")
+                with span("prompt"):
+                    confirm = input(f"Are you sure you want to delete entry {entry_id}? (yes/no): ")
                 if confirm.lower() in ["yes", "y"]:
-                    utils.delete.deleteEntryById(entry_id, all_entries)
+                    entry = all_entries[entry_id - 1]
+                    identity = {"sitename": entry.sitename, "siteurl": entry.siteurl, "email": entry.email or "", "username": entry.username or ""}
+                    try:
+                        vault.delete(**identity)
+                    except EntryNotFound as e:
+                        printc(f"[yellow][-][/yellow] {e}")
+                        return
+                    printc("[green][+][/green] Entry deleted successfully")
+                    refreshCompletion(res[3], removed=identity)
                 else:
                     printc("[yellow][-][/yellow] Cancelled")
             except ValueError:
@@ -123,11 +411,505 @@ def main():
             if args.login is None:
                 args.login = ""
             
-            confirm = input(f"Delete entry for {args.name}? (yes/no): ")
+            with span("prompt"):
+                confirm = input(f"Delete entry for {args.name}? (yes/no): ")
             if confirm.lower() in ["yes", "y"]:
-                utils.delete.deleteEntry(args.name, args.url, args.email, args.login)
+                try:
+                    vault.delete(args.name, args.url, args.email, args.login)
+                except EntryNotFound as e:
+                    printc(f"[yellow][-][/yellow] {e}")
+                    return
+                printc("[green][+][/green] Entry deleted successfully")
+                refreshCompletion(res[3], removed={"sitename": args.name, "siteurl": args.url, "email": args.email, "username": args.login})
             else:
                 printc("[yellow][-][/yellow] Cancelled")
 
+    if args.option in ["attach", "get-attachment"]:
+        if args.name is None or args.url is None:
+            printc("[red][!][/red] Both Site Name (-s) and Site URL (-u) are required to pick the entry", file=sys.stderr)
+            return
+
+        import os
+        import utils.attachments
+        import utils.metadata
+        import utils.update
+
+        res = inputAndValidateMasterPassword()
+        if res is None:
+            return
+        mk, db = res[2], res[3]
+        encrypted = utils.metadata.isEncrypted(db.cursor())
+        search = utils.update.identity(args.name, args.url, args.email or "", args.login or "")
+
+        try:
+            entry = utils.attachments.findEntry(db.cursor(), mk, search, encrypted)
+
+            if args.option == "attach":
+                name = args.attachment or (os.path.basename(args.file) if args.file else "note")
+                if args.file is None and sys.stdin.isatty():
+                    printc("[cyan][*][/cyan] Type the note, then Ctrl-D on an empty line")
+                try:
+                    source = open(args.file, "rb") if args.file else sys.stdin.buffer
+                except OSError as e:
+                    db.close()
+                    printc(f"[red][!][/red] {e}", file=sys.stderr)
+                    sys.exit(1)
+                try:
+                    size, stored = utils.attachments.addAttachment(db, mk, entry, name, source, encrypted, compress=args.compress)
+                finally:
+                    if args.file:
+                        source.close()
+                printc(f"[green][+][/green] Attached '{name}': {size} bytes, {stored} stored")
+                return
+
+            attachments = utils.attachments.listAttachments(db.cursor(), mk, entry, encrypted)
+            db.commit()
+            if args.list:
+                for _, name, size, stored, compressed in attachments:
+                    printc(f"{name}  {size} bytes, {stored} stored{', compressed' if compressed else ''}")
+                return
+
+            if args.attachment is not None:
+                matches = [row for row in attachments if row[1] == args.attachment]
+            else:
+                matches = attachments if len(attachments) == 1 else []
+            if not matches:
+                if args.attachment is not None or not attachments:
+                    raise utils.attachments.AttachmentError("No such attachment")
+                raise utils.attachments.AttachmentError(
+                    f"The entry has {len(attachments)} attachments; pick one with --attachment (--list shows them)"
+                )
+
+            if args.file:
+                utils.attachments.saveAttachment(db, mk, matches[0][0], args.file)
+                printc(f"[green][+][/green] Wrote '{matches[0][1]}' to {args.file}")
+            else:
+                utils.attachments.readAttachment(db, mk, matches[0][0], sys.stdout.buffer)
+        except utils.attachments.AttachmentError as e:
+            db.rollback()
+            printc(f"[red][!][/red] {e}", file=sys.stderr)
+            sys.exit(1)
+
+    if args.option == "encrypt-metadata":
+        import utils.metadata
+
+        res = inputAndValidateMasterPassword()
+        if res is None:
+            return
+
+        with span("prompt"):
+            confirm = input("Encrypt site name, URL, email and username of every entry? (yes/no): ")
+        if confirm.lower() in ["yes", "y"]:
+            utils.metadata.enableMetadataEncryption(res[2], db=res[3])
+        else:
+            printc("[yellow][-][/yellow] Cancelled")
+
+    if args.option == "backfill-urls":
+        import utils.metadata
+
+        res = inputAndValidateMasterPassword()
+        if res is None:
+            return
+
+        db = res[3]
+        encrypted = utils.metadata.isEncrypted(db.cursor())
+        count = utils.metadata.backfillUrlColumns(res[2] if encrypted else None, db=db)
+        printc(f"[green][+][/green] Normalized the URLs of {count} entries")
+
+    if args.option == "batch":
+        import utils.batch
+        from utils.dbconfig import dbconfig
+
+        # Unlock once, non-interactively when a descriptor is provided
+        mp = readMasterPassword(args)
+
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(1)
+
+        mk = unlocked[1]
+
+        source = open(args.file, encoding="utf-8") if args.file else sys.stdin
+        try:
+            succeeded, failed = utils.batch.runBatch(db, mk, source, sys.stdout, group=max(args.group, 1))
+        finally:
+            if args.file:
+                source.close()
+            db.close()
+
+        printc(f"[green][+][/green] {succeeded} succeeded, {failed} failed", file=sys.stderr)
+        if failed:
+            sys.exit(2)
+
+    if args.option == "serve":
+        import utils.server
+        from utils.dbconfig import dbconfig
+
+        if args.tokens is None:
+            printc("[red][!][/red] Client token file (--tokens) required")
+            return
+
+        if args.add_token is not None:
+            methods = args.methods.split(",") if args.methods else None
+            token = utils.server.addToken(args.tokens, args.add_token, methods)
+            printc(f"[green][+][/green] Token for {args.add_token} (shown once):")
+            print(token)
+            return
+
+        if (args.socket is None) == (args.port is None):
+            printc("[red][!][/red] Specify exactly one of --socket or --port")
+            return
+
+        tokens = utils.server.loadTokens(args.tokens)
+        if not tokens:
+            printc("[red][!][/red] No client tokens; create one with --add-token NAME")
+            return
+
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        db.close()
+        if unlocked is None:
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(1)
+
+        mk = unlocked[1]
+        del mp
+
+        address = args.socket if args.socket is not None else ("127.0.0.1", args.port)
+        server = utils.server.VaultServer(address, mk, tokens, threads=max(args.threads, 1), unix=args.socket is not None)
+        printc(f"[green][+][/green] Serving {len(tokens)} clients on {args.socket or f'127.0.0.1:{args.port}'} (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    if args.option == "run":
+        import utils.run
+        from utils.dbconfig import dbconfig
+
+        if not command:
+            printc("[red][!][/red] Command to run required after --")
+            sys.exit(2)
+
+        try:
+            mappings = utils.run.parseMappings(args.map)
+        except utils.run.MappingError as e:
+            printc(f"[red][!][/red] {e}", file=sys.stderr)
+            sys.exit(2)
+        if not mappings:
+            printc("[red][!][/red] At least one --map VAR=field:value required", file=sys.stderr)
+            sys.exit(2)
+
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(1)
+
+        # One key derivation and one query for every mapping
+        mk = unlocked[1]
+        try:
+            resolved = utils.run.resolve(db, mk, mappings)
+        except utils.run.MappingError as e:
+            printc(f"[red][!][/red] {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            db.close()
+
+        utils.run.execWith(command, resolved, args.secrets_dir)
+
+    if args.option == "sync":
+        import os
+        import psycopg2
+        import utils.sync
+        from utils.dbconfig import dbconfig
+
+        remote_dsn = args.remote or os.environ.get("PM_SYNC_REMOTE")
+        if not remote_dsn:
+            printc("[red][!][/red] Connection string of the other vault (--remote) required")
+            return
+
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        try:
+            remote = psycopg2.connect(remote_dsn)
+        except psycopg2.Error as e:
+            db.close()
+            printc(f"[red][!][/red] Could not connect to the other vault: {str(e).strip()}")
+            sys.exit(1)
+
+        notes = []
+        try:
+            sent, received, conflicts = utils.sync.sync(db, remote, mp, prefer=args.prefer, notes=notes)
+        except utils.sync.SyncConflict as e:
+            printc(f"[red][!][/red] {e}; nothing was synced")
+            for uuid, mine, theirs in e.conflicts:
+                local_name = mine["sitename"] if mine else "(deleted)"
+                remote_name = theirs["sitename"] if theirs else "(deleted)"
+                printc(f"    {uuid}: local {local_name} / remote {remote_name}")
+            printc("[yellow][-][/yellow] Re-run with --prefer local or --prefer remote to resolve them")
+            db.close()
+            sys.exit(1)
+        except utils.sync.SyncError as e:
+            printc(f"[red][!][/red] {e}")
+            db.close()
+            sys.exit(1)
+        finally:
+            remote.close()
+            for note in notes:
+                printc(f"[green][+][/green] {note}")
+
+        printc(f"[green][+][/green] Sent {sent}, received {received} changes ({conflicts} conflicts resolved)")
+        if received:
+            refreshCompletion(db)
+        db.close()
+
+    if args.option == "snapshot":
+        import time
+        import utils.snapshot
+        from utils.dbconfig import dbconfig
+
+        directory = args.snapshot_dir or utils.snapshot.defaultDir()
+        if args.list:
+            for name, manifest in utils.snapshot.listSnapshots(directory):
+                printc(f"{name}  {manifest['entries']} entries, {len(manifest['chunks'])} chunks")
+            return
+
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(1)
+
+        mk = unlocked[1]
+        started = time.perf_counter()
+        try:
+            name, manifest, written = utils.snapshot.createSnapshot(db, mk, directory)
+        finally:
+            db.close()
+        printc(f"[green][+][/green] Snapshot {name}: {manifest['entries']} entries in {len(manifest['chunks'])} chunks, "
+               f"{written / 1024:.1f} KiB written in {time.perf_counter() - started:.2f}s")
+
+    if args.option == "restore":
+        import utils.add
+        import utils.snapshot
+        from utils.dbconfig import dbconfig
+
+        directory = args.snapshot_dir or utils.snapshot.defaultDir()
+        try:
+            name, manifest = utils.snapshot.loadManifest(directory, args.snapshot)
+        except utils.snapshot.SnapshotError as e:
+            printc(f"[red][!][/red] {e}")
+            sys.exit(1)
+
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(1)
+
+        with span("prompt"):
+            confirm = input(f"Replace every entry in this vault with the {manifest['entries']} entries of snapshot {name}? (yes/no): ")
+        if confirm.lower() not in ["yes", "y"]:
+            db.close()
+            printc("[yellow][-][/yellow] Cancelled")
+            return
+
+        # The snapshot's entries were encrypted with the key of the vault it was taken from
+        secrets, mk = unlocked
+        if manifest["device_secret"] != secrets["device_secret"]:
+            mk = utils.add.computeMasterKey(mp, manifest["device_secret"])
+        try:
+            try:
+                restored = utils.snapshot.restoreSnapshot(db, mk, directory, manifest)
+            except utils.snapshot.AttachmentsWouldBeLost as e:
+                with span("prompt"):
+                    confirm = input(f"{e.count} attachments belong to entries that are not in the snapshot. Delete them with their entries? (yes/no): ")
+                if confirm.lower() not in ["yes", "y"]:
+                    db.close()
+                    printc("[yellow][-][/yellow] Cancelled; vault left unchanged")
+                    return
+                restored = utils.snapshot.restoreSnapshot(db, mk, directory, manifest, dropAttachments=True)
+        except (utils.snapshot.SnapshotError, OSError) as e:
+            printc(f"[red][!][/red] {e}; vault left unchanged")
+            db.close()
+            sys.exit(1)
+        printc(f"[green][+][/green] Restored {restored} entries from snapshot {name}")
+        refreshCompletion(db)
+        db.close()
+
+    if args.option == "stats":
+        import utils.stats
+        from rich.console import Console
+        from rich.table import Table
+
+        if args.reset:
+            utils.stats.reset()
+            printc("[green][+][/green] Latency histograms cleared")
+            return
+
+        histograms = utils.stats.read()
+        if not histograms:
+            printc(f"[yellow][-][/yellow] Nothing recorded yet in {utils.stats.path()}")
+            return
+
+        table = Table(title="Latency")
+        table.add_column("Operation / phase")
+        table.add_column("Count", justify="right")
+        for p in utils.stats.PERCENTILES:
+            table.add_column(f"p{p}", justify="right")
+        table.add_column("Mean", justify="right")
+
+        def fmt(seconds):
+            if seconds < 0.001:
+                return f"{seconds * 1e6:.0f} us"
+            return f"{seconds * 1000:.1f} ms" if seconds < 10 else f"{seconds:.1f} s"
+
+        # Each operation, followed by its phases
+        for name in sorted(histograms, key=lambda n: (n.split("/")[0], "/" in n, n)):
+            count, total, buckets = histograms[name]
+            label = "  " + name.split("/", 1)[1] if "/" in name else f"[bold]{name}[/bold]"
+            table.add_row(
+                label, str(count),
+                *[fmt(utils.stats.percentile(buckets, p)) for p in utils.stats.PERCENTILES],
+                fmt(total / count)
+            )
+        Console().print(table)
+        printc("[dim]Percentiles are bucket upper bounds (buckets are ~19% wide)[/dim]")
+
+        if args.prometheus:
+            utils.stats.writeTextfile(args.prometheus, histograms)
+            printc(f"[green][+][/green] Wrote {args.prometheus}")
+
+    if args.option == "loadtest":
+        import utils.loadtest
+
+        printc(f"[cyan][*][/cyan] Seeding {args.entries} entries into '{utils.loadtest.DATABASE}', then running "
+               f"{args.workers or 8} {args.mode} workers for {args.duration:g}s", file=sys.stderr)
+        try:
+            report = utils.loadtest.run(args.workers or 8, args.mode, args.duration, args.mix, args.entries, args.keyspace)
+        except utils.loadtest.LoadtestError as e:
+            printc(f"[red][!][/red] {e}")
+            sys.exit(1)
+        if args.format == "json":
+            import json
+            print(json.dumps(report, indent=2))
+        else:
+            utils.loadtest.printReport(report)
+
+    if args.option == "rotate":
+        import time
+        import utils.output
+        import utils.rotate
+        import utils.urls
+        from utils.dbconfig import dbconfig
+        from utils.vault import Vault
+
+        try:
+            age = utils.rotate.parseAge(args.older_than)
+        except ValueError as e:
+            printc(f"[red][!][/red] --older-than: {e}")
+            return
+
+        search = {}
+        if args.name is not None:
+            search["sitename"] = args.name
+        if args.domain is not None:
+            search["url_domain"] = utils.urls.normalizeUrl(args.domain)["domain"]
+        if args.tag:
+            search["any_tags" if args.any_tag else "tags"] = args.tag
+        if args.folder is not None:
+            search["folder"] = args.folder
+
+        # Like verify, takes --passphrase-fd so it can run from cron or a systemd timer
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(2)
+
+        started = time.perf_counter()
+        try:
+            with span("rotate"):
+                rotated = Vault(db, unlocked[1]).rotate(age, search, args.length)
+        finally:
+            db.close()
+        elapsed = time.perf_counter() - started
+
+        # Written only after the commit, so consumers never see passwords that were rolled back
+        if args.format != "table":
+            columns = ["uuid", "sitename", "siteurl", "email", "username", "version"]
+            if args.with_passwords:
+                columns.append("password")
+            rows = ({column: entry[column] for column in columns} for entry in rotated)
+            utils.output.streamRows(rows, args.format, sys.stdout, columns)
+        printc(f"[green][+][/green] {len(rotated)} password(s) older than {args.older_than} rotated in {elapsed:.2f}s", file=sys.stderr)
+
+    if args.option == "verify":
+        import time
+        import utils.output
+        import utils.verify
+        from utils.dbconfig import dbconfig
+
+        # Reads the master password from --passphrase-fd / $PM_PASSPHRASE_FD
+        # when given, so it can run from cron or a systemd timer
+        mp = readMasterPassword(args)
+        db = dbconfig()
+        unlocked = validateMasterPassword(mp, db)
+        if unlocked is None:
+            db.close()
+            printc("[red][!] WRONG! [/red]", file=sys.stderr)
+            sys.exit(2)
+
+        started = time.perf_counter()
+        try:
+            with span("verify"):
+                checked, problems = utils.verify.verifyVault(db, unlocked[1], args.workers)
+        finally:
+            db.close()
+        elapsed = time.perf_counter() - started
+
+        if args.format == "table":
+            if problems:
+                from rich.console import Console
+                from rich.table import Table
+
+                table = Table(title="Problems found")
+                table.add_column("ID", style="cyan")
+                table.add_column("UUID")
+                table.add_column("Problem", style="red")
+                for id, uuid, problem in problems:
+                    table.add_row(str(id or ""), str(uuid or ""), problem)
+                Console().print(table)
+        else:
+            rows = ({"id": id, "uuid": uuid and str(uuid), "problem": problem} for id, uuid, problem in problems)
+            utils.output.streamRows(rows, args.format, sys.stdout, ["id", "uuid", "problem"])
+
+        summary = f"{checked} entries checked in {elapsed:.2f}s ({checked / max(elapsed, 1e-9):,.0f}/s), {len(problems)} problem(s)"
+        if problems:
+            printc(f"[red][!][/red] {summary}", file=sys.stderr)
+            sys.exit(1)
+        printc(f"[green][+][/green] {summary}", file=sys.stderr)
+
+    if args.option == "completion":
+        import utils.completion
+
+        print(utils.completion.script(args.shell, parser), end="")
+
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
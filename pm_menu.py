@@ -1,4 +1,3 @@
-import hashlib
 from getpass import getpass
 import pyperclip
 
@@ -12,13 +11,29 @@ from rich.align import Align
 from rich.text import Text
 from rich import box
 
-import utils.add
 import utils.retrieve
 import utils.generate
+import utils.aesutil
+import utils.typeahead
+import utils.unlock
+import utils.trace
+import utils.stats
+import utils.livecache
+import utils.vault
+from utils.trace import span
 from utils.dbconfig import dbconfig
 
 console = Console()
 
+# Entries rendered (and, for encrypted vaults, decrypted) per page
+PAGE_SIZE = 50
+
+# Every entry, loaded on first use and kept current by Postgres notifications
+entry_cache = None
+
+# The connection each unlock is checked on, then reused by that menu option
+session_db = None
+
 
 def clear_screen():
     """Clear the console screen"""
@@ -56,7 +71,8 @@ def show_menu():
     menu_table.add_row("2", "View All Entries", "📋")
     menu_table.add_row("3", "Search & Extract Password", "🔍")
     menu_table.add_row("4", "Generate Random Password", "🎲")
-    menu_table.add_row("5", "Exit", "🚪")
+    menu_table.add_row("5", "Quick Search", "⚡")
+    menu_table.add_row("6", "Exit", "🚪")
     
     panel = Panel(
         menu_table,
@@ -69,6 +85,14 @@ def show_menu():
     console.print()
 
 
+def session_connection():
+    """The menu session's connection, opened on first use and after a drop"""
+    global session_db
+    if session_db is None or session_db.closed:
+        session_db = dbconfig()
+    return session_db
+
+
 def validate_master_password():
     """Validate master password and return credentials"""
     console.print(Panel(
@@ -77,23 +101,27 @@ def validate_master_password():
         padding=(0, 2)
     ))
     
-    mp = getpass("Enter MASTER PASSWORD: ")
-    hashed_mp = hashlib.sha256(mp.encode()).hexdigest()
+    with span("getpass"):
+        mp = getpass("Enter MASTER PASSWORD: ")
 
     try:
-        db = dbconfig()
-        cursor = db.cursor()
-        query = "SELECT * FROM secrets"
-        cursor.execute(query)
-        result = cursor.fetchall()[0]
-        db.close()
-
-        if hashed_mp != result[0]:
+        db = session_connection()
+        # One key derivation checks the password and yields the master key
+        notes = []
+        with span("menu.unlock"):
+            unlocked = utils.unlock.unlock(mp, db, notes=notes)
+        db.commit()
+        for note in notes:
+            console.print(f"[green][+][/green] {note}")
+
+        if unlocked is None:
             console.print("\n[bold red]❌ WRONG PASSWORD![/bold red]\n")
             return None
 
+        secrets, mk = unlocked
         console.print("\n[bold green]✅ Authentication successful![/bold green]\n")
-        return [mp, result[1]]
+        vault = utils.vault.Vault(db, mk, encrypted=bool(secrets.get("encrypt_metadata", False)))
+        return [mp, secrets["device_secret"], mk, db, vault]
     except Exception as e:
         console.print(f"\n[bold red]❌ Error: {e}[/bold red]\n")
         return None
@@ -127,7 +155,19 @@ def add_entry():
     username = Prompt.ask("👤 [bold green]Username[/bold green]")
 
     console.print()
-    utils.add.addEntry(res[0], res[1], sitename, siteurl, email, username)
+    vault = res[4]
+    if vault.exists(sitename, siteurl, email, username):
+        console.print("[yellow][-][/yellow] Entry with these details already exists")
+    else:
+        res[3].commit()
+        with span("getpass"):
+            password = getpass("Password: ")
+        try:
+            with span("menu.add"):
+                vault.add(sitename, siteurl, email, username, password)
+            console.print("[green][+][/green] Added entry")
+        except utils.vault.DuplicateEntry as e:
+            console.print(f"[yellow][-][/yellow] {e}")
     
     console.print()
     input("Press Enter to continue...")
@@ -148,44 +188,55 @@ def view_all_entries():
         input("\nPress Enter to continue...")
         return
 
-    # Get entries from database
+    # Served from the session's entry cache, which notifications keep current
     try:
-        db = dbconfig()
-        cursor = db.cursor()
-        query = "SELECT * FROM entries"
-        cursor.execute(query)
-        results = cursor.fetchall()
-        db.close()
-
-        if len(results) == 0:
+        with span("menu.view"):
+            cache = live_entries(res[2])
+            rows = cache.rows()
+        total = len(rows)
+
+        if total == 0:
             console.print(Panel(
                 "[yellow]No entries found in the database.[/yellow]",
                 border_style="yellow",
                 padding=(1, 2)
             ))
         else:
-            table = Table(
-                title=f"[bold magenta]Total Entries: {len(results)}[/bold magenta]",
-                box=box.ROUNDED,
-                border_style="green",
-                show_lines=True
-            )
-            table.add_column("🌐 Site Name", style="cyan", width=20)
-            table.add_column("🔗 URL", style="blue", width=30)
-            table.add_column("📧 Email", style="yellow", width=25)
-            table.add_column("👤 Username", style="green", width=20)
-            table.add_column("🔒 Password", style="red", width=12)
-
-            for entry in results:
-                table.add_row(
-                    entry[0] or "",
-                    entry[1] or "",
-                    entry[2] or "",
-                    entry[3] or "",
-                    "••••••••"
+            shown = 0
+
+            while True:
+                page = rows[shown:shown + PAGE_SIZE]
+                if not page:
+                    break
+
+                table = Table(
+                    title=f"[bold magenta]Total Entries: {total}[/bold magenta]",
+                    caption=f"Showing {shown + 1}-{shown + len(page)} of {total}",
+                    box=box.ROUNDED,
+                    border_style="green",
+                    show_lines=True
                 )
-            
-            console.print(table)
+                table.add_column("🌐 Site Name", style="cyan", width=20)
+                table.add_column("🔗 URL", style="blue", width=30)
+                table.add_column("📧 Email", style="yellow", width=25)
+                table.add_column("👤 Username", style="green", width=20)
+                table.add_column("🔒 Password", style="red", width=12)
+
+                # Only the page on screen is decrypted
+                for entry in cache.decode(page):
+                    table.add_row(
+                        entry.sitename or "",
+                        entry.siteurl or "",
+                        entry.email or "",
+                        entry.username or "",
+                        "••••••••"
+                    )
+
+                console.print(table)
+                shown += len(page)
+
+                if shown >= total or not Confirm.ask("[cyan]Show next page?[/cyan]", default=True):
+                    break
     except Exception as e:
         console.print(f"[bold red]❌ Error: {e}[/bold red]")
     
@@ -233,6 +284,10 @@ def search_and_extract():
     if username:
         search["username"] = username
 
+    tags = tag_prompt(res[4])
+    if tags:
+        search["tags"] = [tags]
+
     if not search:
         console.print("\n[yellow]ℹ️  No search criteria provided. Showing all entries...[/yellow]\n")
     
@@ -242,17 +297,66 @@ def search_and_extract():
     )
     
     console.print()
-    utils.retrieve.retrieveEntries(
-        res[0], 
-        res[1], 
-        search, 
-        decryptPassword=copy_password
-    )
+    with span("menu.search"):
+        utils.retrieve.showEntries(res[4], search, decryptPassword=copy_password)
     
     console.print()
     input("Press Enter to continue...")
 
 
+def tag_prompt(vault):
+    """Ask for tags to filter on, listing the vault's tags by number of entries"""
+    with span("menu.tags"):
+        tags, _ = vault.tagCounts()
+    vault.db.commit()
+    if tags:
+        console.print("[dim]" + ", ".join(f"{name} ({count})" for name, count in tags[:20]) + "[/dim]")
+    return Prompt.ask("🏷️  [bold green]Tags[/bold green] (comma-separated, all must match)", default="")
+
+
+def live_entries(mk):
+    """The session's entry cache; the first call loads it"""
+    global entry_cache
+    if entry_cache is None:
+        entry_cache = utils.livecache.EntryCache(mk)
+    return entry_cache
+
+
+def quick_search():
+    """Type-ahead search over all entries, copying the selected password"""
+    clear_screen()
+    console.print(Panel(
+        "[bold cyan]⚡ QUICK SEARCH[/bold cyan]",
+        border_style="cyan",
+        padding=(1, 2)
+    ))
+    console.print()
+
+    res = validate_master_password()
+    if res is None:
+        input("\nPress Enter to continue...")
+        return
+
+    mk = res[2]
+
+    try:
+        # Only rebuilt when another session (or this one) changed entries
+        with span("menu.quick_search"), console.status("[cyan]Building search index...[/cyan]"):
+            search_index = live_entries(mk).searchIndex()
+    except Exception as e:
+        console.print(f"[bold red]❌ Error: {e}[/bold red]")
+        input("\nPress Enter to continue...")
+        return
+
+    def copy_password(row):
+        # The clipboard needs a str; the decrypted bytes are wiped right after
+        with row.password(mk) as password:
+            pyperclip.copy(password.decode())
+        return f"[bold green]📋 Password for {row.sitename} copied to clipboard[/bold green]"
+
+    utils.typeahead.quickSearch(console, search_index, copy_password)
+
+
 def generate_password():
     """Generate a random password"""
     clear_screen()
@@ -267,8 +371,9 @@ def generate_password():
         "🔢 [bold green]Enter password length[/bold green]"
     )
     
-    password = utils.generate.generatePassword(length)
-    pyperclip.copy(password)
+    with span("menu.generate"):
+        password = utils.generate.generatePassword(length)
+        pyperclip.copy(password)
     
     # Display password in a nice centered box
     console.print()
@@ -299,7 +404,7 @@ def main():
         
         choice = Prompt.ask(
             "[bold cyan]Select an option[/bold cyan]",
-            choices=["1", "2", "3", "4", "5"]
+            choices=["1", "2", "3", "4", "5", "6"]
         )
         
         if choice == "1":
@@ -311,6 +416,8 @@ def main():
         elif choice == "4":
             generate_password()
         elif choice == "5":
+            quick_search()
+        elif choice == "6":
             clear_screen()
             console.print()
             console.print(Panel(
@@ -320,9 +427,15 @@ def main():
             ))
             console.print()
             break
+        if session_db is not None and not session_db.closed:
+            # Don't sit in a transaction an option left open while the menu waits
+            session_db.rollback()
+        utils.stats.recordTrace()
 
 
 if __name__ == "__main__":
+    # Always on: every menu operation goes into the latency histograms
+    utils.trace.enable()
     try:
         main()
     except KeyboardInterrupt:
@@ -342,4 +455,8 @@ if __name__ == "__main__":
             padding=(1, 2)
         ))
         console.print_exception(show_locals=True)
-        console.print()
\ No newline at end of file
+        console.print()
+    finally:
+        if session_db is not None:
+            session_db.close()
+        utils.trace.finish()
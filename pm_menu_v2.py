@@ -1,4 +1,3 @@
-import hashlib
 from getpass import getpass
 import pyperclip
 
@@ -12,14 +11,31 @@ from rich.align import Align
 from rich.text import Text
 from rich import box
 
-import utils.add
 import utils.retrieve
 import utils.generate
+import utils.aesutil
+import utils.typeahead
+import utils.unlock
+import utils.trace
+import utils.stats
+import utils.livecache
+import utils.vault
+from utils.trace import span
 import utils.delete
+import utils.update
 from utils.dbconfig import dbconfig
 
 console = Console()
 
+# Entries rendered (and, for encrypted vaults, decrypted) per page
+PAGE_SIZE = 50
+
+# Every entry, loaded on first use and kept current by Postgres notifications
+entry_cache = None
+
+# The connection each unlock is checked on, then reused by that menu option
+session_db = None
+
 
 def clear_screen():
     """Clear the console screen"""
@@ -56,7 +72,9 @@ def show_menu():
 [bold yellow]3.[/bold yellow] Search & Extract Password
 [bold yellow]4.[/bold yellow] Delete Entry
 [bold yellow]5.[/bold yellow] Generate Random Password
-[bold yellow]6.[/bold yellow] Exit
+[bold yellow]6.[/bold yellow] Quick Search
+[bold yellow]7.[/bold yellow] Update Password
+[bold yellow]8.[/bold yellow] Exit
         """,
         title="[bold magenta]Main Menu[/bold magenta]",
         border_style="bright_blue",
@@ -67,6 +85,14 @@ def show_menu():
     console.print()
 
 
+def session_connection():
+    """The menu session's connection, opened on first use and after a drop"""
+    global session_db
+    if session_db is None or session_db.closed:
+        session_db = dbconfig()
+    return session_db
+
+
 def validate_master_password():
     """Validate master password and return credentials"""
     console.print(Panel(
@@ -75,23 +101,27 @@ def validate_master_password():
         padding=(0, 2)
     ))
     
-    mp = getpass("Enter MASTER PASSWORD: ")
-    hashed_mp = hashlib.sha256(mp.encode()).hexdigest()
+    with span("getpass"):
+        mp = getpass("Enter MASTER PASSWORD: ")
 
     try:
-        db = dbconfig()
-        cursor = db.cursor()
-        query = "SELECT * FROM secrets"
-        cursor.execute(query)
-        result = cursor.fetchall()[0]
-        db.close()
-
-        if hashed_mp != result[0]:
+        db = session_connection()
+        # One key derivation checks the password and yields the master key
+        notes = []
+        with span("menu.unlock"):
+            unlocked = utils.unlock.unlock(mp, db, notes=notes)
+        db.commit()
+        for note in notes:
+            console.print(f"[green][+][/green] {note}")
+
+        if unlocked is None:
             console.print("\n[bold red]❌ WRONG PASSWORD![/bold red]\n")
             return None
 
+        secrets, mk = unlocked
         console.print("\n[bold green]✅ Authentication successful![/bold green]\n")
-        return [mp, result[1]]
+        vault = utils.vault.Vault(db, mk, encrypted=bool(secrets.get("encrypt_metadata", False)))
+        return [mp, secrets["device_secret"], mk, db, vault]
     except Exception as e:
         console.print(f"\n[bold red]❌ Error: {e}[/bold red]\n")
         return None
@@ -125,7 +155,19 @@ def add_entry():
     username = Prompt.ask("👤 [bold green]Username[/bold green]")
 
     console.print()
-    utils.add.addEntry(res[0], res[1], sitename, siteurl, email, username)
+    vault = res[4]
+    if vault.exists(sitename, siteurl, email, username):
+        console.print("[yellow][-][/yellow] Entry with these details already exists")
+    else:
+        res[3].commit()
+        with span("getpass"):
+            password = getpass("Password: ")
+        try:
+            with span("menu.add"):
+                vault.add(sitename, siteurl, email, username, password)
+            console.print("[green][+][/green] Added entry")
+        except utils.vault.DuplicateEntry as e:
+            console.print(f"[yellow][-][/yellow] {e}")
     
     console.print()
     input("Press Enter to continue...")
@@ -146,44 +188,55 @@ def view_all_entries():
         input("\nPress Enter to continue...")
         return
 
-    # Get entries from database
+    # Served from the session's entry cache, which notifications keep current
     try:
-        db = dbconfig()
-        cursor = db.cursor()
-        query = "SELECT * FROM entries"
-        cursor.execute(query)
-        results = cursor.fetchall()
-        db.close()
-
-        if len(results) == 0:
+        with span("menu.view"):
+            cache = live_entries(res[2])
+            rows = cache.rows()
+        total = len(rows)
+
+        if total == 0:
             console.print(Panel(
                 "[yellow]No entries found in the database.[/yellow]",
                 border_style="yellow",
                 padding=(1, 2)
             ))
         else:
-            table = Table(
-                title=f"[bold magenta]Total Entries: {len(results)}[/bold magenta]",
-                box=box.ROUNDED,
-                border_style="green",
-                show_lines=True
-            )
-            table.add_column("🌐 Site Name", style="cyan", width=20)
-            table.add_column("🔗 URL", style="blue", width=30)
-            table.add_column("📧 Email", style="yellow", width=25)
-            table.add_column("👤 Username", style="green", width=20)
-            table.add_column("🔒 Password", style="red", width=12)
-
-            for entry in results:
-                table.add_row(
-                    entry[0] or "",
-                    entry[1] or "",
-                    entry[2] or "",
-                    entry[3] or "",
-                    "••••••••"
+            shown = 0
+
+            while True:
+                page = rows[shown:shown + PAGE_SIZE]
+                if not page:
+                    break
+
+                table = Table(
+                    title=f"[bold magenta]Total Entries: {total}[/bold magenta]",
+                    caption=f"Showing {shown + 1}-{shown + len(page)} of {total}",
+                    box=box.ROUNDED,
+                    border_style="green",
+                    show_lines=True
                 )
-            
-            console.print(table)
+                table.add_column("🌐 Site Name", style="cyan", width=20)
+                table.add_column("🔗 URL", style="blue", width=30)
+                table.add_column("📧 Email", style="yellow", width=25)
+                table.add_column("👤 Username", style="green", width=20)
+                table.add_column("🔒 Password", style="red", width=12)
+
+                # Only the page on screen is decrypted
+                for entry in cache.decode(page):
+                    table.add_row(
+                        entry.sitename or "",
+                        entry.siteurl or "",
+                        entry.email or "",
+                        entry.username or "",
+                        "••••••••"
+                    )
+
+                console.print(table)
+                shown += len(page)
+
+                if shown >= total or not Confirm.ask("[cyan]Show next page?[/cyan]", default=True):
+                    break
     except Exception as e:
         console.print(f"[bold red]❌ Error: {e}[/bold red]")
     
@@ -231,6 +284,10 @@ def search_and_extract():
     if username:
         search["username"] = username
 
+    tags = tag_prompt(res[4])
+    if tags:
+        search["tags"] = [tags]
+
     if not search:
         console.print("\n[yellow]ℹ️  No search criteria provided. Showing all entries...[/yellow]\n")
     
@@ -240,17 +297,66 @@ def search_and_extract():
     )
     
     console.print()
-    utils.retrieve.retrieveEntries(
-        res[0], 
-        res[1], 
-        search, 
-        decryptPassword=copy_password
-    )
+    with span("menu.search"):
+        utils.retrieve.showEntries(res[4], search, decryptPassword=copy_password)
     
     console.print()
     input("Press Enter to continue...")
 
 
+def tag_prompt(vault):
+    """Ask for tags to filter on, listing the vault's tags by number of entries"""
+    with span("menu.tags"):
+        tags, _ = vault.tagCounts()
+    vault.db.commit()
+    if tags:
+        console.print("[dim]" + ", ".join(f"{name} ({count})" for name, count in tags[:20]) + "[/dim]")
+    return Prompt.ask("🏷️  [bold green]Tags[/bold green] (comma-separated, all must match)", default="")
+
+
+def live_entries(mk):
+    """The session's entry cache; the first call loads it"""
+    global entry_cache
+    if entry_cache is None:
+        entry_cache = utils.livecache.EntryCache(mk)
+    return entry_cache
+
+
+def quick_search():
+    """Type-ahead search over all entries, copying the selected password"""
+    clear_screen()
+    console.print(Panel(
+        "[bold cyan]⚡ QUICK SEARCH[/bold cyan]",
+        border_style="cyan",
+        padding=(1, 2)
+    ))
+    console.print()
+
+    res = validate_master_password()
+    if res is None:
+        input("\nPress Enter to continue...")
+        return
+
+    mk = res[2]
+
+    try:
+        # Only rebuilt when another session (or this one) changed entries
+        with span("menu.quick_search"), console.status("[cyan]Building search index...[/cyan]"):
+            search_index = live_entries(mk).searchIndex()
+    except Exception as e:
+        console.print(f"[bold red]❌ Error: {e}[/bold red]")
+        input("\nPress Enter to continue...")
+        return
+
+    def copy_password(row):
+        # The clipboard needs a str; the decrypted bytes are wiped right after
+        with row.password(mk) as password:
+            pyperclip.copy(password.decode())
+        return f"[bold green]📋 Password for {row.sitename} copied to clipboard[/bold green]"
+
+    utils.typeahead.quickSearch(console, search_index, copy_password)
+
+
 def generate_password():
     """Generate a random password"""
     clear_screen()
@@ -265,8 +371,9 @@ def generate_password():
         "🔢 [bold green]Enter password length[/bold green]"
     )
     
-    password = utils.generate.generatePassword(length)
-    pyperclip.copy(password)
+    with span("menu.generate"):
+        password = utils.generate.generatePassword(length)
+        pyperclip.copy(password)
     
     # Display password in a nice centered box
     console.print()
@@ -318,7 +425,18 @@ def update_entry():
     username = Prompt.ask("👤 [bold green]Username[/bold green] [dim](optional)[/dim]", default="")
 
     console.print()
-    utils.update.updateEntry(res[0], res[1], sitename, siteurl, email, username)
+    with span("getpass"):
+        password = getpass("New Password: ")
+        retyped = getpass("Re-Type: ")
+    if password == "" or password != retyped:
+        console.print("[yellow][-][/yellow] Passwords empty or do not match; nothing updated")
+    else:
+        try:
+            with span("menu.update"):
+                row = res[4].update(sitename, siteurl, email, username, password=password)
+            console.print(f"[green][+][/green] Entry updated (version {row[1]})")
+        except utils.update.UpdateError as e:
+            console.print(f"[red][!][/red] {e}")
     
     console.print()
     input("Press Enter to continue...")
@@ -350,7 +468,10 @@ def delete_entry():
     ))
     console.print()
     
-    all_entries = utils.delete.listEntries()
+    with span("menu.list"):
+        all_entries = res[4].search()
+    utils.delete.printEntries(all_entries)
+    res[3].commit()
     
     if len(all_entries) == 0:
         input("\nPress Enter to continue...")
@@ -367,6 +488,10 @@ def delete_entry():
             console.print("\n[yellow][-][/yellow] Cancelled")
             input("\nPress Enter to continue...")
             return
+        if entry_id < 1 or entry_id > len(all_entries):
+            console.print("\n[red][!][/red] Invalid ID")
+            input("\nPress Enter to continue...")
+            return
         
         confirm = Confirm.ask(
             f"\n[bold red]⚠️  Are you sure you want to delete entry {entry_id}?[/bold red]",
@@ -374,7 +499,13 @@ def delete_entry():
         )
         
         if confirm:
-            utils.delete.deleteEntryById(entry_id, all_entries)
+            entry = all_entries[entry_id - 1]
+            try:
+                with span("menu.delete"):
+                    res[4].delete(entry.sitename, entry.siteurl, entry.email or "", entry.username or "")
+                console.print("[green][+][/green] Entry deleted successfully")
+            except utils.vault.EntryNotFound as e:
+                console.print(f"[yellow][-][/yellow] {e}")
         else:
             console.print("\n[yellow][-][/yellow] Cancelled")
     except ValueError:
@@ -391,7 +522,7 @@ def main():
         
         choice = Prompt.ask(
             "[bold cyan]Select an option[/bold cyan]",
-            choices=["1", "2", "3", "4", "5", "6"]
+            choices=["1", "2", "3", "4", "5", "6", "7", "8"]
         )
         
         if choice == "1":
@@ -405,6 +536,10 @@ def main():
         elif choice == "5":
             generate_password()
         elif choice == "6":
+            quick_search()
+        elif choice == "7":
+            update_entry()
+        elif choice == "8":
             clear_screen()
             console.print()
             console.print(Panel(
@@ -414,9 +549,15 @@ def main():
             ))
             console.print()
             break
+        if session_db is not None and not session_db.closed:
+            # Don't sit in a transaction an option left open while the menu waits
+            session_db.rollback()
+        utils.stats.recordTrace()
 
 
 if __name__ == "__main__":
+    # Always on: every menu operation goes into the latency histograms
+    utils.trace.enable()
     try:
         main()
     except KeyboardInterrupt:
@@ -436,4 +577,8 @@ if __name__ == "__main__":
             padding=(1, 2)
         ))
         console.print_exception(show_locals=True)
-        console.print()
\ No newline at end of file
+        console.print()
+    finally:
+        if session_db is not None:
+            session_db.close()
+        utils.trace.finish()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The tests import pm and utils from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    """Skip unless the configured Postgres server is reachable; changes to
+    $PM_DATABASE made by the test are undone afterwards"""
+    import psycopg2
+    from utils.dbconfig import connectParams
+
+    monkeypatch.setenv("PM_DATABASE", os.environ.get("PM_DATABASE", "pm"))
+    try:
+        psycopg2.connect(connect_timeout=3, **connectParams("postgres")).close()
+    except psycopg2.Error as e:
+        pytest.skip(f"Postgres unreachable: {str(e).strip()}")
@@ -0,0 +1,5 @@
+import utils.importtime
+
+
+def test_startup_imports_within_budget():
+    assert utils.importtime.main([]) == 0
@@ -0,0 +1,7 @@
+import utils.updatecheck
+
+
+def test_one_writer_wins(postgres):
+    writers = 8
+    result = utils.updatecheck.run(writers)
+    assert utils.updatecheck.passed(writers, *result), result
@@ -1,57 +1,65 @@
 from utils.dbconfig import dbconfig
-import utils.aesutil
+from utils.trace import span
+from utils.vault import Vault, DuplicateEntry, computeMasterKey
+import utils.metadata
 from getpass import getpass
 
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Hash import SHA512
-from Crypto.Random import get_random_bytes
-import base64
-
 from rich import print as printc
-from rich.console import Console
 
-def computeMasterKey(mp, ds):
-    password = mp.encode()
-    salt = ds.encode()
-    key = PBKDF2(password, salt, 32, count=1000000, hmac_hash_module=SHA512)
-    return key
+
+def checkEntry(sitename, siteurl, email, username, mk=None, encrypted=False, db=None):
+    own = db is None
+    if own:
+        db = dbconfig()
+    found = Vault(db, mk, encrypted=encrypted).exists(sitename, siteurl, email, username)
+    if own:
+        db.close()
+    return found
 
 
-def checkEntry(sitename, siteurl, email, username):
-    db = dbconfig()
-    cursor = db.cursor()
-    query = "SELECT * FROM entries WHERE sitename = %s AND siteurl = %s AND email = %s AND username = %s"
-    cursor.execute(query, (sitename, siteurl, email, username))
-    results = cursor.fetchall()
-    db.close()
+def addEntry(mp, ds, sitename, siteurl, email, username, mk=None, db=None, tags=None, folder=None):
+    """Add an entry, prompting for its password, optionally tagged and in a folder
 
-    if len(results) != 0:
-        return True
-    return False
+    `mk` and `db` let a caller that already unlocked the vault reuse its
+    master key and connection.
+    """
+    own = db is None
+    if own:
+        db = dbconfig()
+    encrypted = utils.metadata.isEncrypted(db.cursor())
 
+    # Encrypted vaults need the key before the duplicate check can build its blind indexes
+    if mk is None and encrypted:
+        mk = computeMasterKey(mp, ds)
+    vault = Vault(db, mk, encrypted=encrypted)
 
-def addEntry(mp, ds, sitename, siteurl, email, username):
     # Check if the entry already exists
-    if checkEntry(sitename, siteurl, email, username):
+    if vault.exists(sitename, siteurl, email, username):
         printc("[yellow][-][/yellow] Entry with these details already exists")
+        if own:
+            db.close()
         return
 
+    # Don't sit in an open transaction while the user types
+    db.commit()
+
     # Input Password
-    password = getpass("Password: ")
+    with span("getpass"):
+        password = getpass("Password: ")
 
     # Compute master key
-    mk = computeMasterKey(mp, ds)
+    if vault.mk is None:
+        vault.mk = computeMasterKey(mp, ds)
 
-    # Encrypt password with mk
-    encrypted = utils.aesutil.encrypt(key=mk, source=password, keyType="bytes")
-
-    # Add to db
-    db = dbconfig()
-    cursor = db.cursor()
-    query = "INSERT INTO entries (sitename, siteurl, email, username, password) VALUES (%s, %s, %s, %s, %s)"
-    val = (sitename, siteurl, email, username, encrypted)
-    cursor.execute(query, val)
-    db.commit()
-    db.close()
+    try:
+        vault.add(sitename, siteurl, email, username, password, tags=tags, folder=folder)
+    except DuplicateEntry as e:
+        # Someone added it while the password was typed
+        printc(f"[yellow][-][/yellow] {e}")
+        return
+    finally:
+        if own:
+            db.close()
 
     printc("[green][+][/green] Added entry")
+    return True
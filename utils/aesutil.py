@@ -64,4 +64,36 @@ def decrypt(key, source, decode=True,keyType="hex"):
 	padding = data[-1]  # pick the padding value from the end; Python 2.x: ord(data[-1])
 	if data[-padding:] != bytes([padding]) * padding:  # Python 2.x: chr(padding) * padding
 		raise ValueError("Invalid padding...")
-	return data[:-padding]  # remove the padding
\ No newline at end of file
+	return data[:-padding]  # remove the padding
+
+def decryptSecret(key, source, decode=True, keyType="hex"):
+	'''
+	Like decrypt, but the plaintext is written straight into a wipeable buffer
+	and never exists as an immutable bytes object
+
+	Returns:
+	A utils.secretbuf.SecretBuffer with the decrypted data; wipe it (or use it in a with-block) when done
+	'''
+	from utils.secretbuf import SecretBuffer
+
+	source = source.encode()
+	if decode:
+		source = base64.b64decode(source)
+
+	if keyType == "hex":
+		# Convert key to bytes
+		key = bytes(bytearray.fromhex(key))
+
+	IV = source[:AES.block_size]  # extract the IV from the beginning
+	body = source[AES.block_size:]
+	secret = SecretBuffer(len(body))
+	data = secret.view()
+	AES.new(key, AES.MODE_CBC, IV).decrypt(body, output=data)  # decrypt in place
+	padding = data[-1] if len(data) else 0
+	valid = 1 <= padding <= AES.block_size and data[-padding:] == bytes([padding]) * padding
+	data.release()
+	if not valid:
+		secret.wipe()
+		raise ValueError("Invalid padding...")
+	secret.truncate(len(body) - padding)  # remove the padding
+	return secret
@@ -0,0 +1,270 @@
+import os
+import hmac
+import zlib
+import struct
+import hashlib
+
+from Crypto.Cipher import AES
+
+import utils.aesutil
+import utils.metadata
+from utils.trace import span
+
+# Files and notes attached to an entry are split into fixed-size chunks,
+# each sealed with AES-GCM and stored as one row of attachment_chunks.
+# Every attachment gets its own key, derived from the master key and a
+# random salt, so chunk numbers can serve as nonces. Each chunk's associated
+# data is its number and whether it is the last one, so chunks can't be
+# reordered, dropped or cut off at the end without decryption failing.
+# Both directions go through fixed-size buffers: memory use does not depend
+# on the size of the file.
+
+CHUNK_SIZE = 64 * 1024
+
+# Chunks written or fetched per round trip
+CHUNK_BATCH = 16
+
+SALT_SIZE = 16
+TAG_SIZE = 16
+
+
+class AttachmentError(Exception):
+    pass
+
+
+def attachmentKey(mk, salt):
+    return hmac.new(mk, b"pm-attachment:" + salt, hashlib.sha256).digest()
+
+
+def _cipher(key, seq, last):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=seq.to_bytes(12, "big"), mac_len=TAG_SIZE)
+    cipher.update(struct.pack(">Q?", seq, last))
+    return cipher
+
+
+def sealChunk(key, seq, data, last):
+    ciphertext, tag = _cipher(key, seq, last).encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def openChunk(key, seq, blob, last):
+    blob = bytes(blob)
+    try:
+        return _cipher(key, seq, last).decrypt_and_verify(blob[:-TAG_SIZE], blob[-TAG_SIZE:])
+    except ValueError:
+        raise AttachmentError(f"Chunk {seq} failed authentication; the attachment is damaged or was tampered with")
+
+
+class Sealer:
+    """Turns a binary stream into numbered, sealed chunks
+
+    `size` is the number of plaintext bytes read once iteration is done.
+    """
+
+    def __init__(self, key, compress=False, chunkSize=CHUNK_SIZE):
+        self.key = key
+        self.compress = compress
+        self.chunkSize = chunkSize
+        self.size = 0
+
+    def _blocks(self, source):
+        compressor = zlib.compressobj() if self.compress else None
+        while True:
+            block = source.read(self.chunkSize)
+            if not block:
+                break
+            self.size += len(block)
+            yield compressor.compress(block) if compressor else block
+        if compressor:
+            yield compressor.flush()
+
+    def chunks(self, source):
+        """Yield (seq, blob); the last chunk is held back until the input ends"""
+        pending = bytearray()
+        seq = 0
+        for data in self._blocks(source):
+            pending += data
+            while len(pending) > self.chunkSize:
+                yield seq, sealChunk(self.key, seq, bytes(pending[:self.chunkSize]), False)
+                del pending[:self.chunkSize]
+                seq += 1
+        yield seq, sealChunk(self.key, seq, bytes(pending), True)
+
+
+def unseal(key, chunks, compressed, out):
+    """Decrypt (seq, blob) chunks in order and write the content to `out`
+
+    Raises AttachmentError if a chunk is missing, out of order or altered,
+    or the end was cut off. What was written before the error must then be
+    thrown away.
+    """
+    decompressor = zlib.decompressobj() if compressed else None
+
+    def write(data):
+        if decompressor is None:
+            out.write(data)
+            return
+        # Bounded output per call, so a highly compressible chunk can't balloon
+        while data:
+            out.write(decompressor.decompress(data, CHUNK_SIZE))
+            data = decompressor.unconsumed_tail
+
+    # Only once the next chunk has arrived is it known a chunk wasn't the last
+    expected = 0
+    previous = None
+    for seq, blob in chunks:
+        if seq != expected:
+            raise AttachmentError(f"Chunk {expected} is missing")
+        if previous is not None:
+            write(openChunk(key, seq - 1, previous, False))
+        previous = blob
+        expected += 1
+    if previous is None:
+        raise AttachmentError("Attachment has no content")
+    write(openChunk(key, expected - 1, previous, True))
+    if decompressor is not None:
+        out.write(decompressor.flush())
+
+
+def findEntry(cursor, mk, search, encrypted):
+    """uuid of the one entry matching `search`"""
+    conditions, params = utils.metadata.searchConditions(mk, search, encrypted)
+    cursor.execute(f"SELECT uuid FROM entries WHERE {conditions} LIMIT 2", params)
+    rows = cursor.fetchall()
+    if not rows:
+        raise AttachmentError("Entry not found")
+    if len(rows) > 1:
+        raise AttachmentError("More than one entry matches; be more specific")
+    return rows[0][0]
+
+
+def listAttachments(cursor, mk, entryUuid, encrypted):
+    """[(id, name, size, stored bytes, compressed)] of an entry's attachments"""
+    cursor.execute(
+        "SELECT id, name, size, stored, compressed FROM attachments WHERE entry_uuid = %s ORDER BY id",
+        (entryUuid,)
+    )
+    rows = cursor.fetchall()
+    if encrypted:
+        rows = [(row[0], utils.metadata.decryptField(mk, row[1]), *row[2:]) for row in rows]
+    return rows
+
+
+def addAttachment(db, mk, entryUuid, name, source, encrypted, compress=False):
+    """Stream `source` into a new attachment called `name`, replacing one of
+    the same name, in one transaction; returns (size, stored bytes)"""
+    import psycopg2.extras
+
+    cursor = db.cursor()
+    for attachment in listAttachments(cursor, mk, entryUuid, encrypted):
+        if attachment[1] == name:
+            cursor.execute("DELETE FROM attachments WHERE id = %s", (attachment[0],))
+
+    salt = os.urandom(SALT_SIZE)
+    storedName = utils.aesutil.encrypt(key=mk, source=name, keyType="bytes") if encrypted else name
+    cursor.execute(
+        """
+        INSERT INTO attachments (entry_uuid, name, salt, compressed, chunk_size)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id
+        """,
+        (entryUuid, storedName, salt, compress, CHUNK_SIZE)
+    )
+    attachmentId = cursor.fetchone()[0]
+
+    sealer = Sealer(attachmentKey(mk, salt), compress)
+    batch = []
+    count = 0
+    stored = 0
+    with span("attach"):
+        for seq, blob in sealer.chunks(source):
+            batch.append((attachmentId, seq, blob))
+            count += 1
+            stored += len(blob)
+            if len(batch) == CHUNK_BATCH:
+                psycopg2.extras.execute_values(cursor, "INSERT INTO attachment_chunks (attachment_id, seq, data) VALUES %s", batch)
+                batch = []
+        if batch:
+            psycopg2.extras.execute_values(cursor, "INSERT INTO attachment_chunks (attachment_id, seq, data) VALUES %s", batch)
+
+    cursor.execute(
+        "UPDATE attachments SET chunks = %s, size = %s, stored = %s WHERE id = %s",
+        (count, sealer.size, stored, attachmentId)
+    )
+    db.commit()
+    return sealer.size, stored
+
+
+def readAttachment(db, mk, attachmentId, out):
+    """Stream attachment `attachmentId`, decrypted, to `out`"""
+    cursor = db.cursor()
+    cursor.execute("SELECT salt, compressed FROM attachments WHERE id = %s", (attachmentId,))
+    salt, compressed = cursor.fetchone()
+
+    pager = db.cursor(name="pm_attachment")
+    pager.itersize = CHUNK_BATCH
+    pager.execute("SELECT seq, data FROM attachment_chunks WHERE attachment_id = %s ORDER BY seq", (attachmentId,))
+    try:
+        with span("get-attachment"):
+            unseal(attachmentKey(mk, bytes(salt)), pager, compressed, out)
+    finally:
+        pager.close()
+        db.commit()
+
+
+def saveAttachment(db, mk, attachmentId, path):
+    """Write an attachment to `path` (mode 0600) only once all of it checked out"""
+    partial = f"{path}.part"
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            readAttachment(db, mk, attachmentId, out)
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+
+
+if __name__ == "__main__":
+    # Seal and open a large generated stream offline, chunk by chunk, and
+    # report peak traced memory (python -m utils.attachments [MiB])
+    import sys
+    import time
+    import tracemalloc
+    from rich import print as printc
+
+    class Pattern:
+        """`size` bytes, half random and half zeros, generated as they are read"""
+
+        def __init__(self, size):
+            self.left = size
+
+        def read(self, n):
+            n = min(n, self.left)
+            self.left -= n
+            return os.urandom(n // 2) + bytes(n - n // 2)
+
+    class Digest:
+        def __init__(self):
+            self.hash = hashlib.sha256()
+            self.size = 0
+
+        def write(self, data):
+            self.hash.update(data)
+            self.size += len(data)
+
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 2 ** 20
+    key = attachmentKey(os.urandom(32), os.urandom(SALT_SIZE))
+    ok = True
+    for compress in [False, True]:
+        out = Digest()
+        tracemalloc.start()
+        started = time.perf_counter()
+        unseal(key, Sealer(key, compress).chunks(Pattern(size)), compress, out)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        good = out.size == size
+        ok = ok and good
+        printc(f"[{'green' if good else 'red'}][{'+' if good else '!'}][/] {'compressed' if compress else 'plain'}: "
+               f"{size / 2 ** 20:.0f} MiB in {time.perf_counter() - started:.2f}s, peak {peak / 2 ** 10:.0f} KiB")
+    sys.exit(0 if ok else 1)
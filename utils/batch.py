@@ -0,0 +1,215 @@
+import json
+
+import psycopg2
+
+import utils.aesutil
+import utils.generate
+import utils.metadata
+import utils.update
+import utils.urls
+import utils.vault
+
+
+class BatchError(Exception):
+    pass
+
+
+def _fields(cmd, required=(), defaults=None):
+    values = dict(defaults or {})
+    for field in utils.metadata.FIELDS:
+        if cmd.get(field) is not None:
+            values[field] = str(cmd[field])
+    missing = [field for field in required if field not in values]
+    if missing:
+        raise BatchError(f"missing {', '.join(missing)}")
+    return values
+
+
+def _labels(cmd):
+    """{"tags", "folder"} of a command; tags may be a list or a comma-separated string"""
+    tags = cmd.get("tags")
+    if isinstance(tags, str):
+        tags = [tags]
+    if tags is not None and not (isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)):
+        raise BatchError("tags must be a string or a list of strings")
+    folder = cmd.get("folder")
+    if folder is not None and not isinstance(folder, str):
+        raise BatchError("folder must be a string")
+    return {"tags": tags, "folder": folder}
+
+
+def opAdd(cursor, mk, encrypted, cmd):
+    values = _fields(cmd, required=["sitename", "siteurl", "username"], defaults={"email": ""})
+    if cmd.get("password") is None:
+        raise BatchError("missing password")
+    labels = _labels(cmd)
+
+    # The same lock Vault.add takes, held until the batch commits, so two
+    # concurrent adds of one entry can't both pass the check below
+    key = utils.vault.lockKey(mk, values["sitename"], values["siteurl"], values["email"], values["username"])
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (key,))
+    conditions, params = utils.metadata.searchConditions(mk, values, encrypted)
+    cursor.execute(f"SELECT 1 FROM entries WHERE {conditions}", params)
+    if cursor.fetchone():
+        raise BatchError("entry with these details already exists")
+
+    values.update(labels)
+    columns = utils.metadata.encodeFields(mk, values, encrypted)
+    columns["password"] = utils.aesutil.encrypt(key=mk, source=str(cmd["password"]), keyType="bytes")
+    cursor.execute(
+        "INSERT INTO entries ({}) VALUES ({})".format(", ".join(columns.keys()), ", ".join(["%s"] * len(columns))),
+        list(columns.values())
+    )
+    utils.metadata.rememberLabels(cursor, mk, values, encrypted)
+    return {}
+
+
+def _select(cursor, mk, encrypted, search, limit=None):
+    query = "SELECT sitename, siteurl, email, username, password FROM entries"
+    params = []
+    if search:
+        conditions, params = utils.metadata.searchConditions(mk, search, encrypted)
+        query += f" WHERE {conditions}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def _search(cmd):
+    search = _fields(cmd)
+    if cmd.get("domain") is not None:
+        search["url_domain"] = utils.urls.normalizeUrl(str(cmd["domain"]))["domain"]
+    return search
+
+
+def _entry(mk, row, encrypted, decrypt):
+    entry = dict(zip(utils.metadata.FIELDS, utils.metadata.decodeRow(mk, row, encrypted)))
+    if decrypt:
+        with utils.aesutil.decryptSecret(key=mk, source=row[4], keyType="bytes") as password:
+            entry["password"] = password.decode()
+    return entry
+
+
+def opExtract(cursor, mk, encrypted, cmd):
+    rows = _select(cursor, mk, encrypted, _search(cmd))
+    return {"entries": [_entry(mk, row, encrypted, cmd.get("decrypt")) for row in rows]}
+
+
+def opGet(cursor, mk, encrypted, cmd):
+    """The one entry matching the criteria, with its password; for the
+    secrets daemon, which must never hand out the whole vault"""
+    search = _search(cmd)
+    if not search:
+        raise BatchError(f"give at least one of {', '.join(utils.metadata.FIELDS)} or domain")
+    rows = _select(cursor, mk, encrypted, search, limit=2)
+    if not rows:
+        raise BatchError("entry not found")
+    if len(rows) > 1:
+        raise BatchError("more than one entry matches; be more specific")
+    return {"entries": [_entry(mk, rows[0], encrypted, True)]}
+
+
+def opDelete(cursor, mk, encrypted, cmd):
+    values = _fields(cmd, required=["sitename", "siteurl"], defaults={"email": "", "username": ""})
+    conditions, params = utils.metadata.searchConditions(mk, values, encrypted)
+    cursor.execute(f"DELETE FROM entries WHERE {conditions}", params)
+    if cursor.rowcount == 0:
+        raise BatchError("entry not found")
+    return {"deleted": cursor.rowcount}
+
+
+def opUpdate(cursor, mk, encrypted, cmd):
+    search = _fields(cmd, required=["sitename", "siteurl"])
+    changes = cmd.get("set") or {}
+    if not isinstance(changes, dict) or any(field not in utils.metadata.FIELDS for field in changes):
+        raise BatchError(f"set must be an object with fields from {', '.join(utils.metadata.FIELDS)}")
+    changes = {field: str(value) for field, value in changes.items()}
+    password = str(cmd["password"]) if cmd.get("password") is not None else None
+    version = cmd.get("version")
+    if version is not None and not isinstance(version, int):
+        raise BatchError("version must be an integer")
+
+    try:
+        entry_id, version = utils.update.applyUpdate(cursor, mk, encrypted, search, changes, password, version)
+    except utils.update.UpdateError as e:
+        raise BatchError(str(e))
+    return {"version": version}
+
+
+def opGenerate(cursor, mk, encrypted, cmd):
+    length = cmd.get("length")
+    if not isinstance(length, int) or length < 1:
+        raise BatchError("length must be a positive integer")
+    return {"password": utils.generate.generatePassword(length)}
+
+
+OPS = {
+    "add": opAdd,
+    "extract": opExtract,
+    "delete": opDelete,
+    "update": opUpdate,
+    "generate": opGenerate,
+}
+
+
+def runBatch(db, mk, lines, out, group=100):
+    """Run newline-delimited JSON commands from `lines` over one connection
+
+    Each command runs inside a savepoint, so a failing command is reported
+    and rolled back without aborting the rest of its group. Groups of
+    `group` commands are committed together, and their results are written
+    to `out` as NDJSON only once the commit has succeeded. Returns
+    (succeeded, failed).
+    """
+    cursor = db.cursor()
+    encrypted = utils.metadata.isEncrypted(cursor)
+    db.commit()
+
+    pending = []
+    succeeded = failed = 0
+
+    def flush():
+        db.commit()
+        for result in pending:
+            out.write(json.dumps(result) + "\n")
+        out.flush()
+        pending.clear()
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        result = {"line": lineno}
+        try:
+            cmd = json.loads(line)
+            if not isinstance(cmd, dict):
+                raise BatchError("command must be a JSON object")
+            if "id" in cmd:
+                result["id"] = cmd["id"]
+            op = OPS.get(cmd.get("op")) if isinstance(cmd.get("op"), str) else None
+            if op is None:
+                raise BatchError(f"unknown op {cmd.get('op')!r}; expected one of {', '.join(OPS)}")
+
+            cursor.execute("SAVEPOINT batch_op")
+            try:
+                result.update(op(cursor, mk, encrypted, cmd))
+            except (BatchError, ValueError, psycopg2.Error):
+                cursor.execute("ROLLBACK TO SAVEPOINT batch_op")
+                raise
+            cursor.execute("RELEASE SAVEPOINT batch_op")
+
+            result["ok"] = True
+            succeeded += 1
+        except (BatchError, ValueError, psycopg2.Error) as e:
+            result["ok"] = False
+            result["error"] = str(e).strip()
+            failed += 1
+
+        pending.append(result)
+        if len(pending) >= group:
+            flush()
+
+    flush()
+    return succeeded, failed
@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+import contextlib
+
+from rich import print as printc
+
+# Throwaway database the vaults are seeded into; it is dropped and rebuilt
+# on every run, the real 'pm' database is never touched
+DATABASE = "pm_bench"
+
+MASTER_PASSWORD = "bench master password"
+DEVICE_SECRET = "BENCH00000"
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+
+# A p50 this much slower than the baseline is reported as a regression
+DEFAULT_THRESHOLD = 0.20
+
+# Rows per INSERT round trip while seeding
+SEED_BATCH = 5000
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "runs": len(ordered),
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p90_ms": percentile(ordered, 90) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+        "mean_ms": total / len(ordered) * 1000,
+        "ops_per_s": len(ordered) / total if total else None,
+    }
+
+
+def timeIt(fn, iterations):
+    """Run fn(i) `iterations` times after one warm-up call; returns seconds per call"""
+    fn(-1)
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def createDatabase(name=DATABASE):
+    import psycopg2
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+    from utils.dbconfig import connectParams
+
+    db = psycopg2.connect(**connectParams("postgres"))
+    db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+    if cursor.fetchone() is None:
+        cursor.execute(f"CREATE DATABASE {name}")
+    db.close()
+
+
+def resetVault(db, encrypted):
+    """Recreate an empty vault the way config.py does, then migrate it"""
+    import hashlib
+    import utils.schema
+
+    cursor = db.cursor()
+    cursor.execute("DROP TABLE IF EXISTS entries, secrets, changes, sync_peers, attachments, attachment_chunks, labels CASCADE")
+    cursor.execute("CREATE TABLE secrets (masterkey_hash TEXT NOT NULL, device_secret TEXT NOT NULL)")
+    cursor.execute("""
+        CREATE TABLE entries (
+            sitename TEXT NOT NULL,
+            siteurl TEXT NOT NULL,
+            email TEXT,
+            username TEXT,
+            password TEXT NOT NULL
+        )
+    """)
+    cursor.execute(
+        "INSERT INTO secrets (masterkey_hash, device_secret) VALUES (%s, %s)",
+        (hashlib.sha256(MASTER_PASSWORD.encode()).hexdigest(), DEVICE_SECRET)
+    )
+    db.commit()
+    utils.schema.migrate(db)
+    cursor.execute("UPDATE secrets SET encrypt_metadata = %s", (encrypted,))
+    db.commit()
+
+
+def entryValues(i):
+    return {
+        "sitename": f"site{i}",
+        "siteurl": f"https://login.site{i}.example.com/signin",
+        "email": f"user{i}@example.com",
+        "username": f"user{i}",
+    }
+
+
+def seed(db, mk, encrypted, start, stop):
+    """Insert entries start..stop-1 in batches"""
+    import psycopg2.extras
+    import utils.aesutil
+    import utils.generate
+    import utils.metadata
+
+    cursor = db.cursor()
+    for first in range(start, stop, SEED_BATCH):
+        rows = []
+        columns = None
+        for i in range(first, min(first + SEED_BATCH, stop)):
+            encoded = utils.metadata.encodeFields(mk, entryValues(i), encrypted)
+            encoded["password"] = utils.aesutil.encrypt(
+                key=mk, source=utils.generate.generatePassword(20), keyType="bytes"
+            )
+            columns = columns or list(encoded)
+            rows.append([encoded[col] for col in columns])
+        psycopg2.extras.execute_values(
+            cursor, f"INSERT INTO entries ({', '.join(columns)}) VALUES %s", rows, page_size=SEED_BATCH
+        )
+        db.commit()
+    cursor.execute("ANALYZE entries")
+    db.commit()
+
+
+def staticBenchmarks(mk):
+    """Operations whose cost does not depend on the vault size"""
+    import utils.add
+    import utils.aesutil
+    import utils.generate
+
+    cipher = utils.aesutil.encrypt(key=mk, source="correct horse battery staple", keyType="bytes")
+    return {
+        "computeMasterKey": (lambda i: utils.add.computeMasterKey(MASTER_PASSWORD, DEVICE_SECRET), 3),
+        "aesutil.encrypt": (lambda i: utils.aesutil.encrypt(key=mk, source="correct horse battery staple", keyType="bytes"), 5000),
+        "aesutil.decrypt": (lambda i: utils.aesutil.decrypt(key=mk, source=cipher, keyType="bytes"), 5000),
+        "generatePassword": (lambda i: utils.generate.generatePassword(32), 5000),
+    }
+
+
+def sizedBenchmarks(size, mk, encrypted):
+    """Operations measured against a vault of `size` entries"""
+    import utils.add
+    import utils.delete
+    import utils.retrieve
+
+    pick = random.Random(size)
+
+    def check(i):
+        values = entryValues(pick.randrange(size))
+        utils.add.checkEntry(values["sitename"], values["siteurl"], values["email"], values["username"], mk=mk, encrypted=encrypted)
+
+    def add(i):
+        # Fresh names each call, so the duplicate check never short-circuits
+        values = entryValues(f"-bench-{size}-{i}")
+        utils.add.addEntry(MASTER_PASSWORD, DEVICE_SECRET, values["sitename"], values["siteurl"], values["email"], values["username"])
+
+    def retrieve(i):
+        utils.retrieve.retrieveEntries(MASTER_PASSWORD, DEVICE_SECRET, {"sitename": f"site{pick.randrange(size)}"})
+
+    def listAll(i):
+        utils.delete.listEntries(MASTER_PASSWORD, DEVICE_SECRET)
+
+    return {
+        "checkEntry": (check, 200),
+        "checkEntry+addEntry": (add, 3),
+        "retrieveEntries": (retrieve, 50),
+        "listEntries": (listAll, 1 if size > 100000 else 3),
+    }
+
+
+def run(sizes, encrypted, only=None):
+    """Seed vaults of each size in turn and time every operation
+
+    Sizes are seeded incrementally, so 1k/100k/1M inserts 1M rows in all.
+    """
+    import utils.add
+    from utils.dbconfig import dbconfig
+
+    os.environ["PM_DATABASE"] = DATABASE
+    createDatabase()
+
+    mk = utils.add.computeMasterKey(MASTER_PASSWORD, DEVICE_SECRET)
+    # addEntry prompts for the new password; answer it here
+    utils.add.getpass = lambda prompt="": "bench entry password"
+
+    results = {}
+
+    def record(key, fn, iterations):
+        if only and key.split("@")[0] not in only:
+            return
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            samples = timeIt(fn, iterations)
+        results[key] = summarize(samples)
+        r = results[key]
+        printc(f"[green][+][/green] {key}: p50 {r['p50_ms']:.3f} ms, p99 {r['p99_ms']:.3f} ms, {r['ops_per_s']:.1f} ops/s")
+
+    for name, (fn, iterations) in staticBenchmarks(mk).items():
+        record(name, fn, iterations)
+
+    db = dbconfig()
+    resetVault(db, encrypted)
+    seeded = 0
+    for size in sorted(sizes):
+        printc(f"[cyan][*][/cyan] Seeding {size} entries...")
+        started = time.perf_counter()
+        seed(db, mk, encrypted, seeded, size)
+        seeded = size
+        printc(f"[cyan][*][/cyan] Seeded in {time.perf_counter() - started:.1f}s")
+        for name, (fn, iterations) in sizedBenchmarks(size, mk, encrypted).items():
+            record(f"{name}@{size}", fn, iterations)
+    db.close()
+
+    return {
+        "meta": {
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sorted(sizes),
+            "encrypted": encrypted,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print each operation's p50 against the baseline; returns the regressed keys"""
+    regressions = []
+    for key, now in sorted(current["results"].items()):
+        before = baseline["results"].get(key)
+        if before is None:
+            printc(f"[yellow][-][/yellow] {key}: not in baseline")
+            continue
+        ratio = now["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+        line = f"{key}: p50 {before['p50_ms']:.3f} -> {now['p50_ms']:.3f} ms ({(ratio - 1) * 100:+.1f}%)"
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            printc(f"[red][!][/red] {line}")
+        else:
+            printc(f"[green][+][/green] {line}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pm's hot paths against throwaway vaults")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated vault sizes to seed")
+    parser.add_argument("--only", help="Comma-separated operations to run (e.g. checkEntry,listEntries)")
+    parser.add_argument("--encrypted", action="store_true", help="Seed vaults with metadata encryption on")
+    parser.add_argument("--out", help="Write results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare against a stored results file and fail on regressions")
+    parser.add_argument("--results", help="With --compare: compare this results file instead of running")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed p50 slowdown before flagging (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    if args.results:
+        with open(args.results, encoding="utf-8") as f:
+            current = json.load(f)
+    else:
+        sizes = [int(size) for size in args.sizes.split(",") if size]
+        only = set(args.only.split(",")) if args.only else None
+        current = run(sizes, args.encrypted, only)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        printc(f"[green][+][/green] Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+import os
+
+# Values offered for each completable option. Only non-secret metadata is
+# cached; vaults with encrypted metadata get empty lists.
+FIELDS = {
+    "sitename": "sitename",
+    "siteurl": "siteurl",
+    "email": "email",
+    "username": "username",
+    "domain": "url_domain",
+}
+
+# How an option's value is completed, beyond the choices its argparse
+# definition lists; the commands and options themselves are read from
+# pm.py's parser when the script is generated
+CACHED = {
+    "--name": "sitename", "--new-name": "sitename",
+    "--url": "siteurl", "--new-url": "siteurl",
+    "--email": "email", "--new-email": "email",
+    "--login": "username", "--new-login": "username",
+    "--domain": "domain",
+}
+FILE_OPTIONS = ["--file", "--socket", "--tokens", "--trace", "--cprofile", "--prometheus"]
+DIR_OPTIONS = ["--secrets-dir", "--snapshot-dir"]
+VALUES = {"--methods": ["get", "list", "add", "update"]}
+
+
+def cacheDir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pm", "completion")
+
+
+def cachedVersion():
+    try:
+        with open(os.path.join(cacheDir(), "version")) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, text):
+    # Write-then-rename so a completion running concurrently never sees a
+    # half-written file; 0600 whatever the umask, as it lists vault metadata
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return set(f.read().splitlines())
+    except OSError:
+        return set()
+
+
+def _version(db, secrets):
+    """The vault version the index is checked against"""
+    import utils.shards
+
+    version = secrets.get("vault_version")
+    shards = utils.shards.active()
+    if shards is not None and version is not None:
+        # Each node counts its own writes; the sum moves whenever any of them does
+        version = sum(count for count, in shards.select("SELECT vault_version FROM secrets", dedupe=False))
+    return version
+
+
+def refresh(db, secrets):
+    """Rebuild the completion index if the vault changed since it was written
+
+    `secrets` is the row returned by utils.schema.readSecrets; its
+    vault_version is bumped by a trigger on every write to `entries`.
+    """
+    import utils.shards
+
+    version = _version(db, secrets)
+    if version is None or version == cachedVersion():
+        return False
+
+    values = {field: set() for field in FIELDS}
+    if not secrets.get("encrypt_metadata", False):
+        query = f"SELECT {', '.join(FIELDS.values())} FROM entries"
+        for row in utils.shards.select(db, query):
+            for field, value in zip(FIELDS, row):
+                # One value per line, so multi-line values can't be offered
+                if value and "\n" not in value:
+                    values[field].add(value)
+
+    directory = cacheDir()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    for field, found in values.items():
+        _write(os.path.join(directory, field), "".join(value + "\n" for value in sorted(found)))
+    # The version goes last: it marks the lists above as complete
+    _write(os.path.join(directory, "version"), f"{version}\n")
+    return True
+
+
+def _values(entry):
+    """{completion field: value} of an entry given as {column: value}"""
+    import utils.urls
+
+    values = {field: entry.get(field) for field in FIELDS if field != "domain"}
+    if entry.get("siteurl"):
+        values["domain"] = utils.urls.normalizeUrl(entry["siteurl"])["domain"]
+    return values
+
+
+def afterWrite(db, added=None, removed=None):
+    """Bring the index up to date after a write, on the writer's connection
+
+    `added` and `removed` are the {column: value} details the write put in
+    and took out. A single-statement write moves the vault version by one,
+    so when the index was current just before it, only those names are
+    changed; otherwise (other writers, or no details) the vault is rescanned.
+    """
+    import utils.shards
+    from utils.schema import readSecrets
+
+    secrets = readSecrets(db.cursor())
+    version = _version(db, secrets)
+    cached = cachedVersion()
+    if version is None or version == cached:
+        return False
+    if cached is None or version != cached + 1 or (added is None and removed is None):
+        return refresh(db, secrets)
+
+    directory = cacheDir()
+    if not secrets.get("encrypt_metadata", False):
+        added = _values(added or {})
+        removed = _values(removed or {})
+        for field, column in FIELDS.items():
+            old, new = removed.get(field), added.get(field)
+            if old == new:
+                continue
+            names = _read(os.path.join(directory, field))
+            if new and "\n" not in new:
+                names.add(new)
+            # Another entry may still use the old name
+            if old in names and not utils.shards.select(db, f"SELECT 1 FROM entries WHERE {column} = %s LIMIT 1", [old]):
+                names.discard(old)
+            _write(os.path.join(directory, field), "".join(value + "\n" for value in sorted(names)))
+    _write(os.path.join(directory, "version"), f"{version}\n")
+    return True
+
+
+BASH = r'''# pm.py completion for bash. Load with:  eval "$(python pm.py completion --shell bash)"
+_pm_complete() {
+    local cur prev field dir line
+    cur="${COMP_WORDS[COMP_CWORD]}"
+    prev="${COMP_WORDS[COMP_CWORD-1]}"
+    dir="${XDG_CACHE_HOME:-$HOME/.cache}/pm/completion"
+    COMPREPLY=()
+
+    case "$prev" in
+__FIELDS__
+__CHOICES__
+        __FILES__) COMPREPLY=($(compgen -f -- "$cur")); return ;;
+        __DIRS__) COMPREPLY=($(compgen -d -- "$cur")); return ;;
+    esac
+
+    if [ -n "$field" ]; then
+        [ -r "$dir/$field" ] || return
+        while IFS= read -r line; do
+            COMPREPLY+=("$(printf '%q' "$line")")
+        done < <(awk -v p="$cur" 'index($0, p) == 1' "$dir/$field")
+    elif [[ "$cur" == -* ]]; then
+        COMPREPLY=($(compgen -W "__OPTIONS__" -- "$cur"))
+    else
+        COMPREPLY=($(compgen -W "__COMMANDS__" -- "$cur"))
+    fi
+}
+complete -F _pm_complete pm.py pm
+'''
+
+ZSH = r'''# pm.py completion for zsh. Load with:  eval "$(python pm.py completion --shell zsh)"
+autoload -U +X compinit && compinit
+autoload -U +X bashcompinit && bashcompinit
+''' + BASH.split("\n", 1)[1]
+
+FISH = r'''# pm.py completion for fish. Load with:  python pm.py completion --shell fish | source
+function __pm_cached
+    set -l dir (set -q XDG_CACHE_HOME; and echo $XDG_CACHE_HOME; or echo $HOME/.cache)/pm/completion
+    test -r $dir/$argv[1]; and cat $dir/$argv[1]
+end
+for cmd in pm.py pm
+    complete -c $cmd -f
+    complete -c $cmd -n __fish_is_first_arg -a "__COMMANDS__"
+__FISH__
+end
+'''
+
+
+def _words(parser):
+    """(commands, [(option strings, choices, takes a value)]) from pm.py's parser"""
+    commands = []
+    options = []
+    for action in parser._actions:
+        if not action.option_strings:
+            commands.extend(action.choices or [])
+        else:
+            options.append((action.option_strings, VALUES.get(action.option_strings[-1], action.choices), action.nargs != 0))
+    return commands, options
+
+
+def _fishLine(strings, choices, takesValue):
+    parts = ["complete -c $cmd"]
+    parts += [f"-l {opt[2:]}" if opt.startswith("--") else f"-s {opt[1:]}" for opt in strings]
+    long = strings[-1]
+    if not takesValue:
+        pass
+    elif long in CACHED:
+        parts.append(f'-x -a "(__pm_cached {CACHED[long]})"')
+    elif long in FILE_OPTIONS:
+        parts.append("-r -F")
+    elif long in DIR_OPTIONS:
+        parts.append('-r -a "(__fish_complete_directories)"')
+    elif choices:
+        parts.append(f'-x -a "{" ".join(choices)}"')
+    else:
+        parts.append("-x")
+    return "    " + " ".join(parts)
+
+
+def script(shell, parser):
+    """Return the completion script for `shell`, for the commands and
+    options of `parser` (pm.py's)
+
+    The scripts read the cached value lists directly, so completing never
+    starts Python, opens a database connection or loads crypto.
+    """
+    templates = {"bash": BASH, "zsh": ZSH, "fish": FISH}
+    if shell not in templates:
+        raise ValueError(f"Unsupported shell: {shell} (expected bash, zsh or fish)")
+    commands, options = _words(parser)
+    fields = "\n".join(
+        f"        {'|'.join(strings)}) field={CACHED[strings[-1]]} ;;" for strings, _, _ in options if strings[-1] in CACHED
+    )
+    choices = "\n".join(
+        f'        {"|".join(strings)}) COMPREPLY=($(compgen -W "{" ".join(values)}" -- "$cur")); return ;;'
+        for strings, values, _ in options if values
+    )
+    return (
+        templates[shell]
+        .replace("__COMMANDS__", " ".join(commands))
+        .replace("__OPTIONS__", " ".join(opt for strings, _, _ in options for opt in strings))
+        .replace("__FIELDS__", fields)
+        .replace("__CHOICES__", choices)
+        .replace("__FILES__", "|".join(FILE_OPTIONS))
+        .replace("__DIRS__", "|".join(DIR_OPTIONS))
+        .replace("__FISH__", "\n".join(_fishLine(*option) for option in options))
+    )
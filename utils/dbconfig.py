@@ -1,19 +1,212 @@
+import os
+
 import psycopg2
+import psycopg2.extensions
+
+from utils.trace import span
+
+# Where to connect comes from, first match wins: $PM_DSN / $PM_REPLICA_DSN
+# (libpq connection strings), the [primary] / [replica] sections of the
+# config file, then the built-in defaults below. A host that is a directory,
+# such as /var/run/postgresql, connects over a Unix socket: no TCP handshake,
+# and peer authentication instead of a password. sslmode, sslrootcert,
+# sslcert and sslkey are passed to libpq as they are.
+DEFAULTS = dict(
+    host='localhost',
+    user='pm',
+    password='password',
+)
+
+# Reads skip a replica that is further behind the primary than this, in seconds
+DEFAULT_MAX_LAG = 5.0
+
+# Keys of a config section that are ours rather than libpq's
+OWN_KEYS = ["dsn", "max_lag", "joining"]
+
+# Config sections [shard:NAME] each name one node of a sharded vault
+SHARD_PREFIX = "shard:"
+
+_sections = None
+
+
+def configPath():
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.environ.get("PM_DB_CONFIG") or os.path.join(base, "pm", "db.ini")
+
+
+def configSections():
+    """{section: {key: value}} from the config file, read once per process"""
+    global _sections
+    if _sections is None:
+        _sections = {}
+        path = configPath()
+        if os.path.exists(path):
+            import configparser
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read(path, encoding="utf-8")
+            _sections = {name: dict(parser[name]) for name in parser.sections()}
+    return _sections
+
+
+def _params(section, variable=None):
+    """libpq keywords for `section`, or None when nothing configures it"""
+    settings = configSections().get(section, {})
+    dsn = os.environ.get(variable) if variable else None
+    if dsn is None:
+        dsn = settings.get("dsn")
+        params = {key: value for key, value in settings.items() if key not in OWN_KEYS}
+    else:
+        params = {}
+    if not dsn and not params:
+        return None
+
+    params = {**(psycopg2.extensions.parse_dsn(dsn) if dsn else {}), **params}
+    for key in ["host", "sslrootcert", "sslcert", "sslkey", "passfile"]:
+        if key in params and params[key].startswith("~"):
+            params[key] = os.path.expanduser(params[key])
+    return params
+
+
+def _database(database, params, default="pm"):
+    return database or os.environ.get("PM_DATABASE") or params.get("dbname") or default
+
+
+def connectParams(database=None):
+    """Connection keyword arguments for the primary, shared by dbconfig and connection pools
+
+    The database is `database`, else $PM_DATABASE, else the configured one, else 'pm'.
+    """
+    params = _params("primary", "PM_DSN") or dict(DEFAULTS)
+    params["dbname"] = _database(database, params)
+    return params
+
+
+def replicaParams(database=None):
+    """Connection keyword arguments for the read replica, or None if there is none
+
+    The database defaults to the primary's.
+    """
+    params = _params("replica", "PM_REPLICA_DSN")
+    if params is None:
+        return None
+    params["dbname"] = _database(database, params, connectParams()["dbname"])
+    return params
 
-from rich import print as printc
-from rich.console import Console
-console = Console()
 
-def dbconfig(database="pm"):
+def shardParams(database=None):
+    """{name: connection keyword arguments} for every [shard:NAME] section
+
+    Each node's database defaults to the primary's.
+    """
+    shards = {}
+    for section in configSections():
+        if section.startswith(SHARD_PREFIX):
+            params = _params(section) or {}
+            params["dbname"] = _database(database, params, connectParams()["dbname"])
+            shards[section[len(SHARD_PREFIX):]] = params
+    return shards
+
+
+def joiningShards():
+    """Shard nodes marked `joining = yes`: added to the ring, still being filled"""
+    return [
+        section[len(SHARD_PREFIX):] for section, settings in configSections().items()
+        if section.startswith(SHARD_PREFIX)
+        and settings.get("joining", "").lower() in ["1", "yes", "true", "on"]
+    ]
+
+
+def maxLag():
+    configured = configSections().get("replica", {}).get("max_lag")
+    return float(os.environ.get("PM_REPLICA_MAX_LAG") or configured or DEFAULT_MAX_LAG)
+
+
+def replicaLag(db):
+    """Seconds the server at `db` is behind its primary; 0 for a primary
+
+    A standby that has replayed all it received counts as caught up, but
+    only while it is still streaming; otherwise it is infinitely behind.
+    """
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 'Infinity'
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+        END::float8
+    """)
+    lag = cursor.fetchone()[0]
+    db.rollback()
+    return lag
+
+
+def replica(database=None):
+    """A read-only connection to the replica, or None when there is no
+    replica, it can't be reached, or it lags by more than maxLag()"""
+    params = replicaParams(database)
+    if params is None:
+        return None
     try:
-        db = psycopg2.connect(
-            host='localhost',
-            user='pm',
-            password='password',
-            dbname=database
-        )
+        with span("db.connect.replica"):
+            db = psycopg2.connect(**params)
+            db.set_session(readonly=True)
+            lag = replicaLag(db)
+    except psycopg2.Error:
+        return None
+    if lag > maxLag():
+        db.close()
+        return None
+    return db
+
+
+def reader(db=None):
+    """Connection for read-only queries: the replica when it is usable, else
+    `db`, else a new primary connection. Close it unless it is `db`."""
+    return replica() or db or dbconfig()
+
+
+def dbconfig(database=None, readonly=False):
+    """Connect to the primary; `readonly` goes to the replica when it is usable"""
+    if readonly:
+        db = replica(database)
+        if db is not None:
+            return db
+
+    try:
+        with span("db.connect"):
+            db = psycopg2.connect(**connectParams(database))
 
     except Exception as e:
-        console.print_exception(show_locals=True)
+        from rich.console import Console
+        Console().print_exception(show_locals=True)
 
     return db
+
+
+if __name__ == "__main__":
+    # Show where writes and reads go (python -m utils.dbconfig)
+    from rich import print as printc
+
+    def describe(params):
+        shown = {key: ("***" if key == "password" else value) for key, value in params.items()}
+        return " ".join(f"{key}={value}" for key, value in shown.items())
+
+    printc(f"[cyan][*][/cyan] Config file: {configPath()}{'' if os.path.exists(configPath()) else ' (absent)'}")
+    printc(f"[cyan][*][/cyan] Primary: {describe(connectParams())}")
+    params = replicaParams()
+    if params is None:
+        printc("[yellow][-][/yellow] No replica configured; reads go to the primary")
+    else:
+        printc(f"[cyan][*][/cyan] Replica: {describe(params)}")
+        try:
+            db = psycopg2.connect(**params)
+            lag = replicaLag(db)
+            db.close()
+        except psycopg2.Error as e:
+            printc(f"[red][!][/red] Replica unreachable, reads go to the primary: {str(e).strip()}")
+        else:
+            if lag > maxLag():
+                printc(f"[yellow][-][/yellow] Replica {lag:.1f}s behind (limit {maxLag():g}s); reads go to the primary")
+            else:
+                printc(f"[green][+][/green] Replica {lag:.1f}s behind (limit {maxLag():g}s); reads go to the replica")
@@ -1,4 +1,8 @@
-from utils.dbconfig import dbconfig
+from utils.dbconfig import dbconfig, reader
+from utils.trace import span
+import utils.metadata
+import utils.shards
+from utils.vault import Vault, EntryNotFound, computeMasterKey
 from rich import print as printc
 from rich.console import Console
 from rich.table import Table
@@ -6,19 +10,27 @@ from rich.table import Table
 console = Console()
 
 
-def listEntries():
+def listEntries(mp=None, ds=None, mk=None, db=None):
     """List all entries with their IDs"""
-    db = dbconfig()
+    # A caught-up replica takes the reads, else the caller's connection or a new one
+    read = reader(db)
+    own = read is not db
+    db = read
     cursor = db.cursor()
+    encrypted = utils.metadata.isEncrypted(cursor)
     query = "SELECT ctid, sitename, siteurl, email, username FROM entries"
-    cursor.execute(query)
-    results = cursor.fetchall()
-    db.close()
+    with span("db.query"):
+        results = utils.shards.select(db, query)
+    if own:
+        db.close()
     
     if len(results) == 0:
         printc("[yellow][-][/yellow] No entries found in the database")
         return []
     
+    if mk is None and encrypted and mp is not None:
+        mk = computeMasterKey(mp, ds)
+
     table = Table(title="All Entries")
     table.add_column("ID", style="cyan", width=8)
     table.add_column("Site Name", style="green", width=20)
@@ -27,44 +39,102 @@ def listEntries():
     table.add_column("Username", style="magenta", width=20)
     
     for idx, entry in enumerate(results, 1):
+        if encrypted and mk is None:
+            fields = ["{encrypted}"] * 4
+        else:
+            fields = utils.metadata.decodeRow(mk, entry[1:], encrypted)
         table.add_row(
             str(idx),
-            entry[1] or "",
-            entry[2] or "",
-            entry[3] or "",
-            entry[4] or ""
+            fields[0] or "",
+            fields[1] or "",
+            fields[2] or "",
+            fields[3] or ""
         )
     
-    console.print(table)
+    with span("render"):
+        console.print(table)
     return results
 
 
-def deleteEntry(sitename, siteurl, email, username):
-    """Delete a specific entry"""
-    db = dbconfig()
+def printEntries(entries):
+    """Print utils.records.Entry objects numbered from 1, for picking one to delete"""
+    if len(entries) == 0:
+        printc("[yellow][-][/yellow] No entries found in the database")
+        return
+    table = Table(title="All Entries")
+    table.add_column("ID", style="cyan", width=8)
+    table.add_column("Site Name", style="green", width=20)
+    table.add_column("URL", style="blue", width=30)
+    table.add_column("Email", style="yellow", width=25)
+    table.add_column("Username", style="magenta", width=20)
+    for idx, entry in enumerate(entries, 1):
+        table.add_row(str(idx), *[field or "" for field in entry.fields()])
+    with span("render"):
+        console.print(table)
+
+
+def deleteEntry(sitename, siteurl, email, username, mp=None, ds=None, raw=False, mk=None, db=None):
+    """Delete a specific entry
+
+    `raw` matches the stored column values as-is, which is what
+    deleteEntryById passes back from listEntries.
+    """
+    own = db is None
+    if own:
+        db = dbconfig()
     cursor = db.cursor()
-    
+
+    encrypted = not raw and utils.metadata.isEncrypted(cursor)
+    if encrypted and mk is None and mp is None:
+        printc("[red][!][/red] Master password required to delete from an encrypted vault")
+        if own:
+            db.close()
+        return False
+    if mk is None and encrypted:
+        mk = computeMasterKey(mp, ds)
+
+    if not raw:
+        try:
+            Vault(db, mk, encrypted=encrypted).delete(sitename, siteurl, email, username)
+        except EntryNotFound:
+            printc("[yellow][-][/yellow] Entry not found")
+            return False
+        finally:
+            if own:
+                db.close()
+        printc("[green][+][/green] Entry deleted successfully")
+        return True
+
+    # Raw values are stored ciphertext, which says nothing about the shard
+    search = {"sitename": sitename, "siteurl": siteurl, "email": email, "username": username}
+    conditions, params = utils.metadata.searchConditions(mk, search, False)
+    shards = utils.shards.active()
+
     # Check if entry exists
-    query = "SELECT * FROM entries WHERE sitename = %s AND siteurl = %s AND email = %s AND username = %s"
-    cursor.execute(query, (sitename, siteurl, email, username))
-    result = cursor.fetchone()
+    query = f"SELECT 1 FROM entries WHERE {conditions}"
+    result = utils.shards.select(db, query, params)
     
     if not result:
         printc("[yellow][-][/yellow] Entry not found")
-        db.close()
+        if own:
+            db.close()
         return False
     
     # Delete the entry
-    query = "DELETE FROM entries WHERE sitename = %s AND siteurl = %s AND email = %s AND username = %s"
-    cursor.execute(query, (sitename, siteurl, email, username))
-    db.commit()
-    db.close()
+    query = f"DELETE FROM entries WHERE {conditions}"
+    if shards is None:
+        cursor.execute(query, params)
+        db.commit()
+    else:
+        shards.execute(query, params)
+    if own:
+        db.close()
     
     printc("[green][+][/green] Entry deleted successfully")
     return True
 
 
-def deleteEntryById(entry_id, all_entries):
+def deleteEntryById(entry_id, all_entries, db=None):
     """Delete entry by ID from the list"""
     if entry_id < 1 or entry_id > len(all_entries):
         printc("[red][!][/red] Invalid ID")
@@ -76,4 +146,4 @@ def deleteEntryById(entry_id, all_entries):
     email = entry[3]
     username = entry[4]
     
-    return deleteEntry(sitename, siteurl, email, username)
+    return deleteEntry(sitename, siteurl, email, username, raw=True, db=db)
@@ -1,5 +1,6 @@
-import random
+import secrets
 import string
 
 def generatePassword(length):
-	return ''.join([random.choice(string.ascii_letters + string.digits + string.punctuation ) for n in range(length)])
+	# secrets, not random: these passwords go straight into the vault, rotate included
+	return ''.join([secrets.choice(string.ascii_letters + string.digits + string.punctuation ) for n in range(length)])
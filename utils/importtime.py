@@ -0,0 +1,82 @@
+import os
+import sys
+import argparse
+import subprocess
+
+from rich import print as printc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each startup path: the imports it performs, and modules it must never load
+PATHS = {
+    "pm.py (any command)": ("import pm", ["psycopg2", "Crypto", "pyperclip", "rich", "utils"]),
+    "pm.py g": ("import pm, pyperclip, utils.generate, utils.trace", ["psycopg2", "Crypto", "rich.console"]),
+}
+
+# Import budget in milliseconds for every path above
+DEFAULT_BUDGET_MS = 60
+
+# Runs per path; the fastest one is kept to filter out scheduler noise
+RUNS = 5
+
+
+def importTimes(code):
+    """Run `code` under `python -X importtime` and return {module: (self_us, cumulative_us, depth)}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return times
+
+
+def measure(code, baseline):
+    """Milliseconds spent importing what `code` adds on top of a bare interpreter"""
+    best = None
+    modules = {}
+    for _ in range(RUNS):
+        modules = importTimes(code)
+        total = sum(
+            cumulative for name, (_, cumulative, depth) in modules.items()
+            if depth == 0 and name not in baseline
+        )
+        best = total if best is None else min(best, total)
+    return best / 1000, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check pm.py startup import cost")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="Allowed import time per path")
+    args = parser.parse_args(argv)
+
+    baseline = importTimes("pass")
+    failed = False
+
+    for label, (code, forbidden) in PATHS.items():
+        ms, modules = measure(code, baseline)
+        loaded = [
+            bad for bad in forbidden
+            if any(name == bad or name.startswith(bad + ".") for name in modules)
+        ]
+
+        if loaded:
+            failed = True
+            printc(f"[red][!][/red] {label}: imports {', '.join(loaded)}")
+        if ms > args.budget_ms:
+            failed = True
+            printc(f"[red][!][/red] {label}: {ms:.1f} ms of imports (budget {args.budget_ms:.0f} ms)")
+        if not loaded and ms <= args.budget_ms:
+            printc(f"[green][+][/green] {label}: {ms:.1f} ms of imports (budget {args.budget_ms:.0f} ms)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+import utils.dbconfig
+import utils.metadata
+import utils.shards
+from utils.records import Entry
+from utils.searchindex import SearchIndex
+from utils.trace import span
+
+# Every committed insert, update or delete on `entries` sends the row's id
+# on this channel (a trigger, schema step 8), whichever client made it.
+CHANNEL = "pm_entries"
+
+# With more changes than this pending, one full reload beats fetching each
+RELOAD_THRESHOLD = 1000
+
+COLUMNS = "id, sitename, siteurl, email, username, password"
+
+
+class EntryCache:
+    """Every entry's row as stored, kept in memory and brought up to date
+    from Postgres notifications
+
+    Rows stay encrypted (metadata too, on an encrypted vault) until decode()
+    is called on the ones a view actually shows.
+
+    Each node the entries live on (the primary, or every shard) gets its
+    own LISTEN connection. refresh() reads the notifications that arrived
+    since the last call, without a round trip when there are none, and
+    re-fetches just the rows they name. Views call it before using the
+    cache, so they see every committed change without re-querying the
+    whole table or polling.
+    """
+
+    def __init__(self, mk):
+        self.mk = mk
+        self.entries = {}
+        # Bumped on every change, so views derived from the entries know to rebuild
+        self.version = 0
+        self.encrypted = False
+        self._index = None
+        self._indexVersion = None
+        self._connections = {}
+
+        shards = utils.shards.active()
+        self.params = {"primary": utils.dbconfig.connectParams()} if shards is None else dict(shards.params)
+        for node in self.params:
+            self._listen(node)
+
+    def _listen(self, node):
+        """(Re)connect to `node`, LISTEN, then load its entries; listening
+        first means nothing committed in between is missed"""
+        with span("db.connect"):
+            db = psycopg2.connect(**self.params[node])
+        # Notifications are delivered between transactions; autocommit never holds one open
+        db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = db.cursor()
+        cursor.execute(f"LISTEN {CHANNEL}")
+        self._connections[node] = db
+
+        self.encrypted = utils.metadata.isEncrypted(cursor)
+        self.entries = {key: entry for key, entry in self.entries.items() if key[0] != node}
+        with span("db.query"):
+            cursor.execute(f"SELECT {COLUMNS} FROM entries ORDER BY id")
+            for row in cursor:
+                self.entries[(node, row[0])] = row[1:]
+        self.version += 1
+
+    def _apply(self, node, ids):
+        db = self._connections[node]
+        cursor = db.cursor()
+        encrypted = utils.metadata.isEncrypted(cursor)
+        if len(ids) > RELOAD_THRESHOLD or encrypted != self.encrypted:
+            db.close()
+            self._listen(node)
+            return
+
+        with span("db.query"):
+            cursor.execute(f"SELECT {COLUMNS} FROM entries WHERE id = ANY(%s)", (list(ids),))
+            found = {row[0]: row[1:] for row in cursor.fetchall()}
+        for id in ids:
+            if id in found:
+                self.entries[(node, id)] = found[id]
+            else:
+                self.entries.pop((node, id), None)
+        self.version += 1
+
+    def refresh(self):
+        """Apply the changes committed since the last call; returns how many entries changed"""
+        changed = 0
+        for node, db in list(self._connections.items()):
+            try:
+                db.poll()
+            except psycopg2.OperationalError:
+                # Notifications sent while disconnected are lost; start over
+                db.close()
+                self._listen(node)
+                changed += 1
+                continue
+            if not db.notifies:
+                continue
+            ids = {int(notify.payload) for notify in db.notifies if notify.channel == CHANNEL}
+            db.notifies.clear()
+            self._apply(node, ids)
+            changed += len(ids)
+        return changed
+
+    def rows(self):
+        """Up-to-date rows, (sitename, siteurl, email, username, password) as stored"""
+        self.refresh()
+        return list(self.entries.values())
+
+    def decode(self, rows):
+        """[Entry] for `rows`; only these are decrypted"""
+        return [Entry.fromRow(self.mk, row, self.encrypted) for row in rows]
+
+    def searchIndex(self):
+        """Quick-search index over the entries, rebuilt only after a change;
+        searching needs every entry's metadata, so it decodes them all"""
+        self.refresh()
+        if self._indexVersion != self.version:
+            self._index = SearchIndex(self.decode(self.entries.values()))
+            self._indexVersion = self.version
+        return self._index
+
+    def close(self):
+        for db in self._connections.values():
+            db.close()
+        self._connections = {}
@@ -0,0 +1,282 @@
+import os
+import time
+import random
+import threading
+import contextlib
+import multiprocessing
+
+import utils.bench
+
+# Throwaway database the load runs against; adds and deletes never touch 'pm'
+DATABASE = "pm_loadtest"
+
+DEFAULT_MIX = "add=20,extract=60,list=5,delete=15"
+
+# How often the monitor samples pg_stat_activity for lock waits, in seconds
+MONITOR_INTERVAL = 0.1
+
+
+class LoadtestError(Exception):
+    pass
+
+
+def parseMix(spec):
+    """'add=20,extract=60,...' -> [(op, weight)]"""
+    mix = []
+    for item in spec.split(","):
+        op, sep, weight = item.strip().partition("=")
+        if not sep or op not in OPS:
+            raise LoadtestError(f"Invalid mix item {item!r}; expected op=weight with op in {', '.join(OPS)}")
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise LoadtestError(f"Invalid weight in {item!r}")
+        if weight > 0:
+            mix.append((op, weight))
+    if not mix:
+        raise LoadtestError("The mix has no operation with a positive weight")
+    return mix
+
+
+# Each operation drives the same code path the CLI does, minus prompts and
+# key derivation, and returns an outcome: "ok", or "skipped"/"missing" when
+# the vault state made it a no-op. Names come from a small key space so
+# concurrent clients really collide on the same entries.
+
+def opAdd(ctx, rng):
+    from utils.dbconfig import dbconfig
+    from utils.vault import Vault, DuplicateEntry
+
+    values = utils.bench.entryValues(rng.randrange(ctx["keyspace"]))
+    # The CLI's add: check and insert under the entry's advisory lock
+    db = dbconfig()
+    try:
+        Vault(db, ctx["mk"], encrypted=False).add(values["sitename"], values["siteurl"], values["email"],
+                                                  values["username"], "loadtest password")
+    except DuplicateEntry:
+        return "skipped"
+    finally:
+        db.close()
+    return "ok"
+
+
+def opExtract(ctx, rng):
+    import utils.retrieve
+
+    sitename = utils.bench.entryValues(rng.randrange(ctx["keyspace"]))["sitename"]
+    utils.retrieve.retrieveEntries(utils.bench.MASTER_PASSWORD, utils.bench.DEVICE_SECRET, {"sitename": sitename})
+    return "ok"
+
+
+def opList(ctx, rng):
+    import utils.delete
+
+    utils.delete.listEntries()
+    return "ok"
+
+
+def opDelete(ctx, rng):
+    import utils.delete
+
+    values = utils.bench.entryValues(rng.randrange(ctx["keyspace"]))
+    if utils.delete.deleteEntry(values["sitename"], values["siteurl"], values["email"], values["username"], raw=True):
+        return "ok"
+    return "missing"
+
+
+OPS = {
+    "add": opAdd,
+    "extract": opExtract,
+    "list": opList,
+    "delete": opDelete,
+}
+
+
+def worker(args):
+    """Run the mix until the deadline; returns {op: {"latencies", "outcomes", "errors"}}"""
+    index, mix, ctx, deadline = args
+    rng = random.Random(index)
+    ops = [op for op, _ in mix]
+    weights = [weight for _, weight in mix]
+    results = {op: {"latencies": [], "outcomes": {}, "errors": {}} for op in ops}
+
+    while time.time() < deadline:
+        op = rng.choices(ops, weights)[0]
+        result = results[op]
+        started = time.perf_counter()
+        try:
+            outcome = OPS[op](ctx, rng)
+            result["outcomes"][outcome] = result["outcomes"].get(outcome, 0) + 1
+        except Exception as e:
+            # dbconfig reports a failed connect and returns nothing, which
+            # surfaces here as UnboundLocalError
+            message = f"{type(e).__name__}: {str(e).strip().splitlines()[0] if str(e).strip() else ''}"
+            result["errors"][message] = result["errors"].get(message, 0) + 1
+        result["latencies"].append(time.perf_counter() - started)
+    return results
+
+
+def _processWorker(args):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        return worker(args)
+
+
+def _threadWorker(args, parts):
+    parts[args[0]] = worker(args)
+
+
+class Monitor(threading.Thread):
+    """Samples sessions waiting on locks and open connections while the load runs"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.lock_waits = 0
+        self.max_lock_waits = 0
+        self.max_connections = 0
+
+    def run(self):
+        from utils.dbconfig import dbconfig
+
+        db = dbconfig()
+        db.autocommit = True
+        cursor = db.cursor()
+        while not self.stopping.wait(MONITOR_INTERVAL):
+            cursor.execute("""
+                SELECT count(*), count(*) FILTER (WHERE wait_event_type = 'Lock')
+                FROM pg_stat_activity WHERE datname = current_database()
+            """)
+            connections, waiting = cursor.fetchone()
+            self.samples += 1
+            self.lock_waits += waiting
+            self.max_lock_waits = max(self.max_lock_waits, waiting)
+            self.max_connections = max(self.max_connections, connections)
+        db.close()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def merge(parts):
+    merged = {}
+    for part in parts:
+        for op, result in part.items():
+            into = merged.setdefault(op, {"latencies": [], "outcomes": {}, "errors": {}})
+            into["latencies"].extend(result["latencies"])
+            for key in ("outcomes", "errors"):
+                for name, count in result[key].items():
+                    into[key][name] = into[key].get(name, 0) + count
+    return merged
+
+
+def duplicates(db):
+    """Entries stored more than once: adds that raced past the duplicate check"""
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT COALESCE(SUM(n - 1), 0) FROM (
+            SELECT COUNT(*) AS n FROM entries
+            GROUP BY sitename, siteurl, email, username HAVING COUNT(*) > 1
+        ) dup
+    """)
+    return int(cursor.fetchone()[0])
+
+
+def run(workers=8, mode="thread", duration=10.0, mix=None, entries=10000, keyspace=None):
+    """Seed a throwaway vault, run `workers` clients for `duration` seconds and report"""
+    import utils.add
+    from utils.dbconfig import dbconfig
+
+    mix = parseMix(mix or DEFAULT_MIX)
+    keyspace = keyspace or entries
+    os.environ["PM_DATABASE"] = DATABASE
+    utils.bench.createDatabase(DATABASE)
+
+    mk = utils.add.computeMasterKey(utils.bench.MASTER_PASSWORD, utils.bench.DEVICE_SECRET)
+    db = dbconfig()
+    utils.bench.resetVault(db, False)
+    utils.bench.seed(db, mk, False, 0, entries)
+    db.close()
+
+    ctx = {"mk": mk, "keyspace": keyspace}
+    deadline = time.time() + duration
+    jobs = [(i, mix, ctx, deadline) for i in range(workers)]
+
+    monitor = Monitor()
+    monitor.start()
+    started = time.perf_counter()
+    if mode == "process":
+        with multiprocessing.Pool(workers) as pool:
+            parts = pool.map(_processWorker, jobs)
+    else:
+        # Output redirection is process-wide, so it wraps all the threads
+        parts = [None] * workers
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            threads = [threading.Thread(target=_threadWorker, args=(job, parts)) for job in jobs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    elapsed = time.perf_counter() - started
+    monitor.stop()
+
+    db = dbconfig()
+    duplicate_rows = duplicates(db)
+    db.close()
+
+    operations = {}
+    for op, result in merge(parts).items():
+        summary = utils.bench.summarize(result["latencies"]) if result["latencies"] else {"runs": 0}
+        summary["throughput"] = len(result["latencies"]) / elapsed
+        summary["max_ms"] = max(result["latencies"]) * 1000 if result["latencies"] else None
+        summary["outcomes"] = result["outcomes"]
+        summary["errors"] = result["errors"]
+        operations[op] = summary
+
+    return {
+        "config": {"workers": workers, "mode": mode, "duration": duration, "mix": dict(mix), "entries": entries, "keyspace": keyspace},
+        "elapsed": elapsed,
+        "operations": operations,
+        "duplicates": duplicate_rows,
+        "lock_waits": {
+            "samples": monitor.samples,
+            "mean_waiting": monitor.lock_waits / monitor.samples if monitor.samples else 0,
+            "max_waiting": monitor.max_lock_waits,
+        },
+        "max_connections": monitor.max_connections,
+    }
+
+
+def printReport(report):
+    from rich import print as printc
+    from rich.console import Console
+    from rich.table import Table
+
+    table = Table(title=f"{report['config']['workers']} {report['config']['mode']} workers, {report['elapsed']:.1f}s")
+    for column in ["Operation", "Count", "ops/s", "p50", "p95", "p99", "max", "Errors", "Outcomes"]:
+        table.add_column(column, justify="left" if column in ("Operation", "Outcomes") else "right")
+
+    total = errors = 0
+    for op, s in sorted(report["operations"].items()):
+        op_errors = sum(s["errors"].values())
+        total += s["runs"]
+        errors += op_errors
+        if s["runs"] == 0:
+            continue
+        table.add_row(
+            op, str(s["runs"]), f"{s['throughput']:.1f}",
+            f"{s['p50_ms']:.1f} ms", f"{s['p95_ms']:.1f} ms", f"{s['p99_ms']:.1f} ms", f"{s['max_ms']:.1f} ms",
+            str(op_errors), ", ".join(f"{k} {v}" for k, v in sorted(s["outcomes"].items()))
+        )
+    Console().print(table)
+
+    printc(f"[cyan][*][/cyan] {total / report['elapsed']:.1f} ops/s overall, {errors} errors")
+    for op, s in sorted(report["operations"].items()):
+        for message, count in sorted(s["errors"].items(), key=lambda item: -item[1]):
+            printc(f"    [red]{op}[/red] x{count}: {message}")
+    colour = "red" if report["duplicates"] else "green"
+    printc(f"[{colour}][{'!' if report['duplicates'] else '+'}][/{colour}] Duplicate entries from racing adds: {report['duplicates']}")
+    waits = report["lock_waits"]
+    printc(f"[cyan][*][/cyan] Sessions waiting on locks: mean {waits['mean_waiting']:.2f}, max {waits['max_waiting']} "
+           f"({waits['samples']} samples); peak connections {report['max_connections']}")
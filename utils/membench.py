@@ -0,0 +1,75 @@
+import os
+import sys
+import base64
+import argparse
+import tracemalloc
+
+from rich import print as printc
+from rich.console import Console
+from rich.table import Table
+
+import utils.bench
+from utils.records import Entry
+from utils.searchindex import SearchIndex
+from utils.secretbuf import SecretBuffer
+
+# Memory footprint of listed entries, per entry, for the ways rows are held
+# in memory (python -m utils.membench). Runs offline: rows are built the way
+# the database driver hands them over, without a database.
+
+DEFAULT_ENTRIES = 100000
+
+
+def rows(count):
+    """(sitename, siteurl, email, username, password) tuples as fetchall() returns them"""
+    for i in range(count):
+        values = utils.bench.entryValues(i)
+        # An encrypted password as stored: base64 of IV + one AES block
+        cipher = base64.b64encode(os.urandom(32)).decode()
+        yield (values["sitename"], values["siteurl"], values["email"], values["username"], cipher)
+
+
+def measure(build):
+    """Bytes still allocated once `build()` returns, with its result kept alive"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def layouts(count):
+    fields = ["sitename", "siteurl", "email", "username", "password"]
+    return {
+        "tuples (fetchall)": lambda: list(rows(count)),
+        "dicts (batch/export)": lambda: [dict(zip(fields, row)) for row in rows(count)],
+        "Entry records": lambda: [Entry(*row) for row in rows(count)],
+        "Entry records + SearchIndex": lambda: SearchIndex([Entry(*row) for row in rows(count)]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-entry memory footprint of listed entries")
+    parser.add_argument("--entries", type=int, default=DEFAULT_ENTRIES, help="Entries to list")
+    args = parser.parse_args(argv)
+
+    table = Table(title=f"{args.entries} listed entries")
+    table.add_column("Held as")
+    table.add_column("Total", justify="right")
+    table.add_column("Per entry", justify="right")
+    for name, build in layouts(args.entries).items():
+        size = measure(build)
+        table.add_row(name, f"{size / 2 ** 20:.1f} MiB", f"{size / args.entries:.0f} B")
+    Console().print(table)
+
+    # A decrypted password, only while it is in use
+    secret = SecretBuffer(16)
+    printc(f"[cyan][*][/cyan] A decrypted password in a SecretBuffer: {sys.getsizeof(secret) + sys.getsizeof(secret._store)} B, "
+           f"{'mlock()ed' if secret.locked() else 'not locked (set PM_MLOCK=1)'}, zeroed on wipe()")
+    secret.wipe()
+
+
+if __name__ == "__main__":
+    main()
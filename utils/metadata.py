@@ -0,0 +1,295 @@
+import hmac
+import functools
+import hashlib
+
+import utils.aesutil
+from utils.dbconfig import dbconfig
+from utils.urls import normalizeUrl
+from utils.schema import readSecrets
+
+from rich import print as printc
+
+FIELDS = ["sitename", "siteurl", "email", "username"]
+
+# Searchable columns that hold only a blind index (no ciphertext) when encrypted
+INDEX_ONLY = ["url_domain"]
+
+# Columns that group entries: a text[] of tags and a folder. Encrypted vaults
+# store only their blind indexes, and the encrypted names in `labels`.
+LABELS = ["tags", "folder"]
+
+# Rows fetched per round trip when rewriting an existing vault
+BATCH_SIZE = 500
+
+
+def isEncrypted(cursor):
+    """Whether this vault stores entry metadata encrypted"""
+    return bool(readSecrets(cursor).get("encrypt_metadata", False))
+
+
+@functools.lru_cache(maxsize=4)
+def blindIndexKeys(mk):
+    """Derive one HMAC key per field so equal values in different columns
+    never produce the same index value
+
+    Cached per master key, since every search and write of an encrypted
+    vault needs them. Callers must not modify the returned dict.
+    """
+    return {
+        field: hmac.new(mk, b"pm-blind-index:" + field.encode(), hashlib.sha256).digest()
+        for field in FIELDS + INDEX_ONLY + LABELS
+    }
+
+
+def blindIndex(keys, field, value):
+    return hmac.new(keys[field], value.encode(), hashlib.sha256).hexdigest()
+
+
+def urlColumns(siteurl, keys=None):
+    """Normalized URL columns for `siteurl`
+
+    Encrypted vaults only keep a blind index of the registrable domain, so
+    `--domain` lookups still work without exposing the host or path.
+    """
+    url = normalizeUrl(siteurl)
+    if keys is None:
+        return {
+            "url_scheme": url["scheme"],
+            "url_host": url["host"],
+            "url_domain": url["domain"],
+            "url_path": url["path"],
+        }
+    return {
+        "url_scheme": None,
+        "url_host": None,
+        "url_domain": blindIndex(keys, "url_domain", url["domain"]),
+        "url_path": None,
+    }
+
+
+def normalizeTags(tags):
+    """Tags lowercased, trimmed, de-duplicated and sorted; "a,b" counts as two"""
+    found = set()
+    for tag in tags or []:
+        for part in tag.split(","):
+            part = part.strip().lower()
+            if part:
+                found.add(part)
+    return sorted(found)
+
+
+def encodeFields(mk, values, encrypted):
+    """Map plaintext field values to the columns stored in `entries`
+
+    With metadata encryption on, each field is AES-encrypted and gets a
+    deterministic blind index alongside it; otherwise values pass through.
+    The site URL is also split into its normalized parts.
+    """
+    columns = dict(values)
+    if "tags" in values:
+        columns["tags"] = normalizeTags(values["tags"])
+    if "folder" in values:
+        columns["folder"] = values["folder"] or None
+    if not encrypted:
+        if "siteurl" in values:
+            columns.update(urlColumns(values["siteurl"]))
+        return columns
+
+    keys = blindIndexKeys(mk)
+    if "tags" in columns:
+        columns["tags"] = [blindIndex(keys, "tags", tag) for tag in columns["tags"]]
+    if columns.get("folder") is not None:
+        columns["folder"] = blindIndex(keys, "folder", columns["folder"])
+    for field in FIELDS:
+        if field in values:
+            columns[field] = utils.aesutil.encrypt(key=mk, source=values[field], keyType="bytes")
+            columns[f"{field}_bidx"] = blindIndex(keys, field, values[field])
+    if "siteurl" in values:
+        columns.update(urlColumns(values["siteurl"], keys))
+    return columns
+
+
+def searchConditions(mk, search, encrypted):
+    """Build the WHERE clause and parameters for an equality search
+
+    Encrypted vaults match on the indexed blind-index columns, so a lookup is
+    still one indexed query instead of decrypting every row. "tags" matches
+    entries with all of the given tags, "any_tags" those with at least one;
+    both are answered by the GIN index on entries.tags.
+    """
+    keys = blindIndexKeys(mk) if encrypted else None
+    conditions = []
+    params = []
+    for col, value in search.items():
+        if col in ["tags", "any_tags"]:
+            tags = normalizeTags(value)
+            conditions.append("tags @> %s::text[]" if col == "tags" else "tags && %s::text[]")
+            params.append([blindIndex(keys, "tags", tag) for tag in tags] if encrypted else tags)
+        elif not encrypted:
+            conditions.append(f"{col} = %s")
+            params.append(value)
+        else:
+            conditions.append(f"{col} = %s" if col in INDEX_ONLY or col == "folder" else f"{col}_bidx = %s")
+            params.append(blindIndex(keys, col, value))
+    return " AND ".join(conditions), params
+
+
+def rememberLabels(cursor, mk, values, encrypted):
+    """Store the encrypted names of the tags and folder in `values`, so an
+    encrypted vault, whose entries hold only their blind indexes, can still
+    list them"""
+    if not encrypted:
+        return
+    keys = blindIndexKeys(mk)
+    labels = [("tags", tag) for tag in normalizeTags(values.get("tags"))]
+    if values.get("folder"):
+        labels.append(("folder", values["folder"]))
+    if not labels:
+        return
+    cursor.executemany(
+        "INSERT INTO labels (value, name) VALUES (%s, %s) ON CONFLICT (value) DO NOTHING",
+        [(blindIndex(keys, field, name), utils.aesutil.encrypt(key=mk, source=name, keyType="bytes")) for field, name in labels]
+    )
+
+
+def labelNames(mk, rows):
+    """{stored value: name} from (value, name) rows of `labels`"""
+    return {value: decryptField(mk, name) for value, name in rows}
+
+
+def decodeLabels(tags, folder, encrypted, names=None):
+    """(tags, folder) as plaintext; encrypted vaults look them up in labelNames()"""
+    tags = tags or []
+    if not encrypted:
+        return tags, folder
+    names = names or {}
+    return sorted(names.get(tag, "?") for tag in tags), (names.get(folder, "?") if folder else None)
+
+
+def decryptField(mk, value):
+    if value is None:
+        return None
+    return utils.aesutil.decrypt(key=mk, source=value, keyType="bytes").decode()
+
+
+def decodeRow(mk, row, encrypted):
+    """Return the (sitename, siteurl, email, username) part of a row as plaintext"""
+    fields = tuple(row[:4])
+    if not encrypted:
+        return fields
+    return tuple(decryptField(mk, value) for value in fields)
+
+
+def enableMetadataEncryption(mk, db=None):
+    """Encrypt the metadata of every existing entry and switch the vault over
+
+    Runs on `db`, or on a new connection it closes afterwards.
+    """
+    own = db is None
+    if own:
+        db = dbconfig()
+    cursor = db.cursor()
+
+    if isEncrypted(cursor):
+        printc("[yellow][-][/yellow] Metadata encryption is already enabled")
+        db.rollback()
+        if own:
+            db.close()
+        return False
+
+    # Stream the plaintext rows with a server-side cursor and rewrite them in
+    # batches; everything happens in one transaction so a failure leaves the
+    # vault untouched.
+    reader = db.cursor(name="pm_encrypt_metadata")
+    reader.itersize = BATCH_SIZE
+    reader.execute("SELECT ctid, sitename, siteurl, email, username, tags, folder FROM entries")
+
+    query = """
+        UPDATE entries SET sitename = %s, siteurl = %s, email = %s, username = %s,
+            sitename_bidx = %s, siteurl_bidx = %s, email_bidx = %s, username_bidx = %s,
+            url_scheme = %s, url_host = %s, url_domain = %s, url_path = %s,
+            tags = %s, folder = %s
+        WHERE ctid = %s
+    """
+    count = 0
+    while True:
+        rows = reader.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        batch = []
+        for row in rows:
+            values = dict(zip(FIELDS, [value or "" for value in row[1:5]]))
+            values.update(tags=row[5], folder=row[6])
+            columns = encodeFields(mk, values, True)
+            rememberLabels(cursor, mk, values, True)
+            batch.append(
+                tuple(columns[field] for field in FIELDS)
+                + tuple(columns[f"{field}_bidx"] for field in FIELDS)
+                + (columns["url_scheme"], columns["url_host"], columns["url_domain"], columns["url_path"])
+                + (columns["tags"], columns["folder"])
+                + (row[0],)
+            )
+        cursor.executemany(query, batch)
+        count += len(batch)
+    reader.close()
+
+    # Attachment names are metadata too
+    cursor.execute("SELECT id, name FROM attachments")
+    for attachmentId, name in cursor.fetchall():
+        cursor.execute(
+            "UPDATE attachments SET name = %s WHERE id = %s",
+            (utils.aesutil.encrypt(key=mk, source=name, keyType="bytes"), attachmentId)
+        )
+
+    cursor.execute("UPDATE secrets SET encrypt_metadata = TRUE")
+    db.commit()
+    if own:
+        db.close()
+
+    printc(f"[green][+][/green] Encrypted metadata of {count} entries")
+    return True
+
+
+def backfillUrlColumns(mk=None, db=None):
+    """Fill the normalized URL columns of entries added before they existed
+
+    Works through BATCH_SIZE rows at a time and commits after each batch, so
+    it can be interrupted and resumed on a large vault. Runs on `db`, or on
+    a new connection it closes afterwards.
+    """
+    own = db is None
+    if own:
+        db = dbconfig()
+    cursor = db.cursor()
+    encrypted = isEncrypted(cursor)
+    if encrypted and mk is None:
+        db.rollback()
+        if own:
+            db.close()
+        raise ValueError("The master key is required to backfill an encrypted vault")
+    keys = blindIndexKeys(mk) if encrypted else None
+
+    query = """
+        UPDATE entries SET url_scheme = %s, url_host = %s, url_domain = %s, url_path = %s
+        WHERE ctid = %s
+    """
+    count = 0
+    while True:
+        cursor.execute("SELECT ctid, siteurl FROM entries WHERE url_domain IS NULL LIMIT %s", (BATCH_SIZE,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        batch = []
+        for ctid, siteurl in rows:
+            if encrypted:
+                siteurl = decryptField(mk, siteurl)
+            columns = urlColumns(siteurl, keys)
+            batch.append((columns["url_scheme"], columns["url_host"], columns["url_domain"], columns["url_path"], ctid))
+        cursor.executemany(query, batch)
+        db.commit()
+        count += len(batch)
+
+    db.commit()
+    if own:
+        db.close()
+    return count
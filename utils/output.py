@@ -0,0 +1,36 @@
+import csv
+import json
+
+FORMATS = ["table", "json", "ndjson", "csv"]
+
+
+def streamRows(rows, fmt, out, columns):
+    """Write dict rows to `out` as they arrive, without holding the result set
+
+    `fmt` is one of json, ndjson or csv; table output is rendered by the
+    callers with rich instead.
+    """
+    if fmt == "ndjson":
+        for row in rows:
+            out.write(json.dumps(row) + "\n")
+
+    elif fmt == "json":
+        # One array, written element by element
+        out.write("[")
+        separator = "\n"
+        for row in rows:
+            out.write(separator + json.dumps(row))
+            separator = ",\n"
+        out.write("\n]\n" if separator != "\n" else "]\n")
+
+    elif fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            # Lists (tags) become one comma-separated cell
+            writer.writerow({k: ",".join(v) if isinstance(v, list) else v for k, v in row.items()})
+
+    else:
+        raise ValueError(f"Unknown output format: {fmt}")
+
+    out.flush()
@@ -0,0 +1,72 @@
+import os
+import sys
+import ipaddress
+
+# Compiled from https://publicsuffix.org/list/public_suffix_list.dat (MPL-2.0).
+# Regenerate with: python -m utils.publicsuffix /path/to/public_suffix_list.dat
+from utils.public_suffix_data import RULES, WILDCARDS, EXCEPTIONS
+
+
+def registrableDomain(host):
+    """Return the registrable domain of `host` ("eTLD+1"), e.g.
+    login.github.com -> github.com, foo.bar.co.uk -> bar.co.uk
+
+    IP addresses, single-label hosts and hosts that are themselves a public
+    suffix are returned unchanged.
+    """
+    host = host.lower().rstrip(".")
+    if not host:
+        return host
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+
+    labels = host.split(".")
+    # Walk from the longest candidate down so the first hit is the longest
+    # matching rule; the implicit "*" rule makes the last label a suffix
+    suffix_len = 1
+    for i in range(len(labels)):
+        candidate = ".".join(labels[i:])
+        if candidate in EXCEPTIONS:
+            suffix_len = len(labels) - i - 1
+            break
+        if candidate in RULES or ".".join(labels[i + 1:]) in WILDCARDS:
+            suffix_len = len(labels) - i
+            break
+
+    if suffix_len >= len(labels):
+        return host
+    return ".".join(labels[-(suffix_len + 1):])
+
+
+def compileList(source):
+    """Turn the text of public_suffix_list.dat into the data module source"""
+    rules, wildcards, exceptions = set(), set(), set()
+    for line in source.splitlines():
+        rule = line.strip().split(" ")[0]
+        if not rule or rule.startswith("//"):
+            continue
+        kind, rule = ("!", rule[1:]) if rule.startswith("!") else ("*", rule[2:]) if rule.startswith("*.") else ("", rule)
+        # Hosts are compared in their ASCII (punycode) form
+        rule = rule.encode("idna").decode() if not rule.isascii() else rule.lower()
+        {"!": exceptions, "*": wildcards, "": rules}[kind].add(rule)
+
+    def literal(name, values):
+        return f'{name} = frozenset("""\n' + "\n".join(sorted(values)) + '\n""".split())\n'
+
+    return (
+        "# Generated by utils/publicsuffix.py from the Public Suffix List\n"
+        "# (https://publicsuffix.org/, MPL-2.0). Do not edit by hand.\n\n"
+        + literal("RULES", rules) + "\n"
+        + literal("WILDCARDS", wildcards) + "\n"
+        + literal("EXCEPTIONS", exceptions)
+    )
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as f:
+        data = compileList(f.read())
+    with open(os.path.join(os.path.dirname(__file__), "public_suffix_data.py"), "w", encoding="utf-8") as f:
+        f.write(data)
@@ -0,0 +1,37 @@
+import utils.aesutil
+import utils.metadata
+
+
+class Entry:
+    """One entry's metadata, with its password still encrypted
+
+    __slots__ keeps a record as small as the row tuple it replaces, with
+    fields read by name. The password is only decrypted by password(),
+    into a buffer the caller wipes.
+    """
+
+    __slots__ = ("sitename", "siteurl", "email", "username", "cipher", "tags", "folder")
+
+    def __init__(self, sitename, siteurl, email, username, cipher=None, tags=(), folder=None):
+        self.sitename = sitename
+        self.siteurl = siteurl
+        self.email = email
+        self.username = username
+        self.cipher = cipher
+        self.tags = tags
+        self.folder = folder
+
+    @classmethod
+    def fromRow(cls, mk, row, encrypted):
+        """From a (sitename, siteurl, email, username[, password]) row as stored"""
+        return cls(*utils.metadata.decodeRow(mk, row, encrypted), row[4] if len(row) > 4 else None)
+
+    def __repr__(self):
+        return f"Entry({self.sitename!r}, {self.siteurl!r}, {self.email!r}, {self.username!r})"
+
+    def fields(self):
+        return (self.sitename, self.siteurl, self.email, self.username)
+
+    def password(self, mk):
+        """The decrypted password as a SecretBuffer; use it in a with-block"""
+        return utils.aesutil.decryptSecret(key=mk, source=self.cipher, keyType="bytes")
@@ -1,36 +1,42 @@
-from utils.dbconfig import dbconfig
-import utils.aesutil
-import pyperclip
+import sys
 
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Hash import SHA512
-from Crypto.Random import get_random_bytes
-import base64
+from utils.dbconfig import reader
+from utils.trace import span
+from utils.vault import Vault, computeMasterKey
+import utils.metadata
+import utils.output
+import pyperclip
 
 from rich import print as printc
 from rich.console import Console
 from rich.table import Table
 
-def computeMasterKey(mp, ds):
-    password = mp.encode()
-    salt = ds.encode()
-    key = PBKDF2(password, salt, 32, count=1000000, hmac_hash_module=SHA512)
-    return key
 
-def retrieveEntries(mp, ds, search, decryptPassword=False):
-    db = dbconfig()
-    cursor = db.cursor()
+def openVault(mp, ds, db, mk, needKey=False):
+    """Vault on a caught-up replica, else the caller's connection or a new one
+
+    The key is only derived when the vault's metadata is encrypted or
+    `needKey` is set. Returns (vault, whether to close its connection).
+    """
+    read = reader(db)
+    encrypted = utils.metadata.isEncrypted(read.cursor())
+    if mk is None and (encrypted or needKey):
+        mk = computeMasterKey(mp, ds)
+    return Vault(read, mk, encrypted=encrypted), read is not db
 
-    if len(search) == 0:
-        query = "SELECT * FROM entries"
-        cursor.execute(query)
-    else:
-        conditions = " AND ".join([f"{col} = %s" for col in search.keys()])
-        query = f"SELECT * FROM entries WHERE {conditions}"
-        cursor.execute(query, list(search.values()))
 
-    results = cursor.fetchall()
-    db.close()
+def retrieveEntries(mp, ds, search, decryptPassword=False, mk=None, db=None):
+    vault, own = openVault(mp, ds, db, mk, needKey=decryptPassword)
+    try:
+        showEntries(vault, search, decryptPassword)
+    finally:
+        if own:
+            vault.db.close()
+
+
+def showEntries(vault, search, decryptPassword=False):
+    """Print the entries matching `search`, or copy the password of the only one"""
+    results = vault.search(search)
 
     if len(results) == 0:
         printc("[yellow][-][/yellow] No results for the search")
@@ -44,20 +50,92 @@ def retrieveEntries(mp, ds, search, decryptPassword=False):
         table.add_column("URL")
         table.add_column("Email")
         table.add_column("Username")
+        table.add_column("Folder")
+        table.add_column("Tags")
         table.add_column("Password")
 
-        for i in results:
-            table.add_row(i[0], i[1], i[2], i[3], "{hidden}")
-        console = Console()
-        console.print(table)
+        with span("render"):
+            for entry in results:
+                table.add_row(*entry.fields(), entry.folder or "", ", ".join(entry.tags), "{hidden}")
+            console = Console()
+            console.print(table)
         return
 
     if decryptPassword and len(results) == 1:
-        # Compute master key
-        mk = computeMasterKey(mp, ds)
-
         # Decrypt password
-        decrypted = utils.aesutil.decrypt(key=mk, source=results[0][4], keyType="bytes")
+        decrypted = vault.password(results[0])
 
         printc("[green][+][/green] Password copied to clipboard")
-        pyperclip.copy(decrypted.decode())
+        with span("clipboard"), decrypted:
+            pyperclip.copy(decrypted.decode())
+
+
+# Rows pulled from the server-side cursor per round trip when exporting
+EXPORT_BATCH = 1000
+
+
+def exportEntries(mp, ds, search, fmt, includePasswords=False, out=None, mk=None, db=None):
+    """Stream matching entries as json, ndjson or csv
+
+    Rows come from a server-side cursor and are written one by one, so no
+    rich renderable is built and memory stays flat for large vaults.
+    Passwords are only decrypted when `includePasswords` is set.
+    """
+    vault, own = openVault(mp, ds, db, mk, needKey=includePasswords)
+    try:
+        writeEntries(vault, search, fmt, includePasswords, out)
+    finally:
+        if own:
+            vault.db.close()
+
+
+def writeEntries(vault, search, fmt, includePasswords=False, out=None):
+    """exportEntries for an open vault"""
+    out = out or sys.stdout
+    entries = vault.iterEntries(search, batch=EXPORT_BATCH)
+
+    columns = list(utils.metadata.FIELDS) + ["folder", "tags"]
+    if includePasswords:
+        columns.append("password")
+
+    def rows():
+        for entry in entries:
+            row = dict(zip(utils.metadata.FIELDS, entry.fields()))
+            row["folder"], row["tags"] = entry.folder, list(entry.tags)
+            if includePasswords:
+                with vault.password(entry) as password:
+                    row["password"] = password.decode()
+            yield row
+
+    try:
+        with span("export"):
+            utils.output.streamRows(rows(), fmt, out, columns)
+    finally:
+        entries.close()
+
+
+def listTags(mp, ds, mk=None, db=None):
+    """Print every tag and folder with its number of entries"""
+    vault, own = openVault(mp, ds, db, mk)
+    try:
+        showTags(vault)
+    finally:
+        if own:
+            vault.db.close()
+
+
+def showTags(vault):
+    tags, folders = vault.tagCounts()
+    if not tags and not folders:
+        printc("[yellow][-][/yellow] No tags or folders yet")
+        return
+    console = Console()
+    for title, counts in [("Tags", tags), ("Folders", folders)]:
+        if not counts:
+            continue
+        table = Table(title=title)
+        table.add_column("Name")
+        table.add_column("Entries", justify="right")
+        for name, count in counts:
+            table.add_row(name, str(count))
+        console.print(table)
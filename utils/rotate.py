@@ -0,0 +1,97 @@
+import re
+from datetime import timedelta
+
+import utils.aesutil
+import utils.generate
+import utils.metadata
+from utils.trace import span
+
+# Entries locked, given new passwords and written per round trip
+ROTATE_BATCH = 500
+
+# Length of the generated passwords unless --length says otherwise
+ROTATE_LENGTH = 24
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parseAge(text):
+    """timedelta from an age such as 90d, 12h or 2w"""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdw])\s*", text or "")
+    if not match:
+        raise ValueError(f"Invalid age: {text!r} (expected e.g. 90d, 12h or 2w)")
+    return timedelta(seconds=int(match.group(1)) * UNITS[match.group(2)])
+
+
+def rotateStale(db, mk, encrypted, olderThan, search=None, length=ROTATE_LENGTH, batchSize=ROTATE_BATCH):
+    """Give every entry whose password is older than `olderThan` a new generated one
+
+    Stale entries are found by a range scan of the updated_at index,
+    `batchSize` at a time, and locked; entries another client has locked
+    are skipped until the next run. Each batch gets its new passwords
+    encrypted together and written by one UPDATE. All batches share one
+    transaction, committed at the end, so a failure leaves every password
+    as it was. A rotated entry's updated_at moves to now, taking it out of
+    the range, so each batch query picks up where the last one stopped.
+
+    Returns [{uuid, sitename, siteurl, email, username, version, password}]
+    for the rotated entries, with the new plaintext passwords.
+    """
+    import psycopg2.extras
+
+    where = "updated_at < now() - %s"
+    params = [olderThan]
+    if search:
+        conditions, searchParams = utils.metadata.searchConditions(mk, search, encrypted)
+        where += f" AND {conditions}"
+        params += searchParams
+
+    cursor = db.cursor()
+    rotated = []
+    try:
+        while True:
+            with span("db.query"):
+                cursor.execute(
+                    f"""
+                    SELECT id, uuid, sitename, siteurl, email, username FROM entries
+                    WHERE {where} ORDER BY updated_at, id LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    params + [batchSize]
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            batch = []
+            found = {}
+            with span("rotate.encrypt"):
+                for row in rows:
+                    password = utils.generate.generatePassword(length)
+                    batch.append((row[0], utils.aesutil.encrypt(key=mk, source=password, keyType="bytes")))
+                    entry = dict(zip(utils.metadata.FIELDS, utils.metadata.decodeRow(mk, row[2:], encrypted)))
+                    entry.update(uuid=str(row[1]), password=password)
+                    found[row[0]] = entry
+
+            with span("db.query"):
+                versions = psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    UPDATE entries SET password = v.password, version = entries.version + 1, updated_at = now()
+                    FROM (VALUES %s) AS v (id, password)
+                    WHERE entries.id = v.id
+                    RETURNING entries.id, entries.version
+                    """,
+                    batch, page_size=batchSize, fetch=True
+                )
+            for id, version in versions:
+                found[id]["version"] = version
+                rotated.append(found[id])
+
+            if len(rows) < batchSize:
+                break
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return rotated
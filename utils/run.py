@@ -0,0 +1,119 @@
+import os
+
+import utils.aesutil
+import utils.metadata
+import utils.urls
+
+# Criteria a mapping may use; "domain" matches the registrable domain
+KEYS = {
+    "sitename": "sitename",
+    "siteurl": "siteurl",
+    "email": "email",
+    "username": "username",
+    "domain": "url_domain",
+}
+
+
+class MappingError(Exception):
+    pass
+
+
+def parseMappings(specs):
+    """Parse `VAR=field:value[+field:value...]` mappings, comma-separated
+
+    Returns a list of (VAR, {column: value}).
+    """
+    mappings = []
+    for spec in specs:
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            var, sep, criteria = item.partition("=")
+            if not sep or not var or not criteria:
+                raise MappingError(f"Invalid mapping {item!r}; expected VAR=field:value")
+
+            search = {}
+            for criterion in criteria.split("+"):
+                key, sep, value = criterion.partition(":")
+                if not sep or key not in KEYS:
+                    raise MappingError(f"Invalid criterion {criterion!r} in {item!r}; fields are {', '.join(KEYS)}")
+                if key == "domain":
+                    value = utils.urls.normalizeUrl(value)["domain"]
+                search[KEYS[key]] = value
+            mappings.append((var, search))
+    return mappings
+
+
+def resolve(db, mk, mappings):
+    """Fetch the passwords for every mapping in one query and decrypt them
+
+    Each mapping must match exactly one entry. Returns {VAR: SecretBuffer}.
+    """
+    cursor = db.cursor()
+    encrypted = utils.metadata.isEncrypted(cursor)
+
+    # One OR of the per-mapping conditions, selecting the columns the rows
+    # are matched back on: blind indexes when metadata is encrypted
+    groups = []
+    params = []
+    matchers = []
+    for var, search in mappings:
+        conditions, values = utils.metadata.searchConditions(mk, search, encrypted)
+        groups.append(f"({conditions})")
+        params.extend(values)
+        columns = [
+            col if not encrypted or col in utils.metadata.INDEX_ONLY else f"{col}_bidx"
+            for col in search
+        ]
+        matchers.append((var, dict(zip(columns, values))))
+
+    selected = sorted({col for _, matcher in matchers for col in matcher})
+    cursor.execute(
+        f"SELECT password, {', '.join(selected)} FROM entries WHERE {' OR '.join(groups)}",
+        params
+    )
+    rows = [dict(zip(["password"] + selected, row)) for row in cursor.fetchall()]
+
+    resolved = {}
+    for var, matcher in matchers:
+        found = [row for row in rows if all(row[col] == value for col, value in matcher.items())]
+        if len(found) == 0:
+            raise MappingError(f"{var}: no entry matches")
+        if len(found) > 1:
+            raise MappingError(f"{var}: {len(found)} entries match; be more specific")
+        resolved[var] = found[0]["password"]
+
+    return {
+        var: utils.aesutil.decryptSecret(key=mk, source=cipher, keyType="bytes")
+        for var, cipher in resolved.items()
+    }
+
+
+def writeSecretFiles(directory, secrets):
+    """Write each secret to DIRECTORY/VAR (mode 0600), then wipe it; returns {VAR_FILE: path}"""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    paths = {}
+    for var, value in secrets.items():
+        path = os.path.join(directory, var)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f, value:
+            f.write(value.view())
+        paths[f"{var}_FILE"] = path
+    return paths
+
+
+def execWith(command, secrets, directory=None):
+    """Replace this process with `command`, its environment carrying the secrets
+
+    With `directory` (ideally on a tmpfs such as /dev/shm), the secrets are
+    written to files there and only their paths go into the environment.
+    """
+    env = dict(os.environ)
+    env.pop("PM_PASSPHRASE_FD", None)
+    if directory is not None:
+        env.update(writeSecretFiles(directory, secrets))
+    else:
+        # exec replaces this process, so the str copies go with it
+        env.update({var: value.decode() for var, value in secrets.items()})
+    os.execvpe(command[0], command, env)
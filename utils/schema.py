@@ -0,0 +1,234 @@
+# Each step is applied once, in order. secrets.schema_version records how many
+# steps a vault has already run, so unlocking an up-to-date vault never touches
+# the DDL below.
+MIGRATIONS = [
+    # 1 - optional metadata encryption with blind-index lookup columns
+    [
+        "ALTER TABLE secrets ADD COLUMN IF NOT EXISTS schema_version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE secrets ADD COLUMN IF NOT EXISTS encrypt_metadata BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS sitename_bidx TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS siteurl_bidx TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS email_bidx TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS username_bidx TEXT",
+        "CREATE INDEX IF NOT EXISTS entries_sitename_bidx_idx ON entries (sitename_bidx)",
+        "CREATE INDEX IF NOT EXISTS entries_siteurl_bidx_idx ON entries (siteurl_bidx)",
+        "CREATE INDEX IF NOT EXISTS entries_email_bidx_idx ON entries (email_bidx)",
+        "CREATE INDEX IF NOT EXISTS entries_username_bidx_idx ON entries (username_bidx)",
+    ],
+    # 2 - normalized site URL parts, looked up by registrable domain
+    [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS url_scheme TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS url_host TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS url_domain TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS url_path TEXT",
+        "CREATE INDEX IF NOT EXISTS entries_url_domain_idx ON entries (url_domain)",
+    ],
+    # 3 - vault version, bumped on every write so caches know when to refresh
+    [
+        "ALTER TABLE secrets ADD COLUMN IF NOT EXISTS vault_version BIGINT NOT NULL DEFAULT 0",
+        """
+        CREATE OR REPLACE FUNCTION pm_bump_vault_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE secrets SET vault_version = vault_version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS entries_vault_version ON entries",
+        """
+        CREATE TRIGGER entries_vault_version
+        AFTER INSERT OR UPDATE OR DELETE ON entries
+        FOR EACH STATEMENT EXECUTE FUNCTION pm_bump_vault_version()
+        """,
+    ],
+    # 4 - row ids and per-row versions for in-place updates
+    [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    ],
+    # 5 - change log for syncing vaults: stable entry ids across vaults, one
+    # log row per entry change, and per-peer sync watermarks
+    [
+        "ALTER TABLE secrets ADD COLUMN IF NOT EXISTS vault_id UUID NOT NULL DEFAULT gen_random_uuid()",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS uuid UUID NOT NULL DEFAULT gen_random_uuid()",
+        "CREATE UNIQUE INDEX IF NOT EXISTS entries_uuid_idx ON entries (uuid)",
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq BIGSERIAL PRIMARY KEY,
+            entry_uuid UUID NOT NULL,
+            op TEXT NOT NULL,
+            origin UUID
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_peers (
+            peer_id UUID PRIMARY KEY,
+            sent_seq BIGINT NOT NULL DEFAULT 0,
+            received_seq BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        # Entries that predate the log are logged once, so a first sync sends them
+        "INSERT INTO changes (entry_uuid, op) SELECT uuid, 'upsert' FROM entries",
+        """
+        CREATE OR REPLACE FUNCTION pm_log_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO changes (entry_uuid, op, origin)
+                VALUES (OLD.uuid, 'delete', NULLIF(current_setting('pm.sync_origin', true), '')::uuid);
+            ELSE
+                INSERT INTO changes (entry_uuid, op, origin)
+                VALUES (NEW.uuid, 'upsert', NULLIF(current_setting('pm.sync_origin', true), '')::uuid);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS entries_change_log ON entries",
+        """
+        CREATE TRIGGER entries_change_log
+        AFTER INSERT OR UPDATE OR DELETE ON entries
+        FOR EACH ROW EXECUTE FUNCTION pm_log_change()
+        """,
+    ],
+    # 6 - master password verifier derived from the master key; the legacy
+    # hash is cleared by utils.unlock on the next unlock
+    [
+        "ALTER TABLE secrets ADD COLUMN IF NOT EXISTS verifier TEXT",
+        "ALTER TABLE secrets ALTER COLUMN masterkey_hash DROP NOT NULL",
+    ],
+    # 7 - attachments: files and notes stored as sealed chunks (utils/attachments.py),
+    # removed with their entry
+    [
+        """
+        CREATE TABLE IF NOT EXISTS attachments (
+            id BIGSERIAL PRIMARY KEY,
+            entry_uuid UUID NOT NULL REFERENCES entries (uuid) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            salt BYTEA NOT NULL,
+            compressed BOOLEAN NOT NULL DEFAULT FALSE,
+            chunk_size INTEGER NOT NULL,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            size BIGINT NOT NULL DEFAULT 0,
+            stored BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS attachments_entry_idx ON attachments (entry_uuid)",
+        """
+        CREATE TABLE IF NOT EXISTS attachment_chunks (
+            attachment_id BIGINT NOT NULL REFERENCES attachments (id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (attachment_id, seq)
+        )
+        """,
+        # Sealed chunks don't compress; don't let TOAST try
+        "ALTER TABLE attachment_chunks ALTER COLUMN data SET STORAGE EXTERNAL",
+    ],
+    # 8 - notify listeners (utils/livecache.py) of every changed entry; Postgres
+    # delivers on commit, and only once per id per transaction
+    [
+        """
+        CREATE OR REPLACE FUNCTION pm_notify_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('pm_entries', OLD.id::text);
+            ELSE
+                PERFORM pg_notify('pm_entries', NEW.id::text);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS entries_notify ON entries",
+        """
+        CREATE TRIGGER entries_notify
+        AFTER INSERT OR UPDATE OR DELETE ON entries
+        FOR EACH ROW EXECUTE FUNCTION pm_notify_change()
+        """,
+    ],
+    # 9 - tags and folders; a GIN index answers tag filters (@> for all, && for any)
+    [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS tags TEXT[] NOT NULL DEFAULT '{}'",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS folder TEXT",
+        "CREATE INDEX IF NOT EXISTS entries_tags_idx ON entries USING GIN (tags)",
+        "CREATE INDEX IF NOT EXISTS entries_folder_idx ON entries (folder)",
+        "CREATE TABLE IF NOT EXISTS labels (value TEXT PRIMARY KEY, name TEXT NOT NULL)",
+    ],
+    # 10 - timestamps; updated_at follows the password, so it gives the
+    # password's age (utils/rotate.py). Existing entries start from now.
+    [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        "CREATE INDEX IF NOT EXISTS entries_updated_at_idx ON entries (updated_at)",
+        """
+        CREATE OR REPLACE FUNCTION pm_touch_password() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.password IS DISTINCT FROM OLD.password THEN
+                NEW.updated_at = now();
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS entries_updated_at ON entries",
+        """
+        CREATE TRIGGER entries_updated_at
+        BEFORE UPDATE ON entries
+        FOR EACH ROW EXECUTE FUNCTION pm_touch_password()
+        """,
+    ],
+    # 11 - commit-safe sync watermarks: each change-log row records the id of
+    # the transaction that wrote it. Sequence numbers are handed out before
+    # commit, so a row can appear below a watermark already taken; a
+    # transaction id below the oldest one still running can't.
+    [
+        "ALTER TABLE changes ADD COLUMN IF NOT EXISTS xid xid8 NOT NULL DEFAULT pg_current_xact_id()",
+        "CREATE INDEX IF NOT EXISTS changes_xid_idx ON changes (xid)",
+        "ALTER TABLE sync_peers ADD COLUMN IF NOT EXISTS sent_xid xid8",
+        "ALTER TABLE sync_peers ADD COLUMN IF NOT EXISTS received_xid xid8",
+    ],
+    # 12 - an update that sets updated_at itself keeps that value, so a
+    # restored entry keeps its password's age instead of starting from now
+    [
+        """
+        CREATE OR REPLACE FUNCTION pm_touch_password() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.password IS DISTINCT FROM OLD.password
+               AND NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+                NEW.updated_at = now();
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+    ],
+]
+
+LATEST = len(MIGRATIONS)
+
+
+def readSecrets(cursor):
+    """Return the single secrets row as a dict keyed by column name"""
+    cursor.execute("SELECT * FROM secrets")
+    row = cursor.fetchone()
+    columns = [c[0] for c in cursor.description]
+    return dict(zip(columns, row))
+
+
+def migrate(db, secrets=None, notes=None):
+    """Bring the vault up to the latest schema version; returns the version
+    it was at. An upgrade is reported by appending to the list `notes`."""
+    cursor = db.cursor()
+    if secrets is None:
+        secrets = readSecrets(cursor)
+
+    version = secrets.get("schema_version", 0)
+    for step in range(version, LATEST):
+        for statement in MIGRATIONS[step]:
+            cursor.execute(statement)
+        cursor.execute("UPDATE secrets SET schema_version = %s", (step + 1,))
+        db.commit()
+
+    if version < LATEST and notes is not None:
+        notes.append(f"Vault schema upgraded to version {LATEST}")
+    return version
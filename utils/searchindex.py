@@ -0,0 +1,130 @@
+import re
+from array import array
+from bisect import bisect_left
+
+from utils.dbconfig import dbconfig
+import utils.metadata
+import utils.shards
+from utils.records import Entry
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Query terms shorter than a trigram are answered from precomputed token prefixes
+SHORT_PREFIX = 2
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """In-memory type-ahead index over entry metadata
+
+    Rows are kept as utils.records.Entry records, with the password still
+    encrypted. Postings are compact arrays of row
+    numbers: token prefixes of one or two characters, and trigrams of every
+    field for longer terms. A query term matches when it occurs anywhere in
+    one of the four fields.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.haystacks = []
+        prefixes = {}
+        grams = {}
+
+        # Rows are visited in order, so every posting list comes out sorted
+        for idx, row in enumerate(rows):
+            hay = "\0".join(value.lower() for value in row.fields() if value)
+            self.haystacks.append(hay)
+
+            starts = set()
+            for token in TOKEN_RE.findall(hay):
+                starts.update(token[:n] for n in range(1, min(len(token), SHORT_PREFIX) + 1))
+            for key in starts:
+                prefixes.setdefault(key, []).append(idx)
+            for gram in trigrams(hay):
+                grams.setdefault(gram, []).append(idx)
+
+        self.prefixes = {key: array("I", ids) for key, ids in prefixes.items()}
+        self.trigrams = {key: array("I", ids) for key, ids in grams.items()}
+
+        # The last answer; typing one more character only narrows it
+        self.lastQuery = None
+        self.lastResult = None
+
+    @classmethod
+    def load(cls, mk=None):
+        """Read the metadata of every entry in one query and index it"""
+        db = dbconfig(readonly=True)
+        cursor = db.cursor()
+        encrypted = utils.metadata.isEncrypted(cursor)
+        query = "SELECT sitename, siteurl, email, username, password FROM entries"
+        rows = [Entry.fromRow(mk, row, encrypted) for row in utils.shards.select(db, query)]
+        db.close()
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _candidates(self, term):
+        if len(term) <= SHORT_PREFIX:
+            return self.prefixes.get(term, ())
+
+        postings = []
+        for gram in trigrams(term):
+            ids = self.trigrams.get(gram)
+            if ids is None:
+                return ()
+            postings.append(ids)
+        postings.sort(key=len)
+
+        result = set(postings[0])
+        for ids in postings[1:]:
+            result.intersection_update(ids)
+            if not result:
+                break
+        return result
+
+    def _matches(self, term, idx):
+        if len(term) <= SHORT_PREFIX:
+            ids = self.prefixes.get(term, ())
+            pos = bisect_left(ids, idx)
+            return pos < len(ids) and ids[pos] == idx
+        return term in self.haystacks[idx]
+
+    def search(self, query):
+        """Return the row numbers matching every term of `query`, in row order
+
+        Terms of one or two characters match the start of a word; longer
+        terms match anywhere in a field.
+        """
+        query = query.lower().strip()
+        terms = query.split()
+        if not terms:
+            return range(len(self.rows))
+
+        narrowing = (
+            self.lastQuery is not None
+            and query.startswith(self.lastQuery)
+            and all(len(term) > SHORT_PREFIX for term in self.lastQuery.split())
+        )
+        if narrowing:
+            # Typing more only removes rows from the previous answer
+            pool = self.lastResult
+            pending = terms
+        else:
+            candidates = {term: self._candidates(term) for term in terms}
+            seed = min(terms, key=lambda term: len(candidates[term]))
+            pool = sorted(candidates[seed])
+            # Prefix postings are exact; trigram postings still need checking
+            pending = [term for term in terms if term != seed or len(term) > SHORT_PREFIX]
+
+        if pending:
+            result = [idx for idx in pool if all(self._matches(term, idx) for term in pending)]
+        else:
+            result = pool
+
+        self.lastQuery = query
+        self.lastResult = result
+        return result
@@ -0,0 +1,101 @@
+import os
+import mmap
+
+# Set $PM_MLOCK=1 to keep secret buffers in their own locked pages (Linux):
+# they are then never written to swap and are left out of core dumps.
+# Without it, or when locking fails (RLIMIT_MEMLOCK), they are bytearrays.
+_libc = None
+
+
+def _lockedPages(size):
+    """An anonymous mapping of at least `size` bytes, mlock()ed, or None"""
+    global _libc
+    import ctypes
+
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        pages = mmap.mmap(-1, max(size, 1))
+    except (OSError, AttributeError):
+        return None
+
+    pin = (ctypes.c_char * len(pages)).from_buffer(pages)
+    locked = _libc.mlock(ctypes.addressof(pin), ctypes.c_size_t(len(pages))) == 0
+    del pin
+    if not locked:
+        pages.close()
+        return None
+    if hasattr(mmap, "MADV_DONTDUMP"):
+        pages.madvise(mmap.MADV_DONTDUMP)
+    return pages
+
+
+class SecretBuffer:
+    """Secret bytes in a mutable buffer that is zeroed when done with
+
+    Use it in a with-block or call wipe(); it is also wiped when collected.
+    What decode() returns is an ordinary str copy, which cannot be wiped,
+    so convert at the last moment (e.g. the clipboard call) and no earlier.
+    """
+
+    __slots__ = ("_store", "_view", "_size")
+
+    def __init__(self, size, lock=None):
+        if lock is None:
+            lock = os.environ.get("PM_MLOCK") == "1"
+        self._size = size
+        self._store = _lockedPages(size) if lock else None
+        if self._store is None:
+            self._store = bytearray(size)
+        # Holding a view also stops the bytearray from ever being resized
+        # (and so copied) while the secret is in it
+        self._view = memoryview(self._store)
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return f"<SecretBuffer {self._size} bytes>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.wipe()
+        return False
+
+    def __del__(self):
+        self.wipe()
+
+    def locked(self):
+        return isinstance(self._store, mmap.mmap)
+
+    def view(self):
+        """Writable memoryview of the secret; don't keep it past wipe()"""
+        if self._view is None:
+            raise ValueError("SecretBuffer already wiped")
+        return self._view[:self._size]
+
+    def truncate(self, size):
+        """Shrink to `size` bytes, zeroing the rest"""
+        self._view[size:self._size] = bytes(self._size - size)
+        self._size = size
+
+    def decode(self, encoding="utf-8"):
+        return str(self.view(), encoding)
+
+    def wipe(self):
+        view = getattr(self, "_view", None)
+        if view is None:
+            return
+        view[:] = bytes(len(view))
+        self._view = None
+        self._size = 0
+        view.release()
+        if isinstance(self._store, mmap.mmap):
+            try:
+                self._store.close()
+            except BufferError:
+                # A view handed out by view() is still alive; the zeroed
+                # pages are unmapped when it goes away
+                pass
@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import hmac
+import socket
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from psycopg2.pool import ThreadedConnectionPool
+import psycopg2
+
+import utils.batch
+import utils.metadata
+from utils.dbconfig import connectParams
+
+# Latency histogram bucket bounds, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+# Largest request body read, in bytes
+MAX_BODY = 1 << 20
+
+# JSON-RPC methods and the batch operation behind each; "get" decrypts one entry
+METHODS = {
+    "get": (utils.batch.opGet, {}),
+    "list": (utils.batch.opExtract, {"decrypt": False}),
+    "add": (utils.batch.opAdd, {}),
+    "update": (utils.batch.opUpdate, {}),
+}
+
+
+class Metrics:
+    """Request counts, errors and latency histograms per method"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.errors = {}
+        self.sums = {}
+        self.buckets = {}
+
+    def observe(self, method, seconds, ok):
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+            self.sums[method] = self.sums.get(method, 0.0) + seconds
+            if not ok:
+                self.errors[method] = self.errors.get(method, 0) + 1
+            buckets = self.buckets.setdefault(method, [0] * len(BUCKETS))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = [
+            "# TYPE pm_requests_total counter",
+            "# TYPE pm_request_errors_total counter",
+            "# TYPE pm_request_duration_seconds histogram",
+        ]
+        with self.lock:
+            for method in sorted(self.counts):
+                lines.append(f'pm_requests_total{{method="{method}"}} {self.counts[method]}')
+                lines.append(f'pm_request_errors_total{{method="{method}"}} {self.errors.get(method, 0)}')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, self.buckets[method]):
+                    cumulative += count
+                    lines.append(f'pm_request_duration_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+                lines.append(f'pm_request_duration_seconds_bucket{{method="{method}",le="+Inf"}} {self.counts[method]}')
+                lines.append(f'pm_request_duration_seconds_sum{{method="{method}"}} {self.sums[method]:.6f}')
+                lines.append(f'pm_request_duration_seconds_count{{method="{method}"}} {self.counts[method]}')
+        return "\n".join(lines) + "\n"
+
+
+def hashToken(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def loadTokens(path):
+    """Read `name sha256(token) [method,method...]` lines into {hash: (name, methods)}
+
+    Only token hashes are stored, so the file itself grants nothing.
+    """
+    tokens = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            methods = set(parts[2].split(",")) if len(parts) > 2 else set(METHODS)
+            tokens[parts[1]] = (parts[0], methods)
+    return tokens
+
+
+def addToken(path, name, methods=None):
+    """Create a token for client `name`, record its hash in `path` and return it"""
+    token = secrets.token_urlsafe(32)
+    line = f"{name} {hashToken(token)}"
+    if methods:
+        line += " " + ",".join(methods)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with os.fdopen(fd, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+    return token
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "pm-serve"
+    # Idle keep-alive connections give their worker thread back after this
+    # long; while other connections wait for a worker, responses close theirs
+    timeout = 2
+
+    def log_message(self, format, *args):
+        # Requests carry secrets in their responses; keep them out of logs
+        pass
+
+    def send(self, status, body, content_type="application/json"):
+        data = body.encode()
+        self.send_response(status)
+        if self.close_connection or self.server.waiting > 0:
+            self.send_header("Connection", "close")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def client(self):
+        header = self.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return None
+        digest = hashToken(header[len("Bearer "):].strip())
+        for known, client in self.server.tokens.items():
+            if hmac.compare_digest(known, digest):
+                return client
+        return None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send(200, self.server.metrics.render(), "text/plain; version=0.0.4")
+        elif self.path == "/health":
+            self.send(200, json.dumps({"ok": True}))
+        else:
+            self.send(404, json.dumps({"error": "not found"}))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY:
+            # The unread body can't be told from the next request
+            self.close_connection = True
+            if length < 0:
+                self.send(400, json.dumps({"error": "invalid Content-Length"}))
+            else:
+                self.send(413, json.dumps({"error": f"request body over {MAX_BODY} bytes"}))
+            return
+        body = self.rfile.read(length)
+
+        if self.path != "/rpc":
+            self.send(404, json.dumps({"error": "not found"}))
+            return
+
+        client = self.client()
+        if client is None:
+            self.send(401, json.dumps({"jsonrpc": "2.0", "id": None, "error": {"code": -32001, "message": "invalid token"}}))
+            return
+
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send(400, json.dumps({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "parse error"}}))
+            return
+
+        if isinstance(request, list):
+            response = [self.server.call(client, item) for item in request]
+        else:
+            response = self.server.call(client, request)
+        self.send(200, json.dumps(response))
+
+
+class VaultServer(HTTPServer):
+    """JSON-RPC over HTTP, served from a thread pool
+
+    Requests share one pool of database connections and the master key
+    derived at startup, so a lookup costs one indexed query and one AES
+    decryption.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, address, mk, tokens, threads=8, unix=False):
+        self.mk = mk
+        self.tokens = tokens
+        self.metrics = Metrics()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pm-serve")
+        self.pool = ThreadedConnectionPool(1, threads, **connectParams())
+        self.unix = unix
+        # Accepted connections not yet picked up by a worker
+        self.waiting = 0
+        self.waitingLock = threading.Lock()
+
+        db = self.pool.getconn()
+        try:
+            self.encrypted = utils.metadata.isEncrypted(db.cursor())
+            db.commit()
+        finally:
+            self.pool.putconn(db)
+
+        if unix:
+            self.address_family = socket.AF_UNIX
+            if os.path.exists(address):
+                os.unlink(address)
+        super().__init__(address, Handler)
+
+    def server_bind(self):
+        if self.unix:
+            # HTTPServer.server_bind resolves a host name, which a socket path hasn't got.
+            # The umask makes the socket 0600 from the start, not after a chmod.
+            umask = os.umask(0o177)
+            try:
+                self.socket.bind(self.server_address)
+            finally:
+                os.umask(umask)
+            self.server_name = "localhost"
+            self.server_port = 0
+        else:
+            super().server_bind()
+
+    def get_request(self):
+        request, address = super().get_request()
+        # Unix sockets report an empty address; BaseHTTPRequestHandler expects a tuple
+        return request, address or ("unix", 0)
+
+    def process_request(self, request, client_address):
+        with self.waitingLock:
+            self.waiting += 1
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        with self.waitingLock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def call(self, client, request):
+        """Run one JSON-RPC request for `client` and return the response object"""
+        started = time.perf_counter()
+        request_id = request.get("id") if isinstance(request, dict) else None
+        method = request.get("method") if isinstance(request, dict) else None
+        known = isinstance(method, str) and method in METHODS
+        name, allowed = client
+
+        def error(code, message):
+            self.metrics.observe(method if known else "invalid", time.perf_counter() - started, False)
+            return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+        if not known:
+            return error(-32601, f"unknown method {method!r}")
+        if method not in allowed:
+            return error(-32003, f"client {name!r} may not call {method!r}")
+        params = request.get("params") or {}
+        if not isinstance(params, dict):
+            return error(-32602, "params must be an object")
+
+        op, fixed = METHODS[method]
+        db = self.pool.getconn()
+        try:
+            result = op(db.cursor(), self.mk, self.encrypted, {**params, **fixed})
+            db.commit()
+        except (utils.batch.BatchError, ValueError) as e:
+            db.rollback()
+            return error(-32602, str(e))
+        except psycopg2.Error as e:
+            db.rollback()
+            return error(-32000, str(e).strip())
+        finally:
+            self.pool.putconn(db)
+
+        self.metrics.observe(method, time.perf_counter() - started, True)
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.pool.closeall()
+        if self.unix and os.path.exists(self.server_address):
+            os.unlink(self.server_address)
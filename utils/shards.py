@@ -0,0 +1,404 @@
+import atexit
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+
+import utils.dbconfig
+import utils.metadata
+from utils.trace import span
+
+# A sharded vault spreads its entries over several Postgres nodes, one
+# [shard:NAME] section of the connection config file each (see
+# utils/dbconfig.py). An entry lives on the node that owns its shard key on
+# a consistent-hash ring, so adding a node only moves the entries the new
+# node takes over. The [primary] keeps the secrets row and stays the place
+# the vault is unlocked from; every node carries a copy of that row
+# (python -m utils.shards init NODE). Without shard sections nothing changes.
+
+# Points each node gets on the ring; more points spread entries more evenly
+POINTS = 256
+
+# Rows moved per transaction when rebalancing
+MOVE_BATCH = 500
+
+# Attachment chunks copied per round trip when an entry moves
+CHUNK_MOVE_BATCH = 16
+
+_active = False
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+
+
+class Ring:
+    """Consistent-hash ring: a key belongs to the first node point at or after its hash"""
+
+    def __init__(self, names, points=POINTS):
+        ring = sorted((_hash(f"{name}#{i}"), name) for name in names for i in range(points))
+        self.hashes = [h for h, _ in ring]
+        self.names = [name for _, name in ring]
+
+    def owner(self, key):
+        i = bisect.bisect_left(self.hashes, _hash(key))
+        return self.names[i % len(self.names)]
+
+
+class ShardMap:
+    """The shard nodes of a vault, with one cached connection per node
+
+    While a node is `joining`, writes already go to it, and reads also ask
+    the node that owned the key before it joined, until a rebalance has
+    moved the entries over.
+    """
+
+    def __init__(self, params, joining=()):
+        self.params = params
+        self.ring = Ring(params)
+        settled = [name for name in params if name not in joining]
+        self.settled = Ring(settled) if len(settled) != len(params) and settled else self.ring
+        self._connections = {}
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def owners(self, key):
+        """Nodes that may hold entries with `key`, the one new writes go to first"""
+        owners = [self.ring.owner(key)]
+        previous = self.settled.owner(key)
+        if previous != owners[0]:
+            owners.append(previous)
+        return owners
+
+    def nodes(self, key=None):
+        return list(self.params) if key is None else self.owners(key)
+
+    def connect(self, name):
+        db = self._connections.get(name)
+        if db is None or db.closed:
+            with span("db.connect.shard"):
+                db = psycopg2.connect(**self.params[name])
+            self._connections[name] = db
+        return db
+
+    def close(self):
+        for db in self._connections.values():
+            db.close()
+        self._connections = {}
+
+    def fanout(self, fn, names=None):
+        """fn(db) on each node in parallel, one transaction each; returns the results in node order"""
+        names = list(self.params) if names is None else names
+
+        def run(name):
+            db = self.connect(name)
+            try:
+                result = fn(db)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            return result
+
+        if len(names) == 1:
+            return [run(names[0])]
+        with span("shards.fanout"), ThreadPoolExecutor(max_workers=len(names)) as pool:
+            return list(pool.map(run, names))
+
+    def select(self, query, params=(), key=None, dedupe=True):
+        """Rows of `query` from the nodes holding `key` (every node when None), merged
+
+        A row seen on two nodes, mid-move, is only returned once unless
+        `dedupe` is off, as it must be for per-node aggregates.
+        """
+        def fetch(db):
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        merged = [row for rows in self.fanout(fetch, self.nodes(key)) for row in rows]
+        if not dedupe:
+            return merged
+        # Array columns (tags) come back as lists, which can't be dict keys
+        seen = set()
+        unique = []
+        for row in merged:
+            found = tuple(tuple(v) if isinstance(v, list) else v for v in row)
+            if found not in seen:
+                seen.add(found)
+                unique.append(row)
+        return unique
+
+    def execute(self, query, params=(), key=None):
+        """Run a write on the nodes holding `key` (every node when None); returns rows affected"""
+        def write(db):
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+        return sum(self.fanout(write, self.nodes(key)))
+
+
+def active():
+    """The vault's ShardMap, or None when no shards are configured"""
+    global _active
+    if _active is False:
+        params = utils.dbconfig.shardParams()
+        _active = ShardMap(params, utils.dbconfig.joiningShards()) if params else None
+        if _active is not None:
+            atexit.register(_active.close)
+    return _active
+
+
+def shardKey(mk, sitename, encrypted):
+    """The key an entry is placed by: its site name, or the site name's blind
+    index when metadata is encrypted, so nodes never see the plain name"""
+    if not encrypted:
+        return sitename
+    return utils.metadata.blindIndex(utils.metadata.blindIndexKeys(mk), "sitename", sitename)
+
+
+def searchKey(mk, search, encrypted):
+    """The shard key a search is confined to, or None when it must ask every node"""
+    if "sitename" not in search:
+        return None
+    return shardKey(mk, search["sitename"], encrypted)
+
+
+def select(db, query, params=(), key=None, dedupe=True):
+    """fetchall() of `query` on `db`, or across the shard nodes holding `key` on a sharded vault"""
+    shards = active()
+    if shards is not None:
+        return shards.select(query, params, key, dedupe)
+    cursor = db.cursor()
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def stream(db, query, params=(), key=None, name="pm_stream", itersize=1000):
+    """Rows of `query` through server-side cursors, node after node on a sharded vault"""
+    shards = active()
+    sources = [db] if shards is None else [shards.connect(node) for node in shards.nodes(key)]
+    for source in sources:
+        pager = source.cursor(name=name)
+        pager.itersize = itersize
+        try:
+            pager.execute(query, params)
+            yield from pager
+        finally:
+            pager.close()
+            if source is not db:
+                source.commit()
+
+
+def _copyAttachments(source, target, uuids):
+    """Copy the attachments of entries `uuids`, chunks included, from
+    `source` to `target`, replacing those the target already has for them
+    (left by an interrupted move); returns how many were copied"""
+    cursor = source.cursor()
+    cursor.execute(
+        """
+        SELECT id, entry_uuid, name, salt, compressed, chunk_size, chunks, size, stored
+        FROM attachments WHERE entry_uuid = ANY(%s::uuid[])
+        """,
+        (uuids,)
+    )
+    attachments = cursor.fetchall()
+    out = target.cursor()
+    out.execute("DELETE FROM attachments WHERE entry_uuid = ANY(%s::uuid[])", (uuids,))
+    for attachment in attachments:
+        # Attachment ids are per node too
+        out.execute(
+            """
+            INSERT INTO attachments (entry_uuid, name, salt, compressed, chunk_size, chunks, size, stored)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+            """,
+            attachment[1:]
+        )
+        attachmentId = out.fetchone()[0]
+        pager = source.cursor(name="pm_move_chunks")
+        pager.itersize = CHUNK_MOVE_BATCH
+        pager.execute("SELECT seq, data FROM attachment_chunks WHERE attachment_id = %s ORDER BY seq", (attachment[0],))
+        batch = []
+        for seq, data in pager:
+            batch.append((attachmentId, seq, data))
+            if len(batch) == CHUNK_MOVE_BATCH:
+                psycopg2.extras.execute_values(out, "INSERT INTO attachment_chunks (attachment_id, seq, data) VALUES %s", batch)
+                batch = []
+        if batch:
+            psycopg2.extras.execute_values(out, "INSERT INTO attachment_chunks (attachment_id, seq, data) VALUES %s", batch)
+        pager.close()
+    return len(attachments)
+
+
+def relocate(shards, name, where="TRUE", params=()):
+    """Move the entries on node `name` matching `where` to the nodes that own them
+
+    Rows are copied in batches: inserted on the owner (kept there if the
+    owner already has a newer version) together with their attachments,
+    committed, then deleted from `name` only if unchanged since they were
+    read. Each batch is one short transaction per node, so the vault stays
+    usable meanwhile. Returns the number of entries moved.
+    """
+    source = shards.connect(name)
+    cursor = source.cursor()
+    keyColumn = "sitename_bidx" if utils.metadata.isEncrypted(cursor) else "sitename"
+    source.commit()
+
+    moved = 0
+    last = 0
+    while True:
+        cursor.execute(
+            f"SELECT * FROM entries WHERE id > %s AND ({where}) ORDER BY id LIMIT %s",
+            [last, *params, MOVE_BATCH]
+        )
+        rows = cursor.fetchall()
+        source.commit()
+        if not rows:
+            return moved
+        columns = [c[0] for c in cursor.description]
+        last = rows[-1][columns.index("id")]
+
+        # Ids are per node; the row gets a new one where it lands
+        copied = [col for col in columns if col != "id"]
+        targets = {}
+        for row in rows:
+            entry = dict(zip(columns, row))
+            if entry[keyColumn] is None:
+                continue
+            owner = shards.owner(entry[keyColumn])
+            if owner != name:
+                targets.setdefault(owner, []).append([entry[col] for col in copied])
+
+        uuid, version = copied.index("uuid"), copied.index("version")
+        for target, values in targets.items():
+            db = shards.connect(target)
+            psycopg2.extras.execute_values(
+                db.cursor(),
+                f"""
+                INSERT INTO entries ({", ".join(copied)}) VALUES %s
+                ON CONFLICT (uuid) DO UPDATE SET {", ".join(f"{col} = EXCLUDED.{col}" for col in copied)}
+                WHERE entries.version < EXCLUDED.version
+                """,
+                values
+            )
+            # The delete below cascades to the source's copies
+            _copyAttachments(source, db, [str(value[uuid]) for value in values])
+            db.commit()
+
+            psycopg2.extras.execute_values(
+                source.cursor(),
+                """
+                DELETE FROM entries e USING (VALUES %s) AS m(uuid, version)
+                WHERE e.uuid = m.uuid::uuid AND e.version = m.version
+                """,
+                [(str(value[uuid]), value[version]) for value in values]
+            )
+            source.commit()
+            moved += len(values)
+
+
+def initNode(shards, name):
+    """Create the vault database on node `name` and copy the primary's secrets row to it"""
+    from psycopg2 import sql
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+    import utils.schema
+
+    params = shards.params[name]
+    admin = psycopg2.connect(**{**params, "dbname": "postgres"})
+    admin.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = admin.cursor()
+    cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (params["dbname"],))
+    if cursor.fetchone() is None:
+        cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(params["dbname"])))
+    admin.close()
+
+    primary = utils.dbconfig.dbconfig()
+    secrets = utils.schema.readSecrets(primary.cursor())
+    primary.close()
+
+    db = shards.connect(name)
+    cursor = db.cursor()
+    cursor.execute("SELECT to_regclass('secrets') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        # The tables as config.py creates them; migrate() does the rest
+        cursor.execute("CREATE TABLE secrets (masterkey_hash TEXT, device_secret TEXT NOT NULL, verifier TEXT)")
+        cursor.execute("""
+            CREATE TABLE entries (
+                sitename TEXT NOT NULL,
+                siteurl TEXT NOT NULL,
+                email TEXT,
+                username TEXT,
+                password TEXT NOT NULL
+            )
+        """)
+        cursor.execute("INSERT INTO secrets (device_secret) VALUES (%s)", (secrets["device_secret"],))
+        db.commit()
+    utils.schema.migrate(db)
+
+    # Everything but the counters each node keeps for itself
+    copied = {col: value for col, value in secrets.items() if col not in ["schema_version", "vault_version"]}
+    cursor.execute(
+        f"UPDATE secrets SET {', '.join(f'{col} = %s' for col in copied)}",
+        list(copied.values())
+    )
+    db.commit()
+
+
+def main(argv=None):
+    import argparse
+    import sys
+    from rich import print as printc
+    from rich.console import Console
+    from rich.table import Table
+
+    parser = argparse.ArgumentParser(description="Manage the shard nodes of a sharded vault")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="Entries per node, and how many sit on the wrong node")
+    init = commands.add_parser("init", help="Create the vault on a new node and copy the secrets to it")
+    init.add_argument("node")
+    commands.add_parser("rebalance", help="Move every entry to the node that owns it")
+    args = parser.parse_args(argv)
+
+    shards = active()
+    if shards is None:
+        sys.exit(f"No [shard:NAME] sections in {utils.dbconfig.configPath()}")
+
+    if args.command == "init":
+        if args.node not in shards.params:
+            sys.exit(f"Unknown node '{args.node}'")
+        initNode(shards, args.node)
+        printc(f"[green][+][/green] Node '{args.node}' ready")
+
+    elif args.command == "status":
+        joining = utils.dbconfig.joiningShards()
+
+        def count(db):
+            cursor = db.cursor()
+            keyColumn = "sitename_bidx" if utils.metadata.isEncrypted(cursor) else "sitename"
+            cursor.execute(f"SELECT {keyColumn}, COUNT(*) FROM entries GROUP BY 1")
+            return cursor.fetchall()
+
+        table = Table(title="Shard nodes")
+        table.add_column("Node")
+        table.add_column("Entries", justify="right")
+        table.add_column("Misplaced", justify="right")
+        for name, keys in zip(shards.params, shards.fanout(count)):
+            misplaced = sum(n for key, n in keys if key is not None and shards.owner(key) != name)
+            label = f"{name} (joining)" if name in joining else name
+            table.add_row(label, str(sum(n for _, n in keys)), str(misplaced))
+        Console().print(table)
+
+    elif args.command == "rebalance":
+        for name in shards.params:
+            moved = relocate(shards, name)
+            printc(f"[green][+][/green] {moved} entries moved off '{name}'")
+        if utils.dbconfig.joiningShards():
+            printc("[cyan][*][/cyan] Done; remove 'joining' from the new node's section")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import os
+import hmac
+import json
+import zlib
+import hashlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Cipher import AES
+import psycopg2.extras
+
+import utils.schema
+
+# A chunk ends after every entry whose uuid hashes to 0 mod CHUNK_ENTRIES, so
+# chunks average this many entries and an edit only changes the chunk it is
+# in: the boundaries depend on the entries themselves, not on their position.
+CHUNK_ENTRIES = 128
+
+# Columns of the secrets row a restore needs to open the entries again
+SECRET_COLUMNS = ["masterkey_hash", "verifier", "device_secret", "encrypt_metadata"]
+
+# Parallel chunk readers on restore
+RESTORE_THREADS = 8
+
+# Rows per INSERT round trip on restore
+INSERT_BATCH = 1000
+
+# Entry columns stored as ISO 8601 strings, parsed back on restore
+TIMESTAMP_COLUMNS = ["created_at", "updated_at"]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class AttachmentsWouldBeLost(SnapshotError):
+    def __init__(self, count):
+        self.count = count
+        super().__init__(f"{count} attachments belong to entries that are not in the snapshot and would be deleted with them")
+
+
+def defaultDir():
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.environ.get("PM_SNAPSHOT_DIR") or os.path.join(base, "pm", "snapshots")
+
+
+def snapshotKey(mk):
+    return hmac.new(mk, b"pm-snapshot", hashlib.sha256).digest()
+
+
+def chunkPath(directory, chunk_id):
+    return os.path.join(directory, "chunks", chunk_id[:2], chunk_id[2:])
+
+
+def _writeFile(path, data):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def sealChunk(key, chunk_id, plaintext):
+    """Compress, then encrypt with AES-GCM; the chunk id is authenticated too"""
+    nonce = os.urandom(12)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(chunk_id.encode())
+    ciphertext, tag = cipher.encrypt_and_digest(zlib.compress(plaintext, 6))
+    return nonce + ciphertext + tag
+
+
+def openChunk(key, chunk_id, data):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=data[:12])
+    cipher.update(chunk_id.encode())
+    try:
+        plaintext = cipher.decrypt_and_verify(data[12:-16], data[-16:])
+    except ValueError:
+        raise SnapshotError(f"Chunk {chunk_id} failed authentication (wrong password or corrupted file)")
+    return zlib.decompress(plaintext)
+
+
+def storeChunk(directory, key, plaintext):
+    """Write a chunk unless an identical one is already stored; returns (id, bytes written)
+
+    The id is a keyed hash of the plaintext, so equal chunks share a file
+    while the file names reveal nothing about their contents.
+    """
+    chunk_id = hmac.new(key, plaintext, hashlib.sha256).hexdigest()[:32]
+    path = chunkPath(directory, chunk_id)
+    if os.path.exists(path):
+        return chunk_id, 0
+    data = sealChunk(key, chunk_id, plaintext)
+    _writeFile(path, data)
+    return chunk_id, len(data)
+
+
+def _isBoundary(uuid):
+    return int(hashlib.sha256(uuid.encode()).hexdigest()[:8], 16) % CHUNK_ENTRIES == 0
+
+
+def _encodeValue(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot snapshot a value of type {type(value).__name__}")
+
+
+def _signManifest(key, manifest):
+    body = json.dumps({k: v for k, v in manifest.items() if k != "mac"}, sort_keys=True).encode()
+    return hmac.new(key, body, hashlib.sha256).hexdigest()
+
+
+def createSnapshot(db, mk, directory):
+    """Snapshot the vault into `directory`; returns (name, manifest, bytes written)
+
+    Entries are read in uuid order and cut into content-defined chunks, so
+    only chunks holding changed entries are new and everything else is
+    shared with earlier snapshots.
+    """
+    key = snapshotKey(mk)
+    secrets = utils.schema.readSecrets(db.cursor())
+    written = 0
+
+    secret_row = json.dumps({col: secrets.get(col) for col in SECRET_COLUMNS}, sort_keys=True).encode()
+    secrets_chunk, size = storeChunk(directory, key, secret_row)
+    written += size
+
+    reader = db.cursor(name="pm_snapshot")
+    reader.itersize = INSERT_BATCH
+    reader.execute("SELECT * FROM entries ORDER BY uuid")
+
+    columns = None
+    chunks = []
+    pending = []
+    count = 0
+    for row in reader:
+        if columns is None:
+            columns = [c[0] for c in reader.description]
+            keep = [i for i, col in enumerate(columns) if col != "id"]
+            uuid_at = columns.index("uuid")
+            columns = [columns[i] for i in keep]
+        pending.append(json.dumps([row[i] for i in keep], default=_encodeValue))
+        count += 1
+        if _isBoundary(str(row[uuid_at])):
+            chunk_id, size = storeChunk(directory, key, "\n".join(pending).encode())
+            chunks.append(chunk_id)
+            written += size
+            pending.clear()
+    if pending:
+        chunk_id, size = storeChunk(directory, key, "\n".join(pending).encode())
+        chunks.append(chunk_id)
+        written += size
+    reader.close()
+
+    # Names of the encrypted vault's tags and folders, read in the same transaction
+    cursor = db.cursor()
+    cursor.execute("SELECT value, name FROM labels ORDER BY value")
+    labels_chunk, size = storeChunk(directory, key, json.dumps(cursor.fetchall()).encode())
+    written += size
+    db.commit()
+
+    created = datetime.datetime.now(datetime.timezone.utc)
+    manifest = {
+        "format": 1,
+        "created": created.isoformat(timespec="seconds"),
+        "vault_id": str(secrets.get("vault_id")),
+        "vault_version": secrets.get("vault_version"),
+        # Needed, with the master password, to derive the key again after
+        # the vault is lost; the secrets row itself is an encrypted chunk
+        "device_secret": secrets["device_secret"],
+        "secrets": secrets_chunk,
+        "labels": labels_chunk,
+        "columns": columns or [],
+        "entries": count,
+        "chunks": chunks,
+    }
+    manifest["mac"] = _signManifest(key, manifest)
+
+    name = created.strftime("%Y%m%dT%H%M%SZ")
+    data = json.dumps(manifest, separators=(",", ":")).encode()
+    _writeFile(os.path.join(directory, "manifests", f"{name}.json"), data)
+    return name, manifest, written + len(data)
+
+
+def listSnapshots(directory):
+    """Manifests in `directory`, oldest first, as [(name, manifest)]"""
+    path = os.path.join(directory, "manifests")
+    if not os.path.isdir(path):
+        return []
+    snapshots = []
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith(".json"):
+            with open(os.path.join(path, filename), encoding="utf-8") as f:
+                snapshots.append((filename[:-len(".json")], json.load(f)))
+    return snapshots
+
+
+def loadManifest(directory, name=None):
+    snapshots = listSnapshots(directory)
+    if not snapshots:
+        raise SnapshotError(f"No snapshots in {directory}")
+    if name is None:
+        return snapshots[-1]
+    for found, manifest in snapshots:
+        if found == name:
+            return found, manifest
+    raise SnapshotError(f"No snapshot named {name!r} in {directory}")
+
+
+def restoreSnapshot(db, mk, directory, manifest, threads=RESTORE_THREADS, dropAttachments=False):
+    """Replace the vault's entries (and key material) with a snapshot's
+
+    Chunks are read, authenticated and decompressed by a thread pool while
+    the rows already decoded are upserted by uuid in batches; everything
+    happens in one transaction. Entries that are in the snapshot keep their
+    attachments. Entries that are not are deleted, and their attachments
+    with them; unless `dropAttachments` is set, that raises
+    AttachmentsWouldBeLost and nothing changes. Returns the number of
+    entries restored.
+    """
+    key = snapshotKey(mk)
+    if not hmac.compare_digest(_signManifest(key, manifest), manifest.get("mac", "")):
+        raise SnapshotError("Manifest failed authentication (wrong password or modified file)")
+
+    def load(chunk_id):
+        with open(chunkPath(directory, chunk_id), "rb") as f:
+            return openChunk(key, chunk_id, f.read())
+
+    secret_row = json.loads(load(manifest["secrets"]))
+    columns = manifest["columns"]
+
+    query = "INSERT INTO entries ({}) VALUES %s ON CONFLICT (uuid) DO UPDATE SET {}".format(
+        ", ".join(columns), ", ".join(f"{col} = EXCLUDED.{col}" for col in columns if col != "uuid")
+    )
+    uuid_at = columns.index("uuid")
+    timestamps = [i for i, col in enumerate(columns) if col in TIMESTAMP_COLUMNS]
+    restored = 0
+    batch = []
+    cursor = db.cursor()
+
+    def insert(rows):
+        psycopg2.extras.execute_values(cursor, query, rows, page_size=INSERT_BATCH)
+        psycopg2.extras.execute_values(cursor, "INSERT INTO pm_restored (uuid) VALUES %s",
+                                       [(row[uuid_at],) for row in rows], page_size=INSERT_BATCH)
+
+    try:
+        # The snapshot's uuids, to delete the entries it doesn't have afterwards
+        cursor.execute("CREATE TEMP TABLE pm_restored (uuid UUID PRIMARY KEY) ON COMMIT DROP")
+        cursor.execute(
+            "UPDATE secrets SET {}".format(", ".join(f"{col} = %s" for col in SECRET_COLUMNS)),
+            # Snapshots taken before verifiers existed have no "verifier"
+            [secret_row.get(col) for col in SECRET_COLUMNS]
+        )
+        # Snapshots taken before tags existed have no labels
+        if manifest.get("labels"):
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO labels (value, name) VALUES %s ON CONFLICT (value) DO UPDATE SET name = EXCLUDED.name",
+                [tuple(label) for label in json.loads(load(manifest["labels"]))],
+                page_size=INSERT_BATCH
+            )
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # map() yields in manifest order while later chunks are still loading
+            for plaintext in executor.map(load, manifest["chunks"]):
+                for line in plaintext.decode().split("\n"):
+                    row = json.loads(line)
+                    for i in timestamps:
+                        if row[i] is not None:
+                            row[i] = datetime.datetime.fromisoformat(row[i])
+                    batch.append(row)
+                if len(batch) >= INSERT_BATCH:
+                    insert(batch)
+                    restored += len(batch)
+                    batch.clear()
+        if batch:
+            insert(batch)
+            restored += len(batch)
+        if restored != manifest["entries"]:
+            raise SnapshotError(f"Snapshot holds {restored} entries, manifest says {manifest['entries']}")
+
+        gone = "NOT EXISTS (SELECT 1 FROM pm_restored r WHERE r.uuid = {})"
+        if not dropAttachments:
+            cursor.execute(f"SELECT COUNT(*) FROM attachments a WHERE {gone.format('a.entry_uuid')}")
+            lost = cursor.fetchone()[0]
+            if lost:
+                raise AttachmentsWouldBeLost(lost)
+        cursor.execute(f"DELETE FROM entries e WHERE {gone.format('e.uuid')}")
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return restored
@@ -0,0 +1,217 @@
+import os
+import math
+import mmap
+import struct
+
+# Latency histograms kept in one small fixed-size file, shared by every
+# pm.py run and menu session on this machine. Bucket i counts durations in
+# [2^(i/4), 2^((i+1)/4)) microseconds: fixed log-scale buckets, ~19% wide,
+# from 1 us up to about 71 minutes.
+MAGIC = b"PMH1"
+SLOTS = 128
+BUCKETS = 128
+NAME_SIZE = 48
+
+HEADER = struct.Struct("<4sIII")
+SLOT_HEAD = struct.Struct(f"<{NAME_SIZE}sQQ")  # name, count, sum of microseconds
+COUNTER = struct.Struct("<Q")
+SLOT_SIZE = SLOT_HEAD.size + BUCKETS * COUNTER.size
+FILE_SIZE = HEADER.size + SLOTS * SLOT_SIZE
+
+# Percentiles shown by `pm.py stats`
+PERCENTILES = [50, 95, 99]
+
+
+def path():
+    base = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.environ.get("PM_STATS_FILE") or os.path.join(base, "pm", "latency.bin")
+
+
+def bucketOf(microseconds):
+    if microseconds < 1:
+        return 0
+    return min(int(math.log2(microseconds) * 4), BUCKETS - 1)
+
+
+def bucketBounds(index):
+    """[low, high) of bucket `index`, in seconds"""
+    return 2 ** (index / 4) / 1e6, 2 ** ((index + 1) / 4) / 1e6
+
+
+def _open(create):
+    import fcntl
+
+    filename = path()
+    if not os.path.exists(filename):
+        if not create:
+            return None, None, None
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    if os.fstat(fd).st_size != FILE_SIZE:
+        os.ftruncate(fd, FILE_SIZE)
+        os.pwrite(fd, HEADER.pack(MAGIC, 1, SLOTS, BUCKETS), 0)
+    view = mmap.mmap(fd, FILE_SIZE)
+    if view[:4] != MAGIC:
+        view.close()
+        os.close(fd)
+        raise ValueError(f"{filename} is not a pm latency histogram file")
+    return fd, view, filename
+
+
+def _close(fd, view):
+    view.close()
+    os.close(fd)
+
+
+def _slot(view, name, create):
+    """Offset of the slot holding `name`, claiming a free one if asked"""
+    key = name.encode()[:NAME_SIZE]
+    for i in range(SLOTS):
+        offset = HEADER.size + i * SLOT_SIZE
+        stored = view[offset:offset + NAME_SIZE].rstrip(b"\0")
+        if stored == key:
+            return offset
+        if not stored:
+            if not create:
+                return None
+            view[offset:offset + NAME_SIZE] = key.ljust(NAME_SIZE, b"\0")
+            return offset
+    return None
+
+
+def record(durations):
+    """Add (name, seconds) samples to the histograms; O(1) work per sample"""
+    if not durations:
+        return
+    fd, view, _ = _open(create=True)
+    try:
+        for name, seconds in durations:
+            offset = _slot(view, name, create=True)
+            if offset is None:
+                continue
+            microseconds = seconds * 1e6
+            _, count, total = SLOT_HEAD.unpack_from(view, offset)
+            struct.pack_into("<QQ", view, offset + NAME_SIZE, count + 1, total + int(microseconds))
+            at = offset + SLOT_HEAD.size + bucketOf(microseconds) * COUNTER.size
+            COUNTER.pack_into(view, at, COUNTER.unpack_from(view, at)[0] + 1)
+    finally:
+        _close(fd, view)
+
+
+def recordSpans(spans):
+    """Record utils.trace spans: each top-level span is an operation, and
+    the spans nested in it are its phases, named `operation/phase`
+
+    Interactive spans (utils.trace.INTERACTIVE: password and confirmation
+    prompts) are not recorded, and the time spent in them is taken out of
+    the operation's duration, so the histograms measure the program only.
+    """
+    from utils.trace import INTERACTIVE
+
+    durations = []
+    children = []
+    for name, start, end, tid, depth in spans:
+        if depth > 0:
+            children.append((name, start, end, tid))
+            continue
+        # Children end before their parent, so they were appended first
+        phases = {}
+        waiting = 0
+        for child, cstart, cend, ctid in children:
+            if ctid == tid and cstart >= start and cend <= end:
+                if child in INTERACTIVE:
+                    waiting += cend - cstart
+                else:
+                    phases[child] = phases.get(child, 0) + cend - cstart
+        if name not in INTERACTIVE:
+            durations.append((name, (end - start - waiting) / 1e9))
+            durations.extend((f"{name}/{child}", total / 1e9) for child, total in phases.items())
+        children = [c for c in children if not (c[3] == tid and c[1] >= start and c[2] <= end)]
+    record(durations)
+
+
+def recordTrace():
+    """Record the utils.trace spans collected since the last call, and let
+    the tracer forget them
+
+    Never raises: failing to keep statistics must not fail the operation.
+    Set $PM_STATS=0 to turn recording off.
+    """
+    import utils.trace
+
+    new = utils.trace.drain()
+    if os.environ.get("PM_STATS") == "0":
+        return
+    try:
+        recordSpans(new)
+    except (OSError, ValueError):
+        pass
+
+
+def read():
+    """{name: (count, total seconds, [bucket counts])}"""
+    fd, view, _ = _open(create=False)
+    if fd is None:
+        return {}
+    try:
+        histograms = {}
+        for i in range(SLOTS):
+            offset = HEADER.size + i * SLOT_SIZE
+            name, count, total = SLOT_HEAD.unpack_from(view, offset)
+            name = name.rstrip(b"\0").decode(errors="replace")
+            if not name:
+                break
+            buckets = list(struct.unpack_from(f"<{BUCKETS}Q", view, offset + SLOT_HEAD.size))
+            histograms[name] = (count, total / 1e6, buckets)
+        return histograms
+    finally:
+        _close(fd, view)
+
+
+def percentile(buckets, p):
+    """Upper bound of the bucket holding the p-th percentile, in seconds"""
+    count = sum(buckets)
+    if count == 0:
+        return None
+    target = count * p / 100
+    seen = 0
+    for index, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            return bucketBounds(index)[1]
+    return bucketBounds(BUCKETS - 1)[1]
+
+
+def prometheus(histograms):
+    """Prometheus text format, bucketed at powers of two to keep it short"""
+    lines = [
+        "# HELP pm_operation_duration_seconds Duration of pm.py and menu operations and their phases",
+        "# TYPE pm_operation_duration_seconds histogram",
+    ]
+    for name, (count, total, buckets) in sorted(histograms.items()):
+        operation, _, phase = name.partition("/")
+        labels = f'operation="{operation}",phase="{phase or "total"}"'
+        cumulative = 0
+        for index, n in enumerate(buckets):
+            cumulative += n
+            if index % 4 == 3:
+                lines.append(f'pm_operation_duration_seconds_bucket{{{labels},le="{bucketBounds(index)[1]:.6g}"}} {cumulative}')
+        lines.append(f'pm_operation_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"pm_operation_duration_seconds_sum{{{labels}}} {total:.6f}")
+        lines.append(f"pm_operation_duration_seconds_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def writeTextfile(filename, histograms):
+    """Write for node_exporter's textfile collector (atomically, as it requires)"""
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(prometheus(histograms))
+    os.replace(tmp, filename)
+
+
+def reset():
+    filename = path()
+    if os.path.exists(filename):
+        os.unlink(filename)
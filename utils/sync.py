@@ -0,0 +1,205 @@
+import psycopg2
+import psycopg2.extras
+
+import utils.aesutil
+import utils.metadata
+import utils.unlock
+
+# Rows per round trip when reading a delta and when applying one
+BATCH_SIZE = 500
+
+
+class SyncError(Exception):
+    pass
+
+
+class SyncConflict(SyncError):
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__(f"{len(conflicts)} entries were changed on both sides since the last sync")
+
+
+class Vault:
+    """One side of a sync: a connection plus what is needed to read and write it"""
+
+    def __init__(self, db, mp, notes=None):
+        self.db = db
+        unlocked = utils.unlock.unlock(mp, db, notes=notes)
+        if unlocked is None:
+            raise SyncError("Master password does not match this vault")
+        db.commit()
+
+        secrets, self.mk = unlocked
+        self.id = str(secrets["vault_id"])
+        self.encrypted = bool(secrets.get("encrypt_metadata", False))
+
+    def highWater(self):
+        """Oldest transaction id still running: every change written by an
+        earlier transaction is already committed (or rolled back)"""
+        cursor = self.db.cursor()
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")
+        return cursor.fetchone()[0]
+
+    def delta(self, after, upto, exclude, afterSeq=0):
+        """Latest change per entry written by transactions in [after, upto), as plaintext
+
+        `after` is the previous sync's high water; None (a peer last synced
+        before transaction ids were logged) reads the rows past sequence
+        `afterSeq` instead. Changes that came from `exclude` (the peer being
+        synced with) are skipped, so what a peer sent is never echoed back
+        to it. Returns {uuid: None for a delete, else {"version", fields...,
+        "tags", "folder", "password", "created_at", "updated_at"}}.
+        """
+        if after is None:
+            since, params = "seq > %s", [afterSeq]
+        else:
+            since, params = "xid >= %s::xid8", [after]
+        reader = self.db.cursor(name="pm_sync_delta")
+        reader.itersize = BATCH_SIZE
+        reader.execute(f"""
+            WITH latest AS (
+                SELECT DISTINCT ON (entry_uuid) entry_uuid, origin
+                FROM changes WHERE {since} AND xid < %s::xid8
+                ORDER BY entry_uuid, seq DESC
+            )
+            SELECT l.entry_uuid, e.sitename, e.siteurl, e.email, e.username, e.password, e.version, e.tags, e.folder,
+                   e.created_at, e.updated_at
+            FROM latest l LEFT JOIN entries e ON e.uuid = l.entry_uuid
+            WHERE l.origin IS DISTINCT FROM %s
+        """, params + [upto, exclude])
+
+        names = self._names()
+        changes = {}
+        for row in reader:
+            if row[5] is None:
+                # Deleted, possibly by a change newer than `upto`
+                changes[str(row[0])] = None
+                continue
+            entry = dict(zip(utils.metadata.FIELDS, utils.metadata.decodeRow(self.mk, row[1:5], self.encrypted)))
+            entry["password"] = utils.aesutil.decrypt(key=self.mk, source=row[5], keyType="bytes").decode()
+            entry["version"] = row[6]
+            entry["tags"], entry["folder"] = self._labels(row[7], row[8], names)
+            entry["created_at"], entry["updated_at"] = row[9], row[10]
+            changes[str(row[0])] = entry
+        reader.close()
+        return changes
+
+    def _names(self):
+        """{stored value: name} of the encrypted vault's tags and folders"""
+        if not self.encrypted:
+            return None
+        cursor = self.db.cursor()
+        cursor.execute("SELECT value, name FROM labels")
+        return utils.metadata.labelNames(self.mk, cursor.fetchall())
+
+    def _labels(self, tags, folder, names):
+        """(tags, folder) as plaintext; on an encrypted vault a label whose
+        name is missing is left out rather than sent as a placeholder"""
+        if not self.encrypted:
+            return sorted(tags or []), folder
+        return sorted(names[tag] for tag in tags or [] if tag in names), names.get(folder)
+
+    def apply(self, changes, origin):
+        """Write a delta from vault `origin`, re-encrypted with this vault's key"""
+        cursor = self.db.cursor()
+        # Picked up by the change-log trigger, so these rows are attributed to the peer
+        cursor.execute("SELECT set_config('pm.sync_origin', %s, true)", (origin,))
+
+        deletes = [uuid for uuid, entry in changes.items() if entry is None]
+        for i in range(0, len(deletes), BATCH_SIZE):
+            cursor.execute("DELETE FROM entries WHERE uuid = ANY(%s::uuid[])", (deletes[i:i + BATCH_SIZE],))
+
+        rows = []
+        columns = None
+        for uuid, entry in changes.items():
+            if entry is None:
+                continue
+            values = {field: entry[field] or "" for field in utils.metadata.FIELDS}
+            values["tags"], values["folder"] = entry["tags"], entry["folder"]
+            # Blind indexes and label names are recomputed under this vault's key
+            encoded = utils.metadata.encodeFields(self.mk, values, self.encrypted)
+            utils.metadata.rememberLabels(cursor, self.mk, values, self.encrypted)
+            encoded["password"] = utils.aesutil.encrypt(key=self.mk, source=entry["password"], keyType="bytes")
+            # Set explicitly, so the password keeps its age here (schema step 12)
+            encoded["created_at"], encoded["updated_at"] = entry["created_at"], entry["updated_at"]
+            if columns is None:
+                columns = ["uuid", "version"] + list(encoded)
+            rows.append([uuid, entry["version"]] + [encoded[col] for col in columns[2:]])
+
+        if rows:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO entries ({}) VALUES %s ON CONFLICT (uuid) DO UPDATE SET {}".format(
+                    ", ".join(columns),
+                    ", ".join(f"{col} = EXCLUDED.{col}" for col in columns[1:])
+                ),
+                rows,
+                template="(" + ", ".join(["%s::uuid"] + ["%s"] * (len(columns) - 1)) + ")",
+                page_size=BATCH_SIZE
+            )
+        return len(deletes) + len(rows)
+
+
+def _same(mine, theirs):
+    if mine is None or theirs is None:
+        return mine is None and theirs is None
+    return all(mine[field] == theirs[field] for field in utils.metadata.FIELDS + utils.metadata.LABELS + ["password"])
+
+
+def sync(local, remote, mp, prefer=None, notes=None):
+    """Exchange the changes made on each side since the last sync
+
+    `local` and `remote` are open connections. Only entries whose change-log
+    rows were written after the watermarks recorded for this peer are read
+    and sent. An entry changed differently on both sides is a conflict: it
+    raises SyncConflict and nothing is written unless `prefer` is "local" or
+    "remote". Returns (sent, received, conflicts); upgrades either vault
+    needed on unlock are appended to the list `notes`.
+    """
+    here = Vault(local, mp, notes)
+    there = Vault(remote, mp, notes)
+    if here.id == there.id:
+        raise SyncError("Both connections point at the same vault")
+
+    cursor = local.cursor()
+    cursor.execute("SELECT sent_xid::text, received_xid::text, sent_seq, received_seq FROM sync_peers WHERE peer_id = %s",
+                   (there.id,))
+    sent_xid, received_xid, sent_seq, received_seq = cursor.fetchone() or (None, None, 0, 0)
+
+    # Fix the upper bounds first; transactions still running, or starting
+    # during the sync, are left for the next one
+    local_high = here.highWater()
+    remote_high = there.highWater()
+    outgoing = here.delta(sent_xid, local_high, there.id, afterSeq=sent_seq)
+    incoming = there.delta(received_xid, remote_high, here.id, afterSeq=received_seq)
+
+    conflicts = []
+    for uuid in set(outgoing) & set(incoming):
+        mine, theirs = outgoing[uuid], incoming[uuid]
+        if _same(mine, theirs):
+            # Same edit on both sides (or deleted on both): nothing to send
+            del outgoing[uuid]
+            del incoming[uuid]
+        else:
+            conflicts.append((uuid, mine, theirs))
+
+    if conflicts:
+        if prefer is None:
+            local.rollback()
+            remote.rollback()
+            raise SyncConflict(conflicts)
+        for uuid, _, _ in conflicts:
+            del (incoming if prefer == "local" else outgoing)[uuid]
+
+    sent = there.apply(outgoing, here.id)
+    received = here.apply(incoming, there.id)
+    cursor.execute("""
+        INSERT INTO sync_peers (peer_id, sent_xid, received_xid) VALUES (%s, %s::xid8, %s::xid8)
+        ON CONFLICT (peer_id) DO UPDATE SET sent_xid = EXCLUDED.sent_xid, received_xid = EXCLUDED.received_xid
+    """, (there.id, local_high, remote_high))
+
+    # Remote first: if the local commit then fails, the next sync resends the
+    # same rows, and re-applying them is harmless
+    remote.commit()
+    local.commit()
+    return sent, received, len(conflicts)
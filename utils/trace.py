@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import threading
+
+# Disabled by default: span() then hands back one shared no-op object, so an
+# instrumented phase costs a global lookup and an empty with-block.
+_enabled = False
+_started = 0
+_spans = []
+_local = threading.local()
+# Whether spans stay in memory for report()/writeTrace() once drained
+_retain = False
+_drained = 0
+
+# Spans that time the person at the keyboard, not the program; utils.stats
+# leaves them, and the time inside them, out of operation durations
+INTERACTIVE = ("getpass", "prompt")
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start", "depth")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.depth = getattr(_local, "depth", 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        _local.depth = self.depth
+        # list.append is atomic, so threads can record without a lock
+        _spans.append((self.name, self.start, end, threading.get_ident(), self.depth))
+        return False
+
+
+def span(name):
+    """Time the enclosed block as phase `name` when tracing is on"""
+    return _Span(name) if _enabled else NOOP
+
+
+def enable(retain=False):
+    """Start collecting spans; `retain` keeps them all for report() and
+    writeTrace() (always so with $PM_PROFILE or $PM_TRACE), else drain()
+    hands them over and frees them"""
+    global _enabled, _started, _retain
+    _enabled = True
+    _started = time.perf_counter_ns()
+    _retain = bool(retain or os.environ.get("PM_PROFILE") or os.environ.get("PM_TRACE"))
+
+
+def enabled():
+    return _enabled
+
+
+def enableFromEnv():
+    """Turn tracing on when $PM_PROFILE or $PM_TRACE is set (for the menus)"""
+    if os.environ.get("PM_PROFILE") or os.environ.get("PM_TRACE"):
+        enable(retain=True)
+
+
+def spans():
+    return list(_spans)
+
+
+def drain():
+    """The spans recorded since the last drain(), in O(new spans)
+
+    Unless spans are retained, they are removed as well, so a long menu
+    session holds only those of the operation in progress.
+    """
+    global _drained
+    if _retain:
+        new = _spans[_drained:]
+        _drained += len(new)
+        return new
+    # Spans appended by other threads meanwhile land past `count` and stay
+    count = len(_spans)
+    new = _spans[:count]
+    del _spans[:count]
+    return new
+
+
+def report(out=None):
+    """Print each phase's call count, total time and share of the run"""
+    out = out or sys.stderr
+    wall = max(time.perf_counter_ns() - _started, 1)
+    phases = {}
+    for name, start, end, _, depth in _spans:
+        calls, total, first, shallowest = phases.get(name, (0, 0, start, depth))
+        phases[name] = (calls + 1, total + end - start, min(first, start), min(shallowest, depth))
+
+    out.write(f"{'phase':<36} {'calls':>7} {'total ms':>10} {'%':>6}\n")
+    for name, (calls, total, _, depth) in sorted(phases.items(), key=lambda item: item[1][2]):
+        label = "  " * depth + name
+        out.write(f"{label:<36} {calls:>7} {total / 1e6:>10.2f} {total / wall * 100:>5.1f}%\n")
+    out.write(f"{'wall':<36} {'':>7} {wall / 1e6:>10.2f}\n")
+
+
+def writeTrace(path):
+    """Write the spans as Chrome trace events (chrome://tracing, Perfetto)"""
+    import json
+
+    pid = os.getpid()
+    events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": (start - _started) / 1000,
+            "dur": (end - start) / 1000,
+            "pid": pid,
+            "tid": tid,
+        }
+        for name, start, end, tid, _ in _spans
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def finish(profile=False, tracePath=None):
+    """Print and/or write what was recorded; used by pm.py and the menus on exit"""
+    if not _enabled:
+        return
+    tracePath = tracePath or os.environ.get("PM_TRACE")
+    if profile or os.environ.get("PM_PROFILE"):
+        report()
+    if tracePath:
+        writeTrace(tracePath)
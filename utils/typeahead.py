@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+
+from rich.console import Group
+from rich.live import Live
+from rich.panel import Panel
+from rich.table import Table
+from rich.text import Text
+from rich import box
+
+# Lines taken by the search box, table header and footer around the results
+CHROME_LINES = 10
+
+
+def readKey():
+    """Read a single keypress without waiting for Enter
+
+    Returns the character typed, or one of "up", "down", "pgup", "pgdn",
+    "enter", "backspace", "esc".
+    """
+    if os.name == "nt":
+        import msvcrt
+        ch = msvcrt.getwch()
+        if ch in ("\x00", "\xe0"):
+            return {"H": "up", "P": "down", "I": "pgup", "Q": "pgdn"}.get(msvcrt.getwch(), "")
+    else:
+        import select
+        # Read the raw descriptor: a buffered stdin would swallow the rest of
+        # an escape sequence and hide it from select()
+        fd = sys.stdin.fileno()
+        first = os.read(fd, 1)
+        if first == b"\x1b":
+            # Arrow keys arrive as an escape sequence; a lone ESC does not
+            if not select.select([fd], [], [], 0.05)[0]:
+                return "esc"
+            seq = os.read(fd, 2).decode(errors="ignore")
+            if seq in ("[5", "[6"):
+                os.read(fd, 1)
+            return {"[A": "up", "[B": "down", "[5": "pgup", "[6": "pgdn"}.get(seq, "")
+        # Pull in the continuation bytes of a multi-byte UTF-8 character
+        extra = 3 if first >= b"\xf0" else 2 if first >= b"\xe0" else 1 if first >= b"\xc0" else 0
+        ch = (first + (os.read(fd, extra) if extra else b"")).decode(errors="ignore")
+
+    if ch in ("\r", "\n"):
+        return "enter"
+    if ch in ("\x7f", "\x08"):
+        return "backspace"
+    if ch == "\x1b":
+        return "esc"
+    return ch
+
+
+class cbreak:
+    """Put the terminal in character-at-a-time mode for the duration of a block"""
+
+    def __enter__(self):
+        if os.name != "nt":
+            import termios
+            import tty
+            self.fd = sys.stdin.fileno()
+            self.saved = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name != "nt":
+            import termios
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+
+
+def render(index, query, matches, selected, offset, height, elapsed, status):
+    table = Table(box=box.SIMPLE_HEAD, expand=True)
+    table.add_column("🌐 Site Name", style="cyan", ratio=2)
+    table.add_column("🔗 URL", style="blue", ratio=3)
+    table.add_column("📧 Email", style="yellow", ratio=2)
+    table.add_column("👤 Username", style="green", ratio=2)
+
+    # Only the visible window of results is turned into table rows
+    for pos in range(offset, min(offset + height, len(matches))):
+        row = index.rows[matches[pos]]
+        style = "reverse" if pos == selected else None
+        table.add_row(*(value or "" for value in row.fields()), style=style)
+
+    search_box = Panel(
+        Text.assemble(("🔍 ", ""), (query, "bold yellow"), ("▏", "blink")),
+        title="[bold cyan]QUICK SEARCH[/bold cyan]",
+        border_style="cyan"
+    )
+    footer = Text.from_markup(
+        f"[dim]{len(matches)} of {len(index)} entries · {elapsed * 1000:.2f} ms · "
+        "↑/↓ move · Enter copy password · Esc back[/dim]"
+    )
+    if status:
+        footer.append("\n")
+        footer.append_text(Text.from_markup(status))
+    return Group(search_box, table, footer)
+
+
+def quickSearch(console, index, copyPassword):
+    """Full-screen incremental search over `index`
+
+    Filters on every keystroke and calls `copyPassword(row)` for the entry
+    selected with Enter.
+    """
+    query = ""
+    selected = 0
+    offset = 0
+    status = ""
+
+    started = time.perf_counter()
+    matches = index.search(query)
+    elapsed = time.perf_counter() - started
+
+    with cbreak(), Live(console=console, screen=True, auto_refresh=False) as live:
+        while True:
+            height = max(console.size.height - CHROME_LINES, 1)
+            if selected < offset:
+                offset = selected
+            elif selected >= offset + height:
+                offset = selected - height + 1
+
+            live.update(render(index, query, matches, selected, offset, height, elapsed, status), refresh=True)
+
+            key = readKey()
+            status = ""
+            if key == "esc":
+                return
+            if key == "enter":
+                if matches:
+                    status = copyPassword(index.rows[matches[selected]])
+                continue
+            if key == "up":
+                selected = max(selected - 1, 0)
+                continue
+            if key == "down":
+                selected = min(selected + 1, max(len(matches) - 1, 0))
+                continue
+            if key == "pgup":
+                selected = max(selected - height, 0)
+                continue
+            if key == "pgdn":
+                selected = min(selected + height, max(len(matches) - 1, 0))
+                continue
+
+            if key == "backspace":
+                query = query[:-1]
+            elif len(key) == 1 and key.isprintable():
+                query += key
+            else:
+                continue
+
+            started = time.perf_counter()
+            matches = index.search(query)
+            elapsed = time.perf_counter() - started
+            selected = 0
+            offset = 0
@@ -0,0 +1,48 @@
+import hmac
+import hashlib
+
+import utils.schema
+from utils.vault import computeMasterKey
+
+# The vault stores an HMAC of this label under the master key. One PBKDF2
+# run then both checks the master password and yields the key, and guessing
+# against the stored value costs a full KDF run per guess, unlike the
+# unsalted sha256(mp) older vaults keep in masterkey_hash.
+VERIFIER_LABEL = b"pm-verifier"
+
+
+def verifierOf(mk):
+    return hmac.new(mk, VERIFIER_LABEL, hashlib.sha256).hexdigest()
+
+
+def unlock(mp, db, secrets=None, notes=None):
+    """Check `mp` against the vault and bring the vault up to date
+
+    Returns (secrets, mk), or None when the password is wrong. A vault
+    that still holds the legacy hash gets a verifier on its first unlock,
+    and the hash is dropped. Upgrades are reported in the list `notes`
+    for the caller to show; nothing is printed.
+    """
+    cursor = db.cursor()
+    if secrets is None:
+        secrets = utils.schema.readSecrets(cursor)
+
+    if secrets.get("verifier"):
+        mk = computeMasterKey(mp, secrets["device_secret"])
+        if not hmac.compare_digest(verifierOf(mk), secrets["verifier"]):
+            return None
+        if utils.schema.migrate(db, secrets, notes) < utils.schema.LATEST:
+            secrets = utils.schema.readSecrets(cursor)
+        return secrets, mk
+
+    legacy = secrets.get("masterkey_hash") or ""
+    if not hmac.compare_digest(hashlib.sha256(mp.encode()).hexdigest(), legacy):
+        return None
+
+    utils.schema.migrate(db, secrets, notes)
+    mk = computeMasterKey(mp, secrets["device_secret"])
+    cursor.execute("UPDATE secrets SET verifier = %s, masterkey_hash = NULL", (verifierOf(mk),))
+    db.commit()
+    if notes is not None:
+        notes.append("Master password check upgraded to a key-derived verifier")
+    return utils.schema.readSecrets(cursor), mk
@@ -0,0 +1,153 @@
+from getpass import getpass
+
+import psycopg2
+import psycopg2.errors
+
+from utils.dbconfig import dbconfig
+from utils.trace import span
+import utils.aesutil
+import utils.metadata
+import utils.shards
+
+from rich import print as printc
+
+
+class UpdateError(Exception):
+    pass
+
+
+class EntryNotFound(UpdateError):
+    pass
+
+
+class AmbiguousEntry(UpdateError):
+    pass
+
+
+class VersionConflict(UpdateError):
+    pass
+
+
+def identity(sitename, siteurl, email="", username=""):
+    """Search dict for the entry to update; blank email/username are left out"""
+    search = {"sitename": sitename, "siteurl": siteurl}
+    if email:
+        search["email"] = email
+    if username:
+        search["username"] = username
+    return search
+
+
+def applyUpdate(cursor, mk, encrypted, search, changes, password=None, expectedVersion=None):
+    """Update the one entry matching `search` in a single statement
+
+    `changes` maps field names to new values ("tags" replaces the whole
+    list); `password` is a new plaintext password. The row's `version` is
+    bumped, and with `expectedVersion` the write only happens if nobody
+    changed the row since that version was read.
+    Returns (id, version) of the updated row.
+
+    The happy path is one UPDATE ... RETURNING round trip. Only when nothing
+    was updated does a SELECT run, to tell a missing row from a conflict.
+    """
+    columns = utils.metadata.encodeFields(mk, changes, encrypted)
+    if password is not None:
+        columns["password"] = utils.aesutil.encrypt(key=mk, source=password, keyType="bytes")
+    if not columns:
+        raise UpdateError("Nothing to update")
+
+    conditions, params = utils.metadata.searchConditions(mk, search, encrypted)
+    assignments = ", ".join([f"{col} = %s" for col in columns])
+
+    # The scalar subquery makes Postgres refuse the statement when more than
+    # one entry matches, instead of updating them all
+    query = f"""
+        UPDATE entries SET {assignments}, version = version + 1
+        WHERE id = (SELECT id FROM entries WHERE {conditions})
+    """
+    values = list(columns.values()) + params
+    if expectedVersion is not None:
+        query += " AND version = %s"
+        values.append(expectedVersion)
+    query += " RETURNING id, version"
+
+    try:
+        cursor.execute(query, values)
+        utils.metadata.rememberLabels(cursor, mk, changes, encrypted)
+    except psycopg2.errors.CardinalityViolation:
+        raise AmbiguousEntry("More than one entry matches; be more specific")
+
+    row = cursor.fetchone()
+    if row is not None:
+        return row
+
+    cursor.execute(f"SELECT version FROM entries WHERE {conditions}", params)
+    current = cursor.fetchone()
+    if current is None:
+        raise EntryNotFound("Entry not found")
+    raise VersionConflict(
+        f"Entry was changed by someone else (now at version {current[0]}, expected {expectedVersion})"
+    )
+
+
+def shardedUpdate(shards, mk, encrypted, search, changes, password=None, expectedVersion=None):
+    """applyUpdate on whichever node owning the site name holds the entry
+
+    A new site name can belong to another node; the entry is then moved there.
+    """
+    key = utils.shards.shardKey(mk, search["sitename"], encrypted)
+    for name in shards.owners(key):
+        db = shards.connect(name)
+        try:
+            row = applyUpdate(db.cursor(), mk, encrypted, search, changes, password, expectedVersion)
+            db.commit()
+        except EntryNotFound:
+            db.rollback()
+            continue
+        except UpdateError:
+            db.rollback()
+            raise
+
+        if "sitename" in changes and shards.owner(utils.shards.shardKey(mk, changes["sitename"], encrypted)) != name:
+            utils.shards.relocate(shards, name, "id = %s", [row[0]])
+        return row
+    raise EntryNotFound("Entry not found")
+
+
+def updateEntry(mp, ds, sitename, siteurl, email, username, changes=None, newPassword=None, expectedVersion=None, mk=None, db=None):
+    """Update an entry's fields and/or password
+
+    With no `changes` and no `newPassword`, prompts for a new password.
+    """
+    changes = changes or {}
+    if not changes and newPassword is None:
+        with span("getpass"):
+            newPassword = getpass("New Password: ")
+            retyped = getpass("Re-Type: ")
+        if newPassword == "" or newPassword != retyped:
+            printc("[yellow][-][/yellow] Passwords empty or do not match; nothing updated")
+            return None
+
+    # utils.vault builds on this module
+    from utils.vault import Vault, computeMasterKey
+
+    own = db is None
+    if own:
+        db = dbconfig()
+    encrypted = utils.metadata.isEncrypted(db.cursor())
+    if mk is None and (encrypted or newPassword is not None):
+        mk = computeMasterKey(mp, ds)
+
+    try:
+        row = Vault(db, mk, encrypted=encrypted).update(sitename, siteurl, email, username, changes, newPassword, expectedVersion)
+    except UpdateError as e:
+        db.rollback()
+        printc(f"[red][!][/red] {e}")
+        return None
+    finally:
+        if own:
+            db.close()
+
+    printc(f"[green][+][/green] Entry updated (version {row[1]})")
+    return row
+
@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+
+from rich import print as printc
+
+# Concurrent-writers check (python -m utils.updatecheck [WRITERS]).
+# Many writers race to update one scratch entry from the same version:
+# exactly one may win, every other one must get a VersionConflict.
+
+# Throwaway database the check runs in; it is rebuilt on every run, the
+# real 'pm' database is never touched
+DATABASE = "pm_update_check"
+
+DEFAULT_WRITERS = 16
+
+
+def run(writers=DEFAULT_WRITERS):
+    """Race `writers` updates of one entry; returns (won, conflicts, start version, final version)"""
+    import utils.bench
+    from utils.dbconfig import dbconfig
+    from utils.update import applyUpdate, VersionConflict
+
+    mk = os.urandom(32)
+    name = "update-check"
+    os.environ["PM_DATABASE"] = DATABASE
+    utils.bench.createDatabase(DATABASE)
+
+    db = dbconfig()
+    utils.bench.resetVault(db, False)
+    cursor = db.cursor()
+    cursor.execute(
+        "INSERT INTO entries (sitename, siteurl, email, username, password) VALUES (%s, %s, '', '', '') RETURNING version",
+        (name, name)
+    )
+    start_version = cursor.fetchone()[0]
+    db.commit()
+
+    barrier = threading.Barrier(writers)
+    outcomes = []
+
+    def writer(n):
+        conn = dbconfig()
+        cur = conn.cursor()
+        barrier.wait()
+        try:
+            applyUpdate(cur, mk, False, {"sitename": name}, {"email": f"writer{n}"}, expectedVersion=start_version)
+            conn.commit()
+            outcomes.append("won")
+        except VersionConflict:
+            conn.rollback()
+            outcomes.append("conflict")
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    cursor.execute("SELECT version FROM entries WHERE sitename = %s", (name,))
+    final_version = cursor.fetchone()[0]
+    db.close()
+    return outcomes.count("won"), outcomes.count("conflict"), start_version, final_version
+
+
+def passed(writers, won, conflicts, start_version, final_version):
+    return won == 1 and conflicts == writers - 1 and final_version == start_version + 1
+
+
+def main():
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_WRITERS
+    result = run(writers)
+    won, conflicts, start_version, final_version = result
+    ok = passed(writers, *result)
+    printc(f"[{'green' if ok else 'red'}]{won} won, {conflicts} conflicts, "
+           f"version {start_version} -> {final_version}[/]")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
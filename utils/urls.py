@@ -0,0 +1,35 @@
+from urllib.parse import urlsplit
+
+from utils.publicsuffix import registrableDomain
+
+
+def normalizeUrl(url):
+    """Split a site URL as typed into its normalized parts
+
+    Returns a dict with `scheme` (None when not typed), `host` (lowercase,
+    punycode, no port or trailing dot), `domain` (registrable domain of the
+    host) and `path` (without trailing slash). So https://github.com/login,
+    github.com and http://www.github.com/ all share domain "github.com".
+    """
+    url = (url or "").strip()
+    if "://" not in url:
+        url = "//" + url
+    parts = urlsplit(url)
+
+    try:
+        host = parts.hostname or ""
+    except ValueError:
+        host = ""
+    host = host.rstrip(".")
+    if host and not host.isascii():
+        try:
+            host = host.encode("idna").decode()
+        except UnicodeError:
+            pass
+
+    return {
+        "scheme": parts.scheme.lower() or None,
+        "host": host,
+        "domain": registrableDomain(host),
+        "path": parts.path.rstrip("/"),
+    }
@@ -0,0 +1,302 @@
+import hmac
+import hashlib
+
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Hash import SHA512
+
+from utils.dbconfig import dbconfig
+from utils.records import Entry
+from utils.trace import span
+from utils.update import UpdateError, EntryNotFound, AmbiguousEntry
+import utils.aesutil
+import utils.metadata
+import utils.shards
+import utils.update
+import utils.urls
+
+# Columns read for an Entry, in the order Entry.fromRow and the labels expect
+COLUMNS = "sitename, siteurl, email, username, password, tags, folder"
+
+# Rows pulled per round trip by iterEntries()
+ITER_BATCH = 1000
+
+
+def computeMasterKey(mp, ds):
+    password = mp.encode()
+    salt = ds.encode()
+    with span("kdf"):
+        key = PBKDF2(password, salt, 32, count=1000000, hmac_hash_module=SHA512)
+    return key
+
+
+def lockKey(mk, *values):
+    """Advisory lock key for an entry's details: a signed 64-bit HMAC
+    under the master key, so the server never sees the details"""
+    digest = hmac.new(mk, "\0".join(values).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+class VaultError(Exception):
+    pass
+
+
+class WrongPassword(VaultError):
+    pass
+
+
+class DuplicateEntry(VaultError):
+    pass
+
+
+class Vault:
+    """An unlocked vault, for use from Python
+
+    Holds one connection and the master key, so the key is derived once
+    however many operations follow. Methods return values and raise
+    VaultError (or utils.update.UpdateError for missing, ambiguous or
+    conflicting entries); none of them print or prompt. The CLI and the
+    menus are built on top of it.
+
+        with Vault.open(mp) as vault:
+            vault.add("github", "github.com", "", "me", "hunter2", tags=["work"])
+            entry = vault.get(sitename="github")
+            with vault.password(entry) as password:
+                ...
+
+    Search criteria are sitename, siteurl, email, username, domain, tags
+    (all must match), any_tags and folder. Sharded vaults are handled the
+    same way as by the CLI. Schema or verifier upgrades done by open() are
+    listed in `notes`, for the caller to show if it likes.
+    """
+
+    def __init__(self, db, mk, encrypted=None, own=False):
+        self.db = db
+        self.mk = mk
+        self.own = own
+        self.encrypted = utils.metadata.isEncrypted(db.cursor()) if encrypted is None else encrypted
+        # Names of the encrypted vault's tags and folders, by stored value
+        self._names = {}
+        self.notes = []
+
+    @classmethod
+    def open(cls, mp, db=None):
+        """Unlock with master password `mp` on `db`, or on a new connection the
+        vault then closes; raises WrongPassword"""
+        import utils.unlock
+
+        own = db is None
+        if own:
+            db = dbconfig()
+        notes = []
+        unlocked = utils.unlock.unlock(mp, db, notes=notes)
+        if unlocked is None:
+            if own:
+                db.close()
+            raise WrongPassword("Wrong master password")
+        db.commit()
+        secrets, mk = unlocked
+        vault = cls(db, mk, encrypted=bool(secrets.get("encrypt_metadata", False)), own=own)
+        vault.notes = notes
+        return vault
+
+    def close(self):
+        if self.own:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _search(self, search, criteria):
+        """Merge a column-keyed search dict and keyword criteria"""
+        search = dict(search or {})
+        for field, value in criteria.items():
+            if value is None:
+                continue
+            if field == "domain":
+                search["url_domain"] = utils.urls.normalizeUrl(value)["domain"]
+            elif field in utils.metadata.FIELDS + ["url_domain", "tags", "any_tags", "folder"]:
+                search[field] = [value] if field in ["tags", "any_tags"] and isinstance(value, str) else value
+            else:
+                raise VaultError(f"Unknown search field: {field}")
+        return search
+
+    def _where(self, search):
+        """(WHERE clause, params) for `search`; empty when there are no criteria"""
+        if not search:
+            return "", []
+        conditions, params = utils.metadata.searchConditions(self.mk, search, self.encrypted)
+        return f" WHERE {conditions}", params
+
+    def _labels(self, values):
+        """{stored value: name} covering `values`, re-read when one is unknown"""
+        if self.encrypted and any(value not in self._names for value in values):
+            rows = utils.shards.select(self.db, "SELECT value, name FROM labels")
+            self._names = utils.metadata.labelNames(self.mk, rows)
+            # Not re-read for a value that has no name
+            for value in values:
+                self._names.setdefault(value, "?")
+        return self._names
+
+    def _entry(self, row):
+        names = self._labels(list(row[5] or []) + ([row[6]] if row[6] else [])) if self.encrypted else None
+        tags, folder = utils.metadata.decodeLabels(row[5], row[6], self.encrypted, names)
+        return Entry(*utils.metadata.decodeRow(self.mk, row, self.encrypted), row[4], tuple(tags), folder)
+
+    def exists(self, sitename, siteurl, email="", username=""):
+        """Whether an entry with exactly these details exists"""
+        search = {"sitename": sitename, "siteurl": siteurl, "email": email, "username": username}
+        where, params = self._where(search)
+        query = f"SELECT 1 FROM entries{where}"
+        with span("db.query"):
+            # A sharded vault only asks the node(s) that own this site name
+            rows = utils.shards.select(self.db, query, params, key=utils.shards.shardKey(self.mk, sitename, self.encrypted))
+        return len(rows) != 0
+
+    def _lockKey(self, *values):
+        return lockKey(self.mk, *values)
+
+    def add(self, sitename, siteurl, email, username, password, tags=None, folder=None):
+        """Add an entry; raises DuplicateEntry if one with these details exists
+
+        The check and the insert run in one transaction holding an advisory
+        lock on the details, so two concurrent adds can't both pass the check.
+        """
+        with span("aes.encrypt"):
+            cipher = utils.aesutil.encrypt(key=self.mk, source=password, keyType="bytes")
+
+        # Encrypt metadata (when enabled) and build its blind indexes
+        values = {"sitename": sitename, "siteurl": siteurl, "email": email, "username": username,
+                  "tags": tags, "folder": folder}
+        columns = utils.metadata.encodeFields(self.mk, values, self.encrypted)
+        columns["password"] = cipher
+
+        # Add to db, or to the node that owns the site name on a sharded vault
+        shards = utils.shards.active()
+        home = self.db if shards is None else shards.connect(shards.owner(utils.shards.shardKey(self.mk, sitename, self.encrypted)))
+        cursor = home.cursor()
+        where, params = self._where({"sitename": sitename, "siteurl": siteurl, "email": email, "username": username})
+        query = "INSERT INTO entries ({}) VALUES ({})".format(
+            ", ".join(columns.keys()), ", ".join(["%s"] * len(columns))
+        )
+        with span("db.query"):
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (self._lockKey(sitename, siteurl, email, username),))
+            cursor.execute(f"SELECT 1 FROM entries{where} LIMIT 1", params)
+            if cursor.fetchone() is not None:
+                home.rollback()
+                raise DuplicateEntry("Entry with these details already exists")
+            cursor.execute(query, list(columns.values()))
+            utils.metadata.rememberLabels(cursor, self.mk, values, self.encrypted)
+            home.commit()
+
+    def search(self, search=None, **criteria):
+        """[Entry] matching the criteria; every entry when there are none"""
+        search = self._search(search, criteria)
+        where, params = self._where(search)
+        with span("db.query"):
+            # Sharded vaults ask the owner of the site name, or every node in parallel
+            rows = utils.shards.select(self.db, f"SELECT {COLUMNS} FROM entries{where}", params,
+                                       key=utils.shards.searchKey(self.mk, search, self.encrypted))
+        return [self._entry(row) for row in rows]
+
+    def get(self, search=None, **criteria):
+        """The one Entry matching the criteria; raises EntryNotFound or AmbiguousEntry"""
+        entries = self.search(search, **criteria)
+        if not entries:
+            raise EntryNotFound("Entry not found")
+        if len(entries) > 1:
+            raise AmbiguousEntry("More than one entry matches; be more specific")
+        return entries[0]
+
+    def iterEntries(self, search=None, batch=ITER_BATCH, **criteria):
+        """Entries matching the criteria, read through a server-side cursor
+        `batch` rows at a time, so memory stays flat for large vaults"""
+        search = self._search(search, criteria)
+        where, params = self._where(search)
+        key = utils.shards.searchKey(self.mk, search, self.encrypted)
+        pager = utils.shards.stream(self.db, f"SELECT {COLUMNS} FROM entries{where}", params,
+                                    key=key, name="pm_iter", itersize=batch)
+        try:
+            for row in pager:
+                yield self._entry(row)
+        finally:
+            pager.close()
+
+    def password(self, entry):
+        """An entry's decrypted password as a SecretBuffer; use it in a with-block"""
+        with span("aes.decrypt"):
+            return entry.password(self.mk)
+
+    def update(self, sitename, siteurl, email="", username="", changes=None, password=None, expectedVersion=None):
+        """Change an entry's fields and/or password; returns (id, version)
+
+        See utils.update.applyUpdate for `changes` and `expectedVersion`.
+        """
+        search = utils.update.identity(sitename, siteurl, email, username)
+        shards = utils.shards.active()
+        if shards is not None:
+            return utils.update.shardedUpdate(shards, self.mk, self.encrypted, search, changes or {}, password, expectedVersion)
+        try:
+            row = utils.update.applyUpdate(self.db.cursor(), self.mk, self.encrypted, search, changes or {}, password, expectedVersion)
+        except UpdateError:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        return row
+
+    def delete(self, sitename, siteurl, email="", username=""):
+        """Delete the entry with these details; raises EntryNotFound"""
+        search = {"sitename": sitename, "siteurl": siteurl, "email": email, "username": username}
+        where, params = self._where(search)
+        query = f"DELETE FROM entries{where}"
+        key = utils.shards.shardKey(self.mk, sitename, self.encrypted)
+        shards = utils.shards.active()
+        with span("db.query"):
+            if shards is None:
+                cursor = self.db.cursor()
+                cursor.execute(query, params)
+                deleted = cursor.rowcount
+                self.db.commit()
+            else:
+                deleted = shards.execute(query, params, key=key)
+        if deleted == 0:
+            raise EntryNotFound("Entry not found")
+        return deleted
+
+    def rotate(self, olderThan, search=None, length=None, **criteria):
+        """New generated passwords for the entries matching the criteria whose
+        password is older than the timedelta `olderThan`, in one transaction
+
+        See utils.rotate.rotateStale; returns the rotated entries as dicts,
+        with their new passwords. Not supported on a sharded vault yet.
+        """
+        import utils.rotate
+
+        if utils.shards.active() is not None:
+            raise VaultError("Rotation is not supported on a sharded vault yet")
+
+        search = self._search(search, criteria)
+        return utils.rotate.rotateStale(self.db, self.mk, self.encrypted, olderThan, search,
+                                        length or utils.rotate.ROTATE_LENGTH)
+
+    def tagCounts(self):
+        """([(tag, entries)], [(folder, entries)]), most used first
+
+        Counted by GROUP BY on each node; a sharded vault sums the nodes' counts.
+        """
+        counts = []
+        for query in [
+            "SELECT tag, COUNT(*) FROM entries, unnest(tags) AS tag GROUP BY tag",
+            "SELECT folder, COUNT(*) FROM entries WHERE folder IS NOT NULL GROUP BY folder",
+        ]:
+            with span("db.query"):
+                rows = utils.shards.select(self.db, query, dedupe=False)
+            names = self._labels([value for value, _ in rows])
+            totals = {}
+            for value, count in rows:
+                name = names.get(value, "?") if self.encrypted else value
+                totals[name] = totals.get(name, 0) + count
+            counts.append(sorted(totals.items(), key=lambda item: (-item[1], item[0])))
+        return counts[0], counts[1]
@@ -0,0 +1,228 @@
+import os
+import base64
+import binascii
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Cipher import AES
+
+import utils.aesutil
+import utils.metadata
+import utils.schema
+from utils.urls import normalizeUrl
+
+# Rows per task handed to a worker process
+VERIFY_BATCH = 2000
+
+COLUMNS = [
+    "id", "uuid", "sitename", "siteurl", "email", "username", "password",
+    "sitename_bidx", "siteurl_bidx", "email_bidx", "username_bidx", "url_domain",
+]
+
+# Set in each worker by _init. CBC decryption is done here with one ECB
+# cipher, P[i] = D(C[i]) xor C[i-1], instead of utils.aesutil creating a
+# new cipher, and so a new key schedule, for every value.
+_encrypted = False
+_keys = None
+_block = None
+
+
+def _init(mk, encrypted):
+    global _encrypted, _keys, _block
+    _encrypted = encrypted
+    _keys = utils.metadata.blindIndexKeys(mk) if encrypted else None
+    _block = AES.new(mk, AES.MODE_ECB)
+
+
+def _ciphertext(value):
+    """IV + ciphertext of a stored value; ValueError unless whole blocks"""
+    raw = base64.b64decode(value, validate=True)
+    if len(raw) < 2 * AES.block_size or len(raw) % AES.block_size:
+        raise ValueError("Invalid length")
+    return raw
+
+
+def _padding(block):
+    """Padding length of a last plaintext block, or 0 if it is invalid"""
+    n = block[-1]
+    return n if 1 <= n <= AES.block_size and block[-n:] == bytes([n]) * n else 0
+
+
+def _decrypts(value):
+    """Whether `value` decrypts with the master key to validly padded plaintext
+
+    Only the last block is decrypted, into a buffer zeroed straight after,
+    since the padding is all there is to check.
+    """
+    try:
+        raw = _ciphertext(value)
+    except (ValueError, TypeError, binascii.Error):
+        return False
+    tail = bytearray(_block.decrypt(raw[-AES.block_size:]))
+    for i, byte in enumerate(raw[-2 * AES.block_size:-AES.block_size]):
+        tail[i] ^= byte
+    valid = _padding(tail) != 0
+    tail[:] = bytes(len(tail))
+    return valid
+
+
+def _decryptField(value):
+    raw = _ciphertext(value)
+    body = _block.decrypt(raw[AES.block_size:])
+    data = (int.from_bytes(body, "big") ^ int.from_bytes(raw[:-AES.block_size], "big")).to_bytes(len(body), "big")
+    n = _padding(data)
+    if n == 0:
+        raise ValueError("Invalid padding...")
+    return data[:-n].decode()
+
+
+def checkRow(row):
+    """Problems found in one entry, as strings"""
+    entry = dict(zip(COLUMNS, row))
+    problems = []
+
+    if entry["password"] is None or not _decrypts(entry["password"]):
+        problems.append("password does not decrypt (bad padding, length or key)")
+
+    if not _encrypted:
+        if entry["url_domain"] is not None and entry["url_domain"] != normalizeUrl(entry["siteurl"])["domain"]:
+            problems.append("url_domain does not match siteurl (run backfill-urls)")
+        return problems
+
+    for field in utils.metadata.FIELDS:
+        value = entry[field]
+        if value is None:
+            continue
+        try:
+            plain = _decryptField(value)
+        except (ValueError, TypeError, UnicodeDecodeError, binascii.Error):
+            problems.append(f"{field} does not decrypt")
+            continue
+        if entry[f"{field}_bidx"] != utils.metadata.blindIndex(_keys, field, plain):
+            problems.append(f"{field}_bidx does not match {field}")
+        if field == "siteurl" and entry["url_domain"] is not None:
+            domain = normalizeUrl(plain)["domain"]
+            if entry["url_domain"] != utils.metadata.blindIndex(_keys, "url_domain", domain):
+                problems.append("url_domain does not match siteurl")
+    return problems
+
+
+def checkBatch(rows):
+    """[(id, uuid, problem)] for a batch of rows, checked in a worker"""
+    return [(row[0], row[1], problem) for row in rows for problem in checkRow(row)]
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def checkRows(rows, mk, encrypted, workers=None, batchSize=VERIFY_BATCH):
+    """Check `rows` in a pool of `workers` processes; returns (rows checked, problems)
+
+    Rows are handed over in batches as they are read, with at most two
+    batches per worker in flight, so memory stays flat however big the vault.
+    Workers report problems only, never plaintexts.
+    """
+    workers = workers or os.cpu_count() or 1
+    checked = 0
+    problems = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(mk, encrypted)) as pool:
+        pending = deque()
+        for batch in _batches(rows, batchSize):
+            checked += len(batch)
+            pending.append(pool.submit(checkBatch, batch))
+            if len(pending) >= workers * 2:
+                problems.extend(pending.popleft().result())
+        while pending:
+            problems.extend(pending.popleft().result())
+    return checked, problems
+
+
+def checkSchema(cursor):
+    """[(id, uuid, problem)] for vault-wide invariants; id and uuid may be None"""
+    problems = []
+
+    cursor.execute("SELECT COUNT(*) FROM secrets")
+    count = cursor.fetchone()[0]
+    if count != 1:
+        return [(None, None, f"secrets has {count} rows instead of 1")]
+
+    secrets = utils.schema.readSecrets(cursor)
+    if secrets.get("schema_version", 0) != utils.schema.LATEST:
+        problems.append((None, None, f"schema version {secrets.get('schema_version', 0)}, expected {utils.schema.LATEST}"))
+    if not secrets.get("verifier") and not secrets.get("masterkey_hash"):
+        problems.append((None, None, "no master password verifier"))
+
+    cursor.execute("SELECT id, uuid FROM entries WHERE version < 1")
+    problems += [(id, uuid, "version is below 1") for id, uuid in cursor.fetchall()]
+
+    if secrets.get("encrypt_metadata", False):
+        cursor.execute("""
+            SELECT id, uuid FROM entries
+            WHERE sitename_bidx IS NULL OR siteurl_bidx IS NULL
+               OR url_scheme IS NOT NULL OR url_host IS NOT NULL OR url_path IS NOT NULL
+        """)
+        problems += [(id, uuid, "missing blind index, or plaintext URL parts in an encrypted vault") for id, uuid in cursor.fetchall()]
+
+    # Every attachment has chunks 0..chunks-1, and belongs to an entry
+    cursor.execute("""
+        SELECT e.id, a.entry_uuid, a.id FROM attachments a
+        LEFT JOIN attachment_chunks c ON c.attachment_id = a.id
+        LEFT JOIN entries e ON e.uuid = a.entry_uuid
+        GROUP BY a.id, e.id
+        HAVING COUNT(c.seq) != a.chunks OR COALESCE(MAX(c.seq) + 1, 0) != a.chunks OR a.chunks = 0
+    """)
+    problems += [(id, uuid, f"attachment {attachment} has missing chunks") for id, uuid, attachment in cursor.fetchall()]
+    return problems
+
+
+def verifyVault(db, mk, workers=None):
+    """Check every entry and the vault's invariants; returns (entries checked, problems)"""
+    cursor = db.cursor()
+    encrypted = utils.metadata.isEncrypted(cursor)
+    problems = checkSchema(cursor)
+
+    pager = db.cursor(name="pm_verify")
+    pager.itersize = VERIFY_BATCH
+    pager.execute(f"SELECT {', '.join(COLUMNS)} FROM entries ORDER BY id")
+    try:
+        checked, found = checkRows(pager, mk, encrypted, workers)
+    finally:
+        pager.close()
+        db.commit()
+    return checked, problems + found
+
+
+if __name__ == "__main__":
+    # Throughput on generated rows, offline (python -m utils.verify [entries])
+    import sys
+    import time
+    from rich import print as printc
+    import utils.bench
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    mk = os.urandom(32)
+    password = utils.aesutil.encrypt(key=mk, source="correct horse battery staple", keyType="bytes")
+    for encrypted in [False, True]:
+        rows = []
+        for i in range(count):
+            columns = utils.metadata.encodeFields(mk, utils.bench.entryValues(i), encrypted)
+            columns.update(id=i + 1, uuid=str(i), password=password)
+            rows.append(tuple(columns.get(col) for col in COLUMNS))
+        # One damaged row, which must be the only one reported
+        rows[count // 2] = rows[count // 2][:6] + (password[:-4] + "AAA=",) + rows[count // 2][7:]
+
+        for workers in sorted({1, os.cpu_count() or 1}):
+            started = time.perf_counter()
+            checked, problems = checkRows(iter(rows), mk, encrypted, workers)
+            elapsed = time.perf_counter() - started
+            ok = checked == count and [p[0] for p in problems] == [count // 2 + 1]
+            printc(f"[{'green' if ok else 'red'}][{'+' if ok else '!'}][/] {'encrypted' if encrypted else 'plain'} metadata, "
+                   f"{workers} worker(s): {checked / elapsed:,.0f} entries/s, {len(problems)} problem(s) found")